@@ -0,0 +1,122 @@
+"""
+Per-worker cache of finished answers to first-turn questions, looked up by the
+question's embedding: a new question closer than `max_dist` to one answered before
+gets the stored answer (and the system message it was answered with) without any
+gpt-4o calls. Entries expire after `ttl` seconds, the oldest are evicted past
+`max_entries`, and every answer is stored under the fingerprint of the style guide and
+knowledge it was built from, so it's only replayed to a worker that loaded the same.
+"""
+
+import dataclasses
+import threading
+import time
+from collections import OrderedDict
+from apis import openai
+import logger
+
+_logger = logger.get_logger(__name__)
+
+
+@dataclasses.dataclass
+class AnswerCacheStats:
+    lookups: int = 0
+    hits: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0  # the fingerprint changed, so everything was dropped
+
+
+@dataclasses.dataclass
+class CachedAnswer:
+    question: openai.Embedding
+    system: str
+    answer: str
+    created: float
+
+
+class AnswerCache:
+    """Answers keyed by question embeddings, searched with an `EmbeddingIndex` rebuilt after every change."""
+
+    def __init__(self, max_entries, ttl, max_dist):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_dist = max_dist
+        self.stats = AnswerCacheStats()
+        self._entries = OrderedDict()  # oldest first
+        self._next_id = 0
+        self._index = None  # over the entries' questions, None if it needs a rebuild
+        self._indexed = {}  # id() of an indexed question to its entry
+        self._fingerprint = None  # of the style and knowledge every entry was answered with
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _check_fingerprint(self, fingerprint):
+        """Drop every entry if they were answered with other style or knowledge. Holds the lock."""
+        if fingerprint == self._fingerprint:
+            return
+        if self._entries:
+            _logger.info(f"Dropped {len(self._entries)} cached answers, the style or knowledge changed.")
+            self.stats.invalidations += 1
+        self._fingerprint = fingerprint
+        self._clear()
+
+    def _expire(self, now):
+        """Holds the lock."""
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.created < self.ttl:
+                break
+            del self._entries[key]
+            self._index = None
+            self.stats.expirations += 1
+
+    def _clear(self):
+        self._entries.clear()
+        self._index = None
+
+    def lookup(self, question, fingerprint):
+        """
+        The closest `CachedAnswer` to the `question` embedding within `max_dist`, answered
+        with the style and knowledge of `fingerprint`, or None.
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self.stats.lookups += 1
+            self._expire(now)
+            if not self._entries or fingerprint != self._fingerprint:
+                return None
+            if self._index is None:
+                entries = list(self._entries.values())
+                self._indexed = {id(entry.question): entry for entry in entries}
+                self._index = openai.EmbeddingIndex([entry.question for entry in entries], max_dist=None)
+            nearest = self._index.query(question, k=1, max_dist=self.max_dist)
+            if not nearest:
+                return None
+            self.stats.hits += 1
+            entry = self._indexed[id(nearest[0].e2)]
+        _logger.debug(f"Answering {question.content!r} from the cache of {entry.question.content!r} ({nearest[0].dist:.3f}).")
+        return entry
+
+    def put(self, question, fingerprint, system, answer):
+        if not self.enabled or not answer:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._entries[self._next_id] = CachedAnswer(question, system, answer, created=now)
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+            self._index = None
+            self.stats.stores += 1
+
+    def clear(self):
+        with self._lock:
+            self._clear()
@@ -2,9 +2,13 @@ import openai
 
 import settings
 
-client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+client = openai.OpenAI(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_BASE_URL)
 APIConnectionError = openai.APIConnectionError
 
 # expose module endpoints
-from apis.openai.completions import get_completion, async_get_completion
-from apis.openai.embeddings import Embedding, k_nearest
+from apis.openai.completions import get_completion, async_get_completion, async_stream_completion
+from apis.openai.embeddings import Embedding, EmbeddingDist, EMBEDDING_MODEL
+from apis.openai.index import EmbeddingIndex, k_nearest, async_k_nearest
+from apis.openai.store import EmbeddingStore, StoreError
+from apis.openai.ivf import IVFIndex
+from apis.openai.cache import EmbeddingCache, query_cache
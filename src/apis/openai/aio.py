@@ -0,0 +1,62 @@
+"""
+Native async access to openai. Each event loop gets one `AsyncOpenAI` client with
+a pooled HTTP connection and explicit timeouts, plus a semaphore that bounds how
+many calls that loop has in flight at once.
+"""
+
+from typing import Dict
+import asyncio
+import weakref
+import httpx
+import openai
+import settings
+
+
+class _LoopResources:
+    """The client and semaphore belonging to one event loop (httpx pools can't be shared across loops)."""
+
+    def __init__(self):
+        self.http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.OPENAI_READ_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_MAX_CONNECTIONS,
+            ),
+        )
+        self.client = openai.AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL,
+            http_client=self.http_client,
+        )
+        self.semaphore = asyncio.Semaphore(settings.OPENAI_MAX_CONCURRENCY)
+
+
+_resources: Dict[asyncio.AbstractEventLoop, _LoopResources] = weakref.WeakKeyDictionary()
+
+
+def _get_resources() -> _LoopResources:
+    loop = asyncio.get_running_loop()
+    resources = _resources.get(loop)
+    if resources is None:
+        resources = _resources[loop] = _LoopResources()
+    return resources
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """The async openai client for the running event loop."""
+    return _get_resources().client
+
+
+def concurrency_limit() -> asyncio.Semaphore:
+    """
+    Hold this (`async with concurrency_limit():`) for the duration of an openai call, or
+    until the response starts for a streamed one.
+    """
+    return _get_resources().semaphore
+
+
+async def aclose() -> None:
+    """Close the pooled connections of the running event loop, e.g. before shutting the loop down."""
+    resources = _resources.pop(asyncio.get_running_loop(), None)
+    if resources is not None:
+        await resources.http_client.aclose()
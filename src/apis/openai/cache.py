@@ -0,0 +1,218 @@
+from __future__ import annotations
+from apis.openai.embeddings import Embedding, EMBEDDING_MODEL
+from collections import OrderedDict
+from typing import Dict, Optional
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+import settings
+import logger
+from local_sqlite import ThreadLocalConnection
+
+_logger = logger.get_logger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of query embeddings keyed on normalized text and model name.
+    The first tier is a bounded in-process LRU, the second is an SQLite file shared
+    by every worker on the host that evicts its least recently used rows once it
+    grows past `max_disk_bytes`. Triggers keep the file's total size in a one-row
+    table, so checking it doesn't scan every row.
+    """
+
+    TOUCH_INTERVAL = 60.0  # seconds a row's last_used may lag behind its hits, so most hits only read
+
+    def __init__(
+        self,
+        path: str = settings.EMBEDDING_CACHE_PATH,
+        max_memory_entries: int = settings.EMBEDDING_CACHE_MEMORY_ENTRIES,
+        max_disk_bytes: int = settings.EMBEDDING_CACHE_DISK_BYTES,
+    ):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = ThreadLocalConnection(path, self._create_tables)
+
+    @staticmethod
+    def normalize(content: str) -> str:
+        """Case-fold and collapse whitespace so trivially different questions share a key."""
+        return ' '.join(content.casefold().split())
+
+    @classmethod
+    def key(cls, content: str, model: str) -> str:
+        return hashlib.sha256(f'{model}\0{cls.normalize(content)}'.encode('utf-8')).hexdigest()
+
+    def stats(self) -> Dict[str, int]:
+        """Hit and miss counters, where every hit is an embeddings round-trip saved."""
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_entries': len(self._memory),
+        }
+
+    def gen(self, content: str, model: str = EMBEDDING_MODEL) -> Embedding:
+        """Like `Embedding.gen`, but only calls openai when neither tier has the vector."""
+        vector = self.get(content, model)
+        if vector is None:
+            embedding = Embedding.gen(content, model)
+            self.put(content, model, np.asarray(embedding.vector, dtype=np.float32))
+            return embedding
+        return Embedding(content=content, vector=vector)
+
+    async def async_gen(self, content: str, model: str = EMBEDDING_MODEL) -> Embedding:
+        """
+        Like `Embedding.async_gen`, but only calls openai when neither tier has the vector.
+        The disk tier is read and written in a thread, off the event loop.
+        """
+        key = self.key(content, model)
+        vector = self._memory_get(key)
+        if vector is None:
+            vector = await asyncio.to_thread(self._disk_lookup, key)
+        if vector is None:
+            embedding = await Embedding.async_gen(content, model)
+            await asyncio.to_thread(self.put, content, model, np.asarray(embedding.vector, dtype=np.float32))
+            return embedding
+        return Embedding(content=content, vector=vector)
+
+    def get(self, content: str, model: str = EMBEDDING_MODEL) -> Optional[np.ndarray]:
+        key = self.key(content, model)
+        vector = self._memory_get(key)
+        return vector if vector is not None else self._disk_lookup(key)
+
+    def _memory_get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            return vector
+
+    def _disk_lookup(self, key: str) -> Optional[np.ndarray]:
+        """Read the disk tier, counting a miss or remembering the vector in memory."""
+        vector = self._disk_get(key)
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, vector)
+            return vector
+
+    def put(self, content: str, model: str, vector: np.ndarray) -> None:
+        key = self.key(content, model)
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.setflags(write=False)  # shared between requests
+        with self._lock:
+            self._remember(key, vector)
+        self._disk_put(key, model, vector)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        try:
+            with self._connection() as db:
+                db.execute('DELETE FROM embeddings')
+        except sqlite3.Error as e:
+            _logger.warning(f'Failed to clear embedding cache: {e}.')
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        """Add to the in-process LRU, must be called while holding the lock."""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    @staticmethod
+    def _create_tables(db: sqlite3.Connection) -> None:
+        db.execute('BEGIN IMMEDIATE')  # so no other worker writes between creating the table and its triggers
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, '
+            'size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings_size ('
+            'id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)'
+        )
+        db.execute(
+            'CREATE TRIGGER IF NOT EXISTS embeddings_size_insert AFTER INSERT ON embeddings '
+            'BEGIN UPDATE embeddings_size SET total = total + NEW.size; END'
+        )
+        db.execute(
+            'CREATE TRIGGER IF NOT EXISTS embeddings_size_update AFTER UPDATE OF size ON embeddings '
+            'BEGIN UPDATE embeddings_size SET total = total + NEW.size - OLD.size; END'
+        )
+        db.execute(
+            'CREATE TRIGGER IF NOT EXISTS embeddings_size_delete AFTER DELETE ON embeddings '
+            'BEGIN UPDATE embeddings_size SET total = total - OLD.size; END'
+        )
+        # the total of a cache file written before it was kept
+        db.execute(
+            'INSERT OR IGNORE INTO embeddings_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM embeddings'
+        )
+        db.commit()
+
+    def _disk_get(self, key: str) -> Optional[np.ndarray]:
+        try:
+            db = self._connection()
+            row = db.execute('SELECT vector, last_used FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            vector, last_used = row
+            now = time.time()
+            if now - last_used > self.TOUCH_INTERVAL:
+                with db:
+                    db.execute('UPDATE embeddings SET last_used = ? WHERE key = ?', (now, key))
+            return np.frombuffer(vector, dtype='<f4')
+        except sqlite3.Error as e:
+            # the cache is an optimization, never fail a request because of it
+            _logger.warning(f'Failed to read embedding cache: {e}.')
+            return None
+
+    def _disk_put(self, key: str, model: str, vector: np.ndarray) -> None:
+        blob = vector.astype('<f4').tobytes()
+        try:
+            with self._connection() as db:
+                # an upsert rather than INSERT OR REPLACE, whose implicit delete wouldn't fire the size trigger
+                db.execute(
+                    'INSERT INTO embeddings (key, model, vector, size, last_used) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET model = excluded.model, vector = excluded.vector, '
+                    'size = excluded.size, last_used = excluded.last_used',
+                    (key, model, blob, len(blob), time.time()),
+                )
+                self._evict(db)
+        except sqlite3.Error as e:
+            _logger.warning(f'Failed to write embedding cache: {e}.')
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        """Drop least recently used rows until the table is back under 90% of its size budget."""
+        (total,) = db.execute('SELECT total FROM embeddings_size').fetchone()
+        if total <= self.max_disk_bytes:
+            return
+        target = int(self.max_disk_bytes * 0.9)
+        freed = 0
+        stale = []
+        for key, size in db.execute('SELECT key, size FROM embeddings ORDER BY last_used'):
+            if total - freed <= target:
+                break
+            stale.append((key,))
+            freed += size
+        db.executemany('DELETE FROM embeddings WHERE key = ?', stale)
+        _logger.debug(f'Evicted {len(stale)} embeddings ({freed} bytes) from the disk cache.')
+
+
+query_cache = EmbeddingCache()
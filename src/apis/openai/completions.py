@@ -1,6 +1,6 @@
 from apis.openai import client
-import asyncio
-from typing import List, Dict, Any, Generator, Union
+from apis.openai.aio import get_async_client, concurrency_limit
+from typing import List, Dict, Any, AsyncGenerator, Generator, Union
 
 
 def get_completion(
@@ -28,7 +28,6 @@ def get_completion(
         return "".join(streamed_response())
 
 
-# Asynchronous method using asyncio and OpenAI API
 async def async_get_completion(
     messages: List[Dict[str, Any]], model: str, **kwargs
 ) -> str:
@@ -36,8 +35,35 @@ async def async_get_completion(
     Async function for getting a chat completion from OpenAI.
     Returns the entire response as a string.
     """
-    loop = asyncio.get_event_loop()
-    response = await loop.run_in_executor(
-        None, get_completion, messages, model, False, **kwargs
-    )
-    return response
+    async with concurrency_limit():
+        response = await get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=False,
+            **kwargs,
+        )
+    return response.choices[0].message.content or ""
+
+
+async def async_stream_completion(
+    messages: List[Dict[str, Any]], model: str, **kwargs
+) -> AsyncGenerator[str, None]:
+    """
+    Async generator streaming back a chat completion from OpenAI token by token.
+    The connection is released as soon as the generator is closed.
+    """
+    # only starting the call counts against the concurrency limit, an answer can stream for
+    # much longer and open streams are bounded by the connection pool instead
+    async with concurrency_limit():
+        stream = await get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **kwargs,
+        )
+    try:
+        async for chunk in stream:
+            if chunk.choices and (content := chunk.choices[0].delta.content):
+                yield content
+    finally:
+        await stream.close()
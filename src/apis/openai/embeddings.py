@@ -1,15 +1,29 @@
 from __future__ import annotations
 from apis.openai import client
+from apis.openai.aio import get_async_client, concurrency_limit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from typing import List
 import json
 import settings
 import logger
 import os
-import math
+import random
+import time
+import numpy as np
+import openai
 
 _logger = logger.get_logger(__name__)
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Failures worth retrying, anything else (bad request, auth, ..) is raised straight away
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,  # includes timeouts
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
 
 @dataclass
 class Embedding:
@@ -23,10 +37,19 @@ class Embedding:
     @staticmethod
     def load_list(path: str) -> List[Embedding]:
         """
-        Load a list of embeddings from a JSON file.
+        Load a list of embeddings from a JSON file, or from a binary embedding
+        store (see `apis.openai.store`). Binary stores are memory-mapped rather
+        than parsed, and each vector is a read-only view onto the mapped file.
         """
-        with open(f'{settings.LOCAL_RESOURCE_DIR}/{path}', 'r') as file:
-            _logger.debug(f'Loading embeddings from {settings.LOCAL_RESOURCE_DIR}/{path}..')
+        from apis.openai import store  # imported here since the store module builds on Embedding
+
+        full_path = f'{settings.LOCAL_RESOURCE_DIR}/{path}'
+        if store.is_store(full_path):
+            embeddings = list(store.EmbeddingStore(full_path))
+            _logger.debug(f'Loaded {len(embeddings)} embeddings!')
+            return embeddings
+        with open(full_path, 'r') as file:
+            _logger.debug(f'Loading embeddings from {full_path}..')
             json_embeddings = json.load(file)
             embeddings = [
                 Embedding(
@@ -41,16 +64,24 @@ class Embedding:
     @staticmethod
     def save_list(embeddings: List[Embedding], path) -> None:
         """
-        Save a list of embeddings to a JSON file.
+        Save a list of embeddings to a JSON file if `path` ends in `.json`,
+        otherwise to a binary embedding store.
         """
+        from apis.openai import store
+
         os.makedirs(f'{settings.LOCAL_RESOURCE_DIR}', exist_ok=True)
-        with open(f'{settings.LOCAL_RESOURCE_DIR}/{path}', 'w') as file:
-            _logger.debug(f'Saving {len(embeddings)} embeddings to {settings.LOCAL_RESOURCE_DIR}/{path}..')
+        full_path = f'{settings.LOCAL_RESOURCE_DIR}/{path}'
+        _logger.debug(f'Saving {len(embeddings)} embeddings to {full_path}..')
+        if not path.endswith('.json'):
+            store.save(embeddings, full_path)
+            _logger.debug(f'Saved!')
+            return
+        with open(full_path, 'w') as file:
             json.dump({
                 'embeddings': [
                     {
                         'content': e.content,
-                        'vector': e.vector,
+                        'vector': [float(x) for x in e.vector],
                     }
                     for e in embeddings
                 ],
@@ -58,7 +89,7 @@ class Embedding:
             _logger.debug(f'Saved!')
 
     @staticmethod
-    def gen(content: str) -> Embedding:
+    def gen(content: str, model: str = EMBEDDING_MODEL) -> Embedding:
         """
         Generate an embedding from openai given some string content.
         """
@@ -67,19 +98,72 @@ class Embedding:
             vector=(
                 client
                 .embeddings
-                .create(input=content, model="text-embedding-ada-002")
+                .create(input=content, model=model)
                 .data[0]
                 .embedding
             ),
         )
 
     @staticmethod
-    def gen_list(content_list: List[str]) -> List[Embedding]:
-        embeddings = []
-        for i, content in enumerate(content_list):
-            embeddings.append(Embedding.gen(content))
-            _logger.debug(f'Generated {i}/{len(content_list)} embeddings.')
-        return embeddings
+    async def async_gen(content: str, model: str = EMBEDDING_MODEL) -> Embedding:
+        """
+        Generate an embedding from openai without blocking the event loop.
+        """
+        async with concurrency_limit():
+            response = await get_async_client().embeddings.create(input=content, model=model)
+        return Embedding(content=content, vector=response.data[0].embedding)
+
+    @staticmethod
+    def gen_list(
+        content_list: List[str],
+        batch_size: int = settings.EMBEDDING_BATCH_SIZE,
+        concurrency: int = settings.EMBEDDING_CONCURRENCY,
+        max_retries: int = settings.EMBEDDING_MAX_RETRIES,
+        embeddings_client=None,
+    ) -> List[Embedding]:
+        """
+        Generate embeddings for many strings, sending `batch_size` inputs per request
+        with up to `concurrency` requests in flight. Transient failures are retried
+        with exponential backoff. `embeddings_client` defaults to the openai client,
+        pass an `apis.openai.fake.FakeClient` to exercise the batching offline.
+        """
+        embeddings_client = embeddings_client or client
+        batches = [
+            content_list[i:i + batch_size] for i in range(0, len(content_list), batch_size)
+        ]
+        results = [None] * len(batches)
+        done = 0
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {
+                executor.submit(Embedding._gen_batch, embeddings_client, batch, max_retries): i
+                for i, batch in enumerate(batches)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += len(results[futures[future]])
+                elapsed = time.perf_counter() - start_time
+                _logger.debug(
+                    f'Generated {done}/{len(content_list)} embeddings '
+                    f'({done / elapsed if elapsed else 0:.1f} embeddings/s).'
+                )
+        return [embedding for batch in results for embedding in batch]
+
+    @staticmethod
+    def _gen_batch(embeddings_client, batch: List[str], max_retries: int) -> List[Embedding]:
+        """Embed one batch of strings in a single request, retrying transient failures."""
+        for attempt in range(max_retries + 1):
+            try:
+                response = embeddings_client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+                break
+            except TRANSIENT_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                delay = min(30.0, 0.5 * 2 ** attempt) * (1 + random.random())
+                _logger.warning(f'Embedding batch failed ({e!r}), retrying in {delay:.1f} seconds.')
+                time.sleep(delay)
+        vectors = [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+        return [Embedding(content=c, vector=v) for c, v in zip(batch, vectors)]
 
 
 @dataclass
@@ -94,14 +178,7 @@ class EmbeddingDist:
 
     @staticmethod
     def get(e1, e2) -> EmbeddingDist:
-        dist = math.sqrt(sum((p - q) ** 2 for p, q in zip(e1.vector, e2.vector)))
+        delta = np.asarray(e1.vector, dtype=np.float32) - np.asarray(e2.vector, dtype=np.float32)
+        dist = float(np.sqrt(np.dot(delta, delta)))
         return EmbeddingDist(e1=e1, e2=e2, dist=dist)
 
-
-def k_nearest(content: str, embeddings: List[Embedding], k: int) -> List[EmbeddingDist]:
-    """Get the `k` nearest embeddings to the given `content`."""
-    content_embedding = Embedding.gen(content)
-    distances = [EmbeddingDist.get(content_embedding, e) for e in embeddings]
-    nearest = sorted(distances, key=lambda d: d.dist)[:k]
-    _logger.debug(f'Found k-nearest distances: {[n.dist for n in nearest]}')
-    return nearest
@@ -0,0 +1,69 @@
+"""
+Local stand-in for the parts of the openai client we call, for exercising and
+benchmarking the embedding pipeline offline. Nothing here touches the network.
+"""
+
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import List, Union
+import hashlib
+import random
+import threading
+import time
+import httpx
+import numpy as np
+import openai
+
+
+def fake_vector(content: str, dim: int = 1536) -> List[float]:
+    """A deterministic unit vector for `content`, so the same input always embeds the same."""
+    seed = int.from_bytes(hashlib.sha256(content.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+@dataclass
+class FakeEmbeddings:
+    """Mimics `client.embeddings` with a fixed per-request latency and random transient failures."""
+
+    latency: float = 0.2
+    failure_rate: float = 0.0
+    dim: int = 1536
+
+    def __post_init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def create(self, input: Union[str, List[str]], model: str, **kwargs):
+        inputs = [input] if isinstance(input, str) else list(input)
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if random.random() < self.failure_rate:
+                raise openai.APIConnectionError(
+                    request=httpx.Request('POST', 'http://fake-openai/v1/embeddings')
+                )
+            return SimpleNamespace(
+                model=model,
+                data=[
+                    SimpleNamespace(index=i, embedding=fake_vector(content, self.dim))
+                    for i, content in enumerate(inputs)
+                ],
+            )
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class FakeClient:
+    """Drop-in for `apis.openai.client` wherever only embeddings are needed."""
+
+    MODEL = "fake"  # what to record as the model of its vectors, so they're never mistaken for real ones
+
+    def __init__(self, latency: float = 0.2, failure_rate: float = 0.0, dim: int = 1536):
+        self.embeddings = FakeEmbeddings(latency=latency, failure_rate=failure_rate, dim=dim)
@@ -0,0 +1,155 @@
+"""
+Local stand-in for the openai chat completions and embeddings endpoints, for load
+testing without spending real api money. Point the app at it with OPENAI_BASE_URL:
+
+    PYTHONPATH=src python -m apis.openai.fake_server --port 8765 --ttft 0.4 --token-rate 40
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 uvicorn --app-dir src asgi:application
+
+Streams are sent the way openai sends them (`data: {chunk}` lines, then `data: [DONE]`),
+with a configurable time-to-first-token, token rate and error injection.
+"""
+
+from dataclasses import dataclass
+import argparse
+import asyncio
+import json
+import random
+import time
+from aiohttp import web
+from apis.openai.fake import fake_vector
+
+WORDS = (
+    "sure thing so i grew up in ontario and moved to montreal for school where i studied "
+    + "computer science and i still like to build small projects like this one in my spare time"
+).split()
+
+
+@dataclass
+class FakeServerConfig:
+    latency: float = 0.05  # seconds before any response (and the whole of a non-streamed one)
+    ttft: float = 0.3  # seconds from request to the first streamed token
+    token_rate: float = 50.0  # tokens per second after the first
+    tokens: int = 120  # tokens per streamed completion
+    error_rate: float = 0.0  # chance a request fails with a 500 (or a 429, see below)
+    ratelimit_rate: float = 0.0  # chance a request fails with a 429
+    disconnect_rate: float = 0.0  # chance a stream is cut off halfway
+    dim: int = 1536
+
+
+def error_response(status, message):
+    return web.json_response(
+        {"error": {"message": message, "type": "server_error", "param": None, "code": None}},
+        status=status,
+    )
+
+
+def injected_error(config):
+    roll = random.random()
+    if roll < config.ratelimit_rate:
+        return error_response(429, "Rate limit reached (injected by the fake server).")
+    if roll < config.ratelimit_rate + config.error_rate:
+        return error_response(500, "The server had an error (injected by the fake server).")
+    return None
+
+
+def chunk(id, model, created, delta, finish_reason=None):
+    return {
+        "id": id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+async def chat_completions(request):
+    config = request.app["config"]
+    body = await request.json()
+    model = body.get("model", "gpt-4o")
+    id, created = f"chatcmpl-fake{random.getrandbits(32):08x}", int(time.time())
+    await asyncio.sleep(config.latency)
+    if (error := injected_error(config)) is not None:
+        return error
+
+    if not body.get("stream"):
+        return web.json_response({
+            "id": id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": body["messages"][-1]["content"][-200:]},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await asyncio.sleep(max(0.0, config.ttft - config.latency))
+    cut_off = config.tokens // 2 if random.random() < config.disconnect_rate else None
+    await response.write(f"data: {json.dumps(chunk(id, model, created, {'role': 'assistant', 'content': ''}))}\n\n".encode())
+    for i in range(config.tokens):
+        if i == cut_off:
+            request.transport.close()  # the client sees the connection drop mid-stream
+            return response
+        if i:
+            await asyncio.sleep(1 / config.token_rate)
+        token = ("" if i == 0 else " ") + WORDS[i % len(WORDS)]
+        await response.write(f"data: {json.dumps(chunk(id, model, created, {'content': token}))}\n\n".encode())
+    await response.write(f"data: {json.dumps(chunk(id, model, created, {}, 'stop'))}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+async def embeddings(request):
+    config = request.app["config"]
+    body = await request.json()
+    inputs = [body["input"]] if isinstance(body["input"], str) else body["input"]
+    await asyncio.sleep(config.latency)
+    if (error := injected_error(config)) is not None:
+        return error
+    return web.json_response({
+        "object": "list",
+        "model": body.get("model"),
+        "data": [
+            {"object": "embedding", "index": i, "embedding": fake_vector(content, config.dim)}
+            for i, content in enumerate(inputs)
+        ],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    })
+
+
+def build_app(config: FakeServerConfig) -> web.Application:
+    app = web.Application()
+    app["config"] = config
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/embeddings", embeddings)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    defaults = FakeServerConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--ttft", type=float, default=defaults.ttft)
+    parser.add_argument("--token-rate", type=float, default=defaults.token_rate)
+    parser.add_argument("--tokens", type=int, default=defaults.tokens)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--ratelimit-rate", type=float, default=defaults.ratelimit_rate)
+    parser.add_argument("--disconnect-rate", type=float, default=defaults.disconnect_rate)
+    args = parser.parse_args()
+    config = FakeServerConfig(
+        latency=args.latency,
+        ttft=args.ttft,
+        token_rate=args.token_rate,
+        tokens=args.tokens,
+        error_rate=args.error_rate,
+        ratelimit_rate=args.ratelimit_rate,
+        disconnect_rate=args.disconnect_rate,
+    )
+    print(f"Fake openai listening on http://{args.host}:{args.port}/v1 with {config}.")
+    web.run_app(build_app(config), host=args.host, port=args.port, print=None)
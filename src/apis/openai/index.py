@@ -0,0 +1,196 @@
+from __future__ import annotations
+from apis.openai.embeddings import Embedding, EmbeddingDist
+from apis.openai import store
+from apis.openai.cache import query_cache
+from typing import List, Optional, Sequence, Union
+import hashlib
+import os
+import numpy as np
+import settings
+import logger
+import tracing
+
+_logger = logger.get_logger(__name__)
+
+
+class EmbeddingIndex:
+    """
+    Nearest-neighbour index that keeps every stored vector in one contiguous
+    float32 matrix, so a query is a single matrix-vector product instead of
+    a Python loop over every embedding.
+    """
+
+    def __init__(
+        self,
+        embeddings: Sequence[Embedding],
+        matrix: Optional[np.ndarray] = None,
+        max_dist: Optional[float] = settings.KNOWLEDGE_MAX_DIST,
+    ):
+        """
+        Build an index over `embeddings`. If `matrix` is given, it must hold the
+        vectors of `embeddings` row by row and is used as-is (i.e., without copying).
+        Results further than `max_dist` away are dropped from every query, set it
+        to `None` to keep everything.
+        """
+        if matrix is None:
+            matrix = np.array([e.vector for e in embeddings], dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[0] != len(embeddings):
+            raise ValueError(
+                f'Index matrix of shape {matrix.shape} does not match {len(embeddings)} embeddings.'
+            )
+        self.embeddings = embeddings
+        self.matrix = matrix
+        self.max_dist = max_dist
+        # |x|^2 for every row, so that |x - q|^2 = |x|^2 - 2 x.q + |q|^2 is one matvec per query
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix, dtype=np.float32)
+        _logger.debug(f'Built embedding index over {len(embeddings)} vectors of size {self.dim}.')
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> EmbeddingIndex:
+        """
+        Build an index from an embeddings file in the resource directory. Binary
+        stores are indexed in place over their memory-mapped vectors (through their
+        ivf index if one was built, see `apis.openai.ivf`), JSON files are parsed
+        and copied into a new matrix.
+        """
+        from apis.openai import ivf  # imported here since the ivf index builds on this one
+
+        full_path = f'{settings.LOCAL_RESOURCE_DIR}/{path}'
+        if store.is_store(full_path):
+            embedding_store = store.EmbeddingStore(full_path)
+            if os.path.exists(ivf.ivf_path(full_path)):
+                try:
+                    return ivf.IVFIndex.open(embedding_store, ivf.ivf_path(full_path), **kwargs)
+                except store.StoreError as e:
+                    _logger.warning(f'Searching {path} exhaustively, its ivf index is unusable: {e}')
+            return cls(embedding_store, matrix=embedding_store.matrix, **kwargs)
+        return cls(Embedding.load_list(path), **kwargs)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def fingerprint(self) -> str:
+        """Cheap hash of what is indexed (its shape and a sample of its contents and vectors)."""
+        digest = hashlib.sha256()
+        digest.update(np.asarray(self.matrix.shape, dtype='<u8').tobytes())
+        step = max(1, len(self) // 256)
+        for i in range(0, len(self), step):
+            digest.update(self.embeddings[i].content.encode('utf-8') + b'\0')
+        digest.update(np.ascontiguousarray(self.matrix[::step]).tobytes())
+        return digest.hexdigest()
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    def query(
+        self, embedding: Embedding, k: int, max_dist: Optional[float] = None, exact: bool = False
+    ) -> List[EmbeddingDist]:
+        """
+        Get the `k` nearest stored embeddings to `embedding`, closest first. Only
+        embeddings closer than `max_dist` (or the index default) are returned.
+        Approximate indexes (see `apis.openai.ivf`) search every vector if `exact`.
+        """
+        return self.query_batch([embedding], k=k, max_dist=max_dist, exact=exact)[0]
+
+    def query_batch(
+        self, embeddings: Sequence[Embedding], k: int, max_dist: Optional[float] = None, exact: bool = False
+    ) -> List[List[EmbeddingDist]]:
+        """
+        Score many query embeddings at once with a single matrix-matrix product.
+        Returns one list of nearest neighbours per query, in the same order. This
+        index is always exact.
+        """
+        if not embeddings:
+            return []
+        queries = np.array([e.vector for e in embeddings], dtype=np.float32)
+        distances = self.distances(queries)
+        max_dist = self.max_dist if max_dist is None else max_dist
+        return [
+            self._nearest(query, vector, row, k, max_dist)
+            for query, vector, row in zip(embeddings, queries, distances)
+        ]
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Euclidean distances between each row of `queries` and every stored vector,
+        as a (num_queries, len(self)) float32 matrix.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        q_sq_norms = np.einsum('ij,ij->i', queries, queries, dtype=np.float32)
+        sq_dists = self.sq_norms[None, :] - 2 * (queries @ self.matrix.T) + q_sq_norms[:, None]
+        np.maximum(sq_dists, 0, out=sq_dists)  # clamp float error around identical vectors
+        return np.sqrt(sq_dists, out=sq_dists)
+
+    def _nearest(
+        self,
+        query: Embedding,
+        vector: np.ndarray,
+        dists: np.ndarray,
+        k: int,
+        max_dist: Optional[float],
+    ) -> List[EmbeddingDist]:
+        """Pick the top `k` from one row of distances using a partial sort."""
+        k = min(k, len(dists))
+        if k <= 0:
+            return []
+        if k < len(dists):
+            candidates = np.argpartition(dists, k - 1)[:k]
+        else:
+            candidates = np.arange(len(dists))
+        # the expanded form loses precision on tiny distances, so re-score the few winners exactly
+        delta = self.matrix[candidates] - vector
+        exact = np.sqrt(np.einsum('ij,ij->i', delta, delta))
+        order = np.argsort(exact, kind='stable')
+        candidates, exact = candidates[order], exact[order]
+        if max_dist is not None:
+            keep = exact < max_dist
+            candidates, exact = candidates[keep], exact[keep]
+        return [
+            EmbeddingDist(e1=query, e2=self.embeddings[i], dist=float(d))
+            for i, d in zip(candidates, exact)
+        ]
+
+
+def k_nearest(
+    content: str,
+    embeddings: Union[EmbeddingIndex, List[Embedding]],
+    k: int,
+    max_dist: Optional[float] = None,
+    exact: bool = False,
+) -> List[EmbeddingDist]:
+    """
+    Get the `k` nearest embeddings to the given `content`. Passing a plain list
+    of embeddings builds a throwaway index with no distance cutoff, so prefer
+    building an `EmbeddingIndex` once and re-using it. The query embedding is
+    looked up in `query_cache` before calling openai. Set `exact` to search an
+    approximate index (see `apis.openai.ivf`) exhaustively.
+    """
+    if not isinstance(embeddings, EmbeddingIndex):
+        embeddings = EmbeddingIndex(embeddings, max_dist=None)
+    with tracing.span('embedding'):
+        content_embedding = query_cache.gen(content)
+    _logger.debug('Query embedding cache stats: %s', logger.Lazy(query_cache.stats))
+    with tracing.span('knn'):
+        nearest = embeddings.query(content_embedding, k=k, max_dist=max_dist, exact=exact)
+    _logger.debug('Found k-nearest distances: %s', logger.Lazy(lambda: [n.dist for n in nearest]))
+    return nearest
+
+
+async def async_k_nearest(
+    content: str,
+    embeddings: Union[EmbeddingIndex, List[Embedding]],
+    k: int,
+    max_dist: Optional[float] = None,
+    exact: bool = False,
+) -> List[EmbeddingDist]:
+    """Like `k_nearest`, but awaits the query embedding instead of blocking on it."""
+    if not isinstance(embeddings, EmbeddingIndex):
+        embeddings = EmbeddingIndex(embeddings, max_dist=None)
+    with tracing.span('embedding'):
+        content_embedding = await query_cache.async_gen(content)
+    _logger.debug('Query embedding cache stats: %s', logger.Lazy(query_cache.stats))
+    with tracing.span('knn'):
+        nearest = embeddings.query(content_embedding, k=k, max_dist=max_dist, exact=exact)
+    _logger.debug('Found k-nearest distances: %s', logger.Lazy(lambda: [n.dist for n in nearest]))
+    return nearest
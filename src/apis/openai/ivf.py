@@ -0,0 +1,222 @@
+"""
+Inverted-file (IVF) approximate nearest-neighbour index over an embedding store, for
+knowledge bases too large to scan on every question. Vectors are clustered offline
+with k-means into `nlist` lists, and a query only scans the `nprobe` lists whose
+centroids are nearest to it. More probes trade speed for recall.
+
+Build it next to the store with:
+
+    python src/build_ann_index.py embeddings.bin [--nlist 512]
+
+`EmbeddingIndex.load` picks up `<store>.ivf` when it exists and still matches the store.
+"""
+
+from __future__ import annotations
+from apis.openai.embeddings import Embedding, EmbeddingDist
+from apis.openai.index import EmbeddingIndex
+from apis.openai import store
+from typing import List, Optional, Sequence
+import hashlib
+import os
+import tempfile
+import time
+import numpy as np
+import settings
+import logger
+
+_logger = logger.get_logger(__name__)
+
+VERSION = 1
+SUFFIX = '.ivf'
+
+
+def ivf_path(store_path: str) -> str:
+    """Where the index of a store lives, next to the file itself if `store_path` is a link (e.g., to a version)."""
+    return os.path.realpath(store_path) + SUFFIX
+
+
+def store_fingerprint(embedding_store: store.EmbeddingStore) -> str:
+    """
+    Cheap hash of a store (its size, content offsets and a sample of its vectors),
+    so an index built for an older version of the store is never used with a newer one.
+    """
+    digest = hashlib.sha256()
+    digest.update(np.asarray(embedding_store.matrix.shape, dtype='<u8').tobytes())
+    digest.update(embedding_store._offsets.tobytes())
+    step = max(1, len(embedding_store) // 256)
+    digest.update(np.ascontiguousarray(embedding_store.matrix[::step]).tobytes())
+    return digest.hexdigest()
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+    """The nearest centroid of every row of `vectors`."""
+    c_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+        # |x|^2 is the same for every centroid, so it doesn't change the argmin
+        assignments[start:start + batch_size] = np.argmin(c_sq_norms[None, :] - 2 * (batch @ centroids.T), axis=1)
+    return assignments
+
+
+def kmeans(
+    matrix: np.ndarray, nlist: int, iterations: int = 10, sample_per_list: int = 64, seed: int = 0
+) -> np.ndarray:
+    """Lloyd's k-means on a random sample of the rows of `matrix`, returning `nlist` float32 centroids."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), nlist * sample_per_list)
+    sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=nlist)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids[filled] = np.add.reduceat(sample[order], starts, axis=0) / counts[filled, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # restart empty lists on random points rather than leave them unreachable
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    Drop-in `EmbeddingIndex` that only scans the `nprobe` nearest lists of an IVF
+    index per query, or every vector if `exact` (i.e., the brute-force search).
+    """
+
+    def __init__(
+        self,
+        embeddings: Sequence[Embedding],
+        matrix: np.ndarray,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_ids: np.ndarray,
+        nprobe: int = settings.KNOWLEDGE_IVF_NPROBE,
+        exact: bool = settings.KNOWLEDGE_EXACT_SEARCH,
+        **kwargs,
+    ):
+        """
+        `list_ids` holds the row of every vector grouped by list, and the `i`th list is
+        `list_ids[list_offsets[i]:list_offsets[i + 1]]`.
+        """
+        super().__init__(embeddings, matrix=matrix, **kwargs)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+        self.exact = exact
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls, embedding_store: store.EmbeddingStore, nlist: Optional[int] = None, iterations: int = 10, seed: int = 0, **kwargs
+    ) -> IVFIndex:
+        """Cluster the vectors of `embedding_store`, by default into about sqrt(count) lists."""
+        matrix = embedding_store.matrix
+        nlist = min(len(matrix), nlist or max(1, int(np.sqrt(len(matrix)))))
+        centroids = kmeans(matrix, nlist, iterations=iterations, seed=seed)
+        assignments = _assign(matrix, centroids)
+        list_ids = np.argsort(assignments, kind='stable').astype(np.int64)
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=nlist)))).astype(np.int64)
+        return cls(embedding_store, matrix, centroids, list_offsets, list_ids, **kwargs)
+
+    def save(self, path: str, fingerprint: str) -> None:
+        """Write the index to `path` (replacing it only once written), tagged with the store's fingerprint."""
+        directory = os.path.dirname(path) or '.'
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.ivf-', delete=False) as file:
+            try:
+                np.savez(
+                    file,
+                    version=np.int64(VERSION),
+                    fingerprint=np.array(fingerprint),
+                    centroids=self.centroids,
+                    list_offsets=self.list_offsets,
+                    list_ids=self.list_ids,
+                )
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException:
+                os.remove(file.name)
+                raise
+        os.chmod(file.name, 0o644)
+        os.replace(file.name, path)
+
+    @classmethod
+    def open(cls, embedding_store: store.EmbeddingStore, path: str, **kwargs) -> IVFIndex:
+        """Load the index at `path` over `embedding_store`, raising `StoreError` if it's missing or stale."""
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != VERSION:
+                    raise store.StoreError(f'Unsupported ivf index version {int(data["version"])} in {path}.')
+                if str(data['fingerprint']) != store_fingerprint(embedding_store):
+                    raise store.StoreError(f'{path} was built for a different version of {embedding_store.path}.')
+                centroids = data['centroids']
+                list_offsets = data['list_offsets']
+                list_ids = data['list_ids']
+        except (OSError, KeyError, ValueError) as e:
+            raise store.StoreError(f'Could not load ivf index {path}: {e}') from e
+        index = cls(embedding_store, embedding_store.matrix, centroids, list_offsets, list_ids, **kwargs)
+        _logger.debug(f'Opened ivf index {path} with {index.nlist} lists, probing {index.nprobe}.')
+        return index
+
+    def query_batch(
+        self, embeddings: Sequence[Embedding], k: int, max_dist: Optional[float] = None, exact: bool = False
+    ) -> List[List[EmbeddingDist]]:
+        if exact or self.exact or self.nprobe >= self.nlist:
+            return super().query_batch(embeddings, k=k, max_dist=max_dist)
+        if not embeddings:
+            return []
+        queries = np.array([e.vector for e in embeddings], dtype=np.float32)
+        max_dist = self.max_dist if max_dist is None else max_dist
+        c_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        probes = np.argpartition(c_sq_norms[None, :] - 2 * (queries @ self.centroids.T), self.nprobe - 1, axis=1)
+        return [
+            self._probe(query, vector, probes[i, :self.nprobe], k, max_dist)
+            for i, (query, vector) in enumerate(zip(embeddings, queries))
+        ]
+
+    def _probe(
+        self, query: Embedding, vector: np.ndarray, lists: np.ndarray, k: int, max_dist: Optional[float]
+    ) -> List[EmbeddingDist]:
+        """Score every vector in the probed `lists` like `EmbeddingIndex.distances`, and keep the top `k`."""
+        candidates = np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists])
+        k = min(k, len(candidates))
+        if k <= 0:
+            return []
+        candidates = np.sort(candidates)  # read the mapped store front to back
+        # |x|^2 - 2 x.q ranks the same as |x - q|^2, since |q|^2 is the same for every candidate
+        scores = self.sq_norms[candidates] - 2 * (self.matrix[candidates] @ vector)
+        if k < len(scores):
+            candidates = candidates[np.argpartition(scores, k - 1)[:k]]
+        # re-score the winners exactly, as `EmbeddingIndex` does
+        delta = self.matrix[candidates] - vector
+        dists = np.sqrt(np.einsum('ij,ij->i', delta, delta))
+        order = np.argsort(dists, kind='stable')
+        candidates, dists = candidates[order], dists[order]
+        if max_dist is not None:
+            keep = dists < max_dist
+            candidates, dists = candidates[keep], dists[keep]
+        return [
+            EmbeddingDist(e1=query, e2=self.embeddings[i], dist=float(d))
+            for i, d in zip(candidates, dists)
+        ]
+
+
+def build(store_path: str, nlist: Optional[int] = None, iterations: int = 10) -> IVFIndex:
+    """Build the ivf index of the store at `store_path` and save it next to the store."""
+    embedding_store = store.EmbeddingStore(store_path)
+    start_time = time.perf_counter()
+    index = IVFIndex.build(embedding_store, nlist=nlist, iterations=iterations)
+    index.save(ivf_path(store_path), store_fingerprint(embedding_store))
+    _logger.info(
+        f'Built ivf index of {len(index)} vectors in {index.nlist} lists '
+        + f'in {time.perf_counter() - start_time:.1f} seconds.'
+    )
+    return index
+
@@ -0,0 +1,173 @@
+"""
+Compact binary format for embedding lists that is opened with mmap instead of parsed.
+
+Layout (little-endian):
+    header    64 bytes: magic, version, dim, count, and the offsets of the three blocks below
+    vectors   `count * dim` float32 values, row by row
+    offsets   `count + 1` uint64 byte offsets into the contents block
+    contents  utf-8 encoded content strings, back to back
+"""
+
+from __future__ import annotations
+from apis.openai.embeddings import Embedding
+from typing import Iterable, Iterator, List, Optional
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+import logger
+
+_logger = logger.get_logger(__name__)
+
+MAGIC = b'SAMBEMB\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQ')
+HEADER_SIZE = 64
+
+
+class StoreError(Exception):
+    """The embedding store file is missing, truncated, or not in the expected format."""
+
+    ...
+
+
+def is_store(path: str) -> bool:
+    """Whether the file at `path` starts with the binary store magic bytes."""
+    try:
+        with open(path, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+class EmbeddingStore:
+    """
+    Read-only, memory-mapped embedding list. Opening a store does no parsing,
+    `matrix` is a view straight onto the mapped vector block, so its pages are
+    shared between every worker process through the page cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            try:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise StoreError(f'Embedding store {path} is empty.') from e
+        if len(self._mmap) < HEADER_SIZE:
+            raise StoreError(f'Embedding store {path} is truncated.')
+        magic, version, dim, count, vectors_at, offsets_at, contents_at = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise StoreError(f'{path} is not an embedding store.')
+        if version != VERSION:
+            raise StoreError(f'Unsupported embedding store version {version} in {path}.')
+        self.dim = dim
+        self.matrix = np.frombuffer(
+            self._mmap, dtype='<f4', count=count * dim, offset=vectors_at
+        ).reshape(count, dim)
+        self._offsets = np.frombuffer(self._mmap, dtype='<u8', count=count + 1, offset=offsets_at)
+        self._contents_at = contents_at
+        _logger.debug(f'Opened embedding store {path} with {count} embeddings of size {dim}.')
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __getitem__(self, i: int) -> Embedding:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Embedding(content=self.content(i), vector=self.matrix[i])
+
+    def __iter__(self) -> Iterator[Embedding]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def content(self, i: int) -> str:
+        """Decode the content string of the `i`th embedding."""
+        start = self._contents_at + int(self._offsets[i])
+        end = self._contents_at + int(self._offsets[i + 1])
+        return self._mmap[start:end].decode('utf-8')
+
+    def contents(self) -> List[str]:
+        return [self.content(i) for i in range(len(self))]
+
+
+class EmbeddingStoreWriter:
+    """
+    Stream embeddings into a new store file one at a time, so large lists never
+    have to fit in memory. The file only replaces `path` once `close()` succeeds.
+    """
+
+    def __init__(self, path: str, dim: Optional[int] = None):
+        self.path = path
+        self.dim = dim
+        self.count = 0
+        directory = os.path.dirname(path) or '.'
+        self._vectors = tempfile.NamedTemporaryFile(dir=directory, prefix='.emb-', delete=False)
+        self._contents = tempfile.TemporaryFile(dir=directory)
+        self._offsets = [0]
+        self._vectors.write(b'\x00' * HEADER_SIZE)  # patched on close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, embedding: Embedding) -> None:
+        vector = np.asarray(embedding.vector, dtype='<f4')
+        if self.dim is None:
+            self.dim = len(vector)
+        if vector.shape != (self.dim,):
+            raise StoreError(f'Expected a vector of size {self.dim}, got {vector.shape}.')
+        self._vectors.write(vector.tobytes())
+        self._contents.write(embedding.content.encode('utf-8'))
+        self._offsets.append(self._contents.tell())
+        self.count += 1
+
+    def write_all(self, embeddings: Iterable[Embedding]) -> None:
+        for embedding in embeddings:
+            self.write(embedding)
+
+    def close(self) -> None:
+        try:
+            file = self._vectors
+            offsets_at = file.tell()
+            file.write(np.asarray(self._offsets, dtype='<u8').tobytes())
+            contents_at = file.tell()
+            self._contents.seek(0)
+            shutil.copyfileobj(self._contents, file)
+            file.seek(0)
+            file.write(HEADER.pack(
+                MAGIC, VERSION, self.dim or 0, self.count, HEADER_SIZE, offsets_at, contents_at
+            ))
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            self._contents.close()
+            os.chmod(file.name, 0o644)  # temp files are private by default
+            os.replace(file.name, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        """Throw away the partially written store."""
+        self._vectors.close()
+        self._contents.close()
+        if os.path.exists(self._vectors.name):
+            os.remove(self._vectors.name)
+
+
+def save(embeddings: Iterable[Embedding], path: str) -> int:
+    """Write `embeddings` to a new store at `path`, returning how many were written."""
+    with EmbeddingStoreWriter(path) as writer:
+        writer.write_all(embeddings)
+    return writer.count
@@ -1,22 +1,24 @@
 import flask
 import settings
+import models
 from models import Message, DisplayPills, Messages, BadId, NotFound, SystemMessage
 from apis import openai as openai
 import bleach
-import time
 from flask_wtf.csrf import CSRFProtect
 import asyncio
+import event_loop
+import fragments
+import streaming
+import sweep_messages
+import tracing
 import logger
 import flask_limiter as fl
-import warnings
-
-# Suppress the specific UserWarning from flask_limiter
-warnings.filterwarnings(
-    "ignore",
-    message="Using the in-memory storage for tracking rate limits as no storage was explicitly specified. This is not recommended for production use.*",
-    category=UserWarning,
-    module='flask_limiter.extension'
-)
+import ratelimit_storage  # registers the sqlite:// rate limit storage
+import json
+import contextlib
+import dataclasses
+import hmac
+import weakref
 
 """
 TODO LIST:
@@ -56,6 +58,7 @@ app.secret_key = settings.FLASK_SECRET_KEY
 csrf = CSRFProtect(app)
 app.config["SESSION_COOKIE_SAMESITE"] = "Strict"
 app.config["SESSION_COOKIE_SECURE"] = True
+app.config["RATELIMIT_ENABLED"] = settings.RATELIMIT_ENABLED
 
 
 # create ratelimiter
@@ -63,106 +66,249 @@ limiter = fl.Limiter(
     fl.util.get_remote_address,
     app=app,
     default_limits=["360 per day"],
+    storage_uri=settings.RATELIMIT_STORAGE_URI,
 )
 
+# rendered html of finished messages, shared by the home page and stream renders
+fragment_cache = fragments.FragmentCache(max_bytes=settings.FRAGMENT_CACHE_BYTES)
 
-def messages_gen_to_event_stream(messages_gen):
-    """Convert a `Messages` generator to a server-side-event stream."""
-
-    def html_gen():
-        for messages in messages_gen:
-            yield flask.render_template("messages.html", messages=messages.to_display())
-
-    def sse_gen():
-        for html_data in html_gen():
-            # Remove newlines and carriage returns that interfere with streaming
-            formatted_html = html_data.replace("\n", " ").replace("\r", " ")
-            yield f"data: {formatted_html}\n\n"
-        yield "data: STOP\n\n"  # Signal end of stream
-
-    response = flask.Response(
-        flask.stream_with_context(sse_gen()),
-        mimetype="text/event-stream",
-        content_type="text/event-stream",
-    )
-    response.headers['X-Accel-Buffering'] = 'no'  # Disable buffering in some servers
+# sweep idle conversations in the background, skipping the ones this worker has cached
+sweeper = sweep_messages.Sweeper(Messages.backend, is_live=Messages.cache.__contains__)
+
+
+@app.before_request
+def start_sweeper():
+    sweeper.start()  # started by the first request, so forked workers each get their own thread
+
+
+@app.before_request
+def start_trace():
+    flask.g.trace = tracing.start()
+
+
+@app.after_request
+def add_server_timing(response):
+    # an event stream's headers go out before it starts, its later spans are in the done event
+    if trace := flask.g.get("trace"):
+        response.headers["Server-Timing"] = trace.server_timing()
     return response
 
 
-def string_gen_to_messages_gen(
-    string_gen, messages, user_content, system_message_content
+class MessagesEventEncoder:
+    """
+    Encodes successive states of one `Messages` object as server-side-events that only
+    carry what changed since the previous state:
+
+        render        the whole conversation as html, sent first (and again on reconnect)
+        append        text to add to the end of the last message
+        replace-last  new content for the last message, e.g. for the ellipsis animation
+        done          end of stream
+
+    Every event has an id, so a reconnecting `EventSource` tells us it has seen the
+    stream before (see `submit_messages_gen`).
+    """
+
+    def __init__(self, trace=None):
+        self.event_id = 0
+        self.message_count = None
+        self.last_content = None
+        self.bytes = 0
+        self.trace = trace
+
+    def event(self, name, data):
+        self.event_id += 1
+        event = f"id: {self.event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+        self.bytes += len(event)
+        return event
+
+    def encode(self, messages):
+        """The event taking the client from the previous state to `messages`, or None if nothing changed."""
+        display = messages.to_display()
+        last_content = display[-1].content if display else ""
+        try:
+            if len(display) != self.message_count:
+                html = fragment_cache.render(display, live=True)
+                return self.event("render", {"html": html, "last": last_content})
+            if last_content == self.last_content:
+                return None
+            if last_content.startswith(self.last_content):
+                return self.event("append", {"text": last_content[len(self.last_content):]})
+            return self.event("replace-last", {"text": last_content})
+        finally:
+            self.message_count = len(display)
+            self.last_content = last_content
+
+    def done(self):
+        if self.trace:
+            self.trace.finish()
+        event = self.event("done", {"timings": self.trace.timings()} if self.trace else {})
+        streaming.stream_stats.add(responses=1, frames=self.event_id, bytes=self.bytes)
+        _logger.debug(f"Sent {self.event_id} frames ({self.bytes} bytes) for this response.")
+        return event
+
+
+ASGI_ENVIRON_KEY = "sambot.asgi"  # set on requests served by asgi.py
+
+
+class EventStreamResponse(flask.Response):
+    """
+    Server-side-event response that keeps hold of the async `Messages` generator behind
+    it. Under WSGI the body drives the generator on the worker's shared event loop,
+    while the ASGI entry point (asgi.py) iterates `messages_gen` natively instead.
+    """
+
+    def __init__(self, messages_gen):
+        self.messages_gen = messages_gen
+        self.trace = flask.g.get("trace")
+
+        def sse_gen():
+            encoder = MessagesEventEncoder(self.trace)
+            for messages in event_loop.iterate(messages_gen):
+                if event := encoder.encode(messages):
+                    yield event
+            yield encoder.done()
+
+        # asgi.py streams `messages_gen` itself, so don't tie a WSGI body to the request context
+        is_asgi = flask.request.environ.get(ASGI_ENVIRON_KEY, False)
+        super().__init__(
+            [] if is_asgi else flask.stream_with_context(sse_gen()),
+            mimetype="text/event-stream",
+            content_type="text/event-stream",
+        )
+        self.headers['X-Accel-Buffering'] = 'no'  # Disable buffering in some servers
+
+
+def messages_gen_to_event_stream(messages_gen):
+    """Convert an async `Messages` generator to a server-side-event stream."""
+    return EventStreamResponse(messages_gen)
+
+
+# the submit being answered for each conversation in this worker, see `string_gen_to_messages_gen`
+_conversation_locks = weakref.WeakValueDictionary()
+
+
+def conversation_lock(id):
+    """The lock of a conversation, only ever used on the worker's one event loop."""
+    lock = _conversation_locks.get(id)
+    if lock is None:
+        lock = _conversation_locks[id] = asyncio.Lock()
+    return lock
+
+
+async def string_gen_to_messages_gen(
+    string_gen, messages, user_content, system_message_content, trace=None
 ):
     """
-    Convert a string generator into a `Messages` generator using the given `Messages` object.
+    Convert an async string generator into an async `Messages` generator using the given `Messages` object.
     NOTE: side-effects include mutating the `Messages` object, saving the `Messages` object, and
           computing the system message.
     NOTE: This method is not a 1:1 conversion between a string generator and a messages generator.
           The system message can take significant time to compute, so an ellipsis animation is streamed
           back to the client while this occurrs.
+    NOTE: Submits to one conversation are answered one at a time (in this worker), a second one waits
+          for the first to be saved, so neither sends gpt the other's half-finished turn or loses it.
     """
+    lock = conversation_lock(messages.id)
+    waited = lock.locked()
+    async with lock:
+        if waited and not Messages.cache.enabled:
+            # this copy was loaded before the other submit saved its turn (a cached one is shared)
+            await asyncio.to_thread(messages.reload)
+        answer = _answer_messages_gen(string_gen, messages, user_content, system_message_content, trace)
+        async with contextlib.aclosing(answer):
+            async for state in answer:
+                yield state
+
+
+async def _answer_messages_gen(string_gen, messages, user_content, system_message_content, trace):
+    """The body of `string_gen_to_messages_gen`, with the conversation to itself."""
 
     # Append user content to messages and add empty assistant message
     messages.append(Message(role="user", content=user_content))
     messages.append(Message(role="assistant", content=""))
+    reply = len(messages) - 1
 
-    # Generate system message and stream ellipsis
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    generate_system_message_task = loop.create_task(system_message_content.generate())
-
-    while not generate_system_message_task.done():
-        old_msg = messages[len(messages) - 1]
-        new_msg = Message(role="assistant", content=old_msg.content + ".")
-        if new_msg.content == "....":
-            new_msg.content = ""
-        messages[len(messages) - 1] = new_msg
-        yield messages
-        loop.run_until_complete(asyncio.sleep(0.5))
+    # Generate system message concurrently and stream ellipsis
+    system_message = system_message_content
+    generate_system_message_task = asyncio.ensure_future(system_message_content.generate())
+    try:
+        while not generate_system_message_task.done():
+            old_msg = messages[reply]
+            new_msg = Message(role="assistant", content=old_msg.content + ".")
+            if new_msg.content == "....":
+                new_msg.content = ""
+            messages[reply] = new_msg
+            yield messages
+            # wakes as soon as the system message is ready, not on the next animation tick
+            await asyncio.wait([generate_system_message_task], timeout=0.5)
+    finally:
+        # e.g., the client disconnected mid-animation, so don't finish the work for nobody
+        generate_system_message_task.cancel()
 
     try:
-        system_message_content = loop.run_until_complete(generate_system_message_task)
+        system_message_content = generate_system_message_task.result()
     except openai.APIConnectionError:
         # set fake system message and notify the user
         # NOTE: This is kind of a hack because technically this call could succeed but
         #       the next call to openai could fail to connect and this message wouldn't show up...
         string_gen = connection_error_string_gen
         system_message_content = SystemMessage(messages, user_content, dummy=True)
+    else:
+        if system_message.cached:
+            # a close enough question was answered before, replay that answer (see answer_cache.py)
+            string_gen = cached_string_gen(system_message.cached.answer)
 
     # set system message
     messages[0] = Message(role="system", content=system_message_content)
 
     # Clean assistant message of any leftover '.'s
-    messages[len(messages) - 1] = Message(role="assistant", content="")
+    messages[reply] = Message(role="assistant", content="")
 
     # Transform generated strings into messages
-    for token in string_gen(messages):
-        old_msg = messages[len(messages) - 1]
+    first = True
+    async for token in string_gen(messages):
+        if first:
+            first = False
+            tracing.mark("first_token", trace)
+        old_msg = messages[reply]
         new_msg = Message(role="assistant", content=old_msg.content + token)
-        messages[len(messages) - 1] = new_msg
+        messages[reply] = new_msg
         yield messages
-    messages.save()
+    tracing.mark("last_token", trace)
+    if string_gen is not connection_error_string_gen:
+        system_message.remember(system_message_content, messages[reply].content)
+    with tracing.span("save", trace):
+        await asyncio.to_thread(messages.save)
 
 
-def dummy_string_gen(messages):
+async def dummy_string_gen(messages):
     """Generate dummy string tokens for debugging purposes."""
     debug_message = "Hello world! This is a dummy chat gpt response for sambot :)"
     for token in debug_message.split(" "):
         yield token + " "
-        time.sleep(0.1)
+        await asyncio.sleep(0.1)
 
 
-def openai_string_gen(messages):
+async def openai_string_gen(messages):
     """Generate string tokens using openai's completions endpoint."""
-    for token in openai.get_completion(
+    async for token in openai.async_stream_completion(
         messages=messages.to_gpt(),
         model="gpt-4o",
-        stream=True,
         temperature=0.15,
     ):
         yield token
 
 
-def connection_error_string_gen(message):
+def cached_string_gen(answer):
+    """A string generator function that streams back a cached answer in one go."""
+
+    async def string_gen(messages):
+        yield answer
+
+    return string_gen
+
+
+async def connection_error_string_gen(message):
     """Generate string tokens for when a connection error occurrs."""
     connection_error_message = (
         "Whoops! It looks like there's been an error connecting to "
@@ -173,40 +319,106 @@ def connection_error_string_gen(message):
     connection_error_message += "or test your internet connection and try again!"
     for token in connection_error_message.split(" "):
         yield token + " "
-        time.sleep(0.1)
+        await asyncio.sleep(0.1)
 
 
-def ratelimit_string_gen(message):
+async def ratelimit_string_gen(message):
     """Generate string tokens for when the client gets ratelimited on the submit endpoint."""
     ratelimit_error_message = (
         "Woah there! You've hit the limit for submissions. Please try again in a bit."
     )
     for token in ratelimit_error_message.split(" "):
         yield token + " "
-        time.sleep(0.1)
+        await asyncio.sleep(0.1)
+
+
+def submit_messages_gen():
+    """
+    Validate the current `/submit` request and return the async `Messages` generator
+    that answers it. Shared by the WSGI view and the ASGI entry point in asgi.py.
+    """
+
+    # Get user submission (or raise)
+    user_content = flask.request.args.get("user_content", None)
+    user_content = bleach.clean(user_content, strip=True)
+    if not user_content:
+        flask.abort(400)
+
+    # Get messages from flask session (or start the conversation, see `home`)
+    trace = flask.g.get("trace")
+    try:
+        messages_id = flask.session.get(settings.SESSION_MESSAGES_KEY, None)
+        with tracing.span("session", trace):
+            messages = Messages.load_from_id(messages_id)
+    except BadId:
+        messages = Messages.create(
+            system=""
+        )  #  System message gets populated by SystemMessage object later
+        flask.session[settings.SESSION_MESSAGES_KEY] = str(messages.id)
+
+    if flask.request.headers.get("Last-Event-ID"):
+        # the browser reconnected to a stream it already started, don't submit the question twice
+        return replay_messages_gen(messages)
+
+    system_message = SystemMessage(messages, user_content, trace=trace)
+    string_gen = dummy_string_gen if settings.USE_DUMMY_OPENAI_RESPONSE else openai_string_gen
+    return string_gen_to_messages_gen(
+        string_gen=streaming.coalesced(string_gen),
+        messages=messages,
+        user_content=user_content,
+        system_message_content=system_message,
+        trace=trace,
+    )
+
+
+async def replay_messages_gen(messages):
+    """A `Messages` generator that only yields the conversation as it stands."""
+    yield messages
+
+
+def ratelimited_messages_gen():
+    """The async `Messages` generator answering a `/submit` request that hit the rate limit."""
+    user_content = flask.request.args.get("user_content", None)
+
+    # Get messages from flask session (or start the conversation, e.g. when the very first submit is limited)
+    try:
+        messages_id = flask.session.get(settings.SESSION_MESSAGES_KEY, None)
+        messages = Messages.load_from_id(messages_id)
+    except BadId:
+        messages = Messages.new(system="")  # stored by the first save, see `MessagesBackend.save`
+        flask.session[settings.SESSION_MESSAGES_KEY] = str(messages.id)
+
+    # stream back ratelimit message on submit
+    system_message = SystemMessage(messages, user_content, dummy=True)
+    return string_gen_to_messages_gen(
+        string_gen=ratelimit_string_gen,
+        messages=messages,
+        user_content=user_content,
+        system_message_content=system_message,
+    )
 
 
 @app.route("/")
 def home():
 
-    # Get current messages from session (or create a new one)
+    # Get current messages from session (or an empty one, only stored on the first `/submit`
+    # so crawlers and bounces don't leave conversations behind)
     try:
         id = flask.session.get(settings.SESSION_MESSAGES_KEY, None)
         messages = Messages.load_from_id(id)
     except BadId:
-        messages = Messages.create(
-            system=""
-        )  #  System message gets populated by SystemMessage object later
-    flask.session[settings.SESSION_MESSAGES_KEY] = str(messages.id)
+        messages = Messages.new(system="")
 
     # Generate suggestion pills
     pills = DisplayPills(messages)
     pills.generate()
 
     # Render homepage
+    display = messages.to_display()
     return flask.render_template(
         template_name_or_list="home.html",
-        messages=messages.to_display(),
+        messages=display,
+        messages_html=fragment_cache.render(display),
         pills=pills,
     )
 
@@ -214,31 +426,30 @@ def home():
 @app.route("/submit")
 @limiter.limit("15 per minute")
 def submit():
+    # Stream back data to the client
+    return messages_gen_to_event_stream(submit_messages_gen())
 
-    # Get user submission (or raise)
-    user_content = flask.request.args.get("user_content", None)
-    user_content = bleach.clean(user_content, strip=True)
-    if not user_content:
-        flask.abort(400)
 
-    # Get messages from flask session (or raise)
-    try:
-        messages_id = flask.session.get(settings.SESSION_MESSAGES_KEY, None)
-        messages = Messages.load_from_id(messages_id)
-    except BadId:
+@app.route("/metrics")
+@limiter.limit("10 per minute")  # a scrape every 15 seconds, with room for retries
+def metrics():
+    """
+    Stage timings and counters for this worker process, in the Prometheus text format.
+    Only served with `Authorization: Bearer <settings.METRICS_TOKEN>`, and not at all without a token.
+    """
+    if not settings.METRICS_TOKEN:
         flask.abort(404)
-
-    # Stream back data to the client
-    system_message = SystemMessage(messages, user_content)
-    string_gen = dummy_string_gen if settings.USE_DUMMY_OPENAI_RESPONSE else openai_string_gen
-    return messages_gen_to_event_stream(
-        string_gen_to_messages_gen(
-            string_gen=string_gen,
-            messages=messages,
-            user_content=user_content,
-            system_message_content=system_message,
-        ),
-    )
+    if not hmac.compare_digest(flask.request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"):
+        flask.abort(401)
+    body = tracing.prometheus({
+        "sambot_stream": dataclasses.asdict(streaming.stream_stats),
+        "sambot_speculation": dataclasses.asdict(models.speculation_stats),
+        "sambot_messages_cache": dataclasses.asdict(Messages.cache.stats),
+        "sambot_query_cache": openai.query_cache.stats(),
+        "sambot_fragment_cache": dataclasses.asdict(fragment_cache.stats),
+        "sambot_answer_cache": dataclasses.asdict(SystemMessage.answers.stats),
+    })
+    return flask.Response(body, mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/resume")
@@ -250,25 +461,7 @@ def resume():
 @app.errorhandler(fl.RateLimitExceeded)
 def handle_rate_limit_exceeded(e):
     if flask.request.endpoint == "submit":
-        user_content = flask.request.args.get("user_content", None)
-
-        # Get messages from flask session (or raise)
-        try:
-            messages_id = flask.session.get(settings.SESSION_MESSAGES_KEY, None)
-            messages = Messages.load_from_id(messages_id)
-        except BadId:
-            flask.abort(404)
-
-        # stream back ratelimit message on submit
-        system_message = SystemMessage(messages, user_content, dummy=True)
-        return messages_gen_to_event_stream(
-            string_gen_to_messages_gen(
-                string_gen=ratelimit_string_gen,
-                messages=messages,
-                user_content=user_content,
-                system_message_content=system_message,
-            ),
-        )
+        return messages_gen_to_event_stream(ratelimited_messages_gen())
 
     # all other endpoints return 429 TOO_MANY_REQUESTS
     flask.abort(429)
@@ -0,0 +1,148 @@
+"""
+ASGI entry point, for serving many concurrent `/submit` streams from one process:
+
+    uvicorn --app-dir src asgi:application --workers 2
+
+`/submit` is dispatched through the same Flask app (so CSRF, sessions, rate limits and
+error handlers behave exactly as under WSGI) on a thread, but its event stream is then
+driven as a coroutine on the server's event loop, so an open stream doesn't pin a worker
+thread.
+Every other route is handed to the WSGI app on a thread pool.
+"""
+
+import asyncio
+import io
+import sys
+from asgiref.wsgi import WsgiToAsgi
+import app as flask_app_module
+import logger
+from apis.openai import aio
+
+_logger = logger.get_logger(__name__)
+
+flask_app = flask_app_module.app
+wsgi_application = WsgiToAsgi(flask_app)
+STREAMING_PATHS = {"/submit"}
+
+
+def build_environ(scope):
+    """A WSGI environ for an ASGI http scope that has no request body."""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("127.0.0.1", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(b""),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        flask_app_module.ASGI_ENVIRON_KEY: True,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def start_response(send, response):
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [
+            (name.lower().encode("latin1"), value.encode("latin1"))
+            for name, value in response.headers.items()
+        ],
+    })
+
+
+async def stream_events(send, messages_gen, trace=None):
+    """Send a server-side-event for each change to the `Messages` yielded, then the done event."""
+    encoder = flask_app_module.MessagesEventEncoder(trace)
+    try:
+        async for messages in messages_gen:
+            if event := encoder.encode(messages):
+                await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+        done_event = encoder.done().encode("utf-8")
+        await send({"type": "http.response.body", "body": done_event, "more_body": False})
+    finally:
+        await messages_gen.aclose()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def dispatch_request():
+    """Run the Flask request pipeline in the pushed request context."""
+    try:
+        return flask_app.full_dispatch_request()
+    except Exception as e:
+        return flask_app.handle_exception(e)  # logs it and renders a 500, as under WSGI
+
+
+async def streaming_application(scope, receive, send):
+    """Run the Flask request pipeline for `scope` in a thread, then stream any event stream natively."""
+    ctx = flask_app.request_context(build_environ(scope))
+    ctx.push()  # contexts are context-variables, so this task keeps it until popped below
+    try:
+        # to_thread runs it in a copy of this task's context variables, request context included,
+        # so session loading, csrf, rate limit storage and the view never block the loop
+        response = await asyncio.to_thread(dispatch_request)
+        await start_response(send, response)
+        if not isinstance(response, flask_app_module.EventStreamResponse):
+            for chunk in response.iter_encoded():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            response.close()
+            return
+
+        stream = asyncio.ensure_future(stream_events(send, response.messages_gen, response.trace))
+        disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await asyncio.wait([stream, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (stream, disconnect):
+                task.cancel()
+            await asyncio.gather(stream, disconnect, return_exceptions=True)
+        if stream.done() and not stream.cancelled() and stream.exception():
+            raise stream.exception()
+    finally:
+        ctx.pop()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _logger.info("Starting ASGI server..")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(flask_app_module.Messages.cache.flush_all)
+            await aio.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] in STREAMING_PATHS:
+        await streaming_application(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
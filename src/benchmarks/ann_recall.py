@@ -0,0 +1,101 @@
+"""
+Recall@k and query time of the ivf index (see apis/openai/ivf.py) against exact search,
+on synthetic clustered embeddings (see `Corpus`) written to a temporary binary store:
+
+    PYTHONPATH=src python -m benchmarks.ann_recall [--sizes 10000 100000] [--dim 1536]
+
+Every query is also answered exactly, and recall@k is the share of the exact k nearest
+that the ivf index found, for each number of probed lists.
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+import numpy as np
+from apis.openai import Embedding, EmbeddingStore, IVFIndex
+from apis.openai import store
+
+
+class Corpus:
+    """
+    Unit vectors clustered around topics in a low dimensional space and projected up to
+    `dim`, since real embeddings of chunks on a few subjects are far from spread evenly.
+    """
+
+    def __init__(self, rng, topics, dim, latent_dim=64, spread=1.5, noise=0.05):
+        self.rng = rng
+        self.centers = rng.standard_normal((topics, latent_dim)).astype(np.float32)
+        self.projection = rng.standard_normal((latent_dim, dim)).astype(np.float32) / np.sqrt(latent_dim)
+        self.spread = spread
+        self.noise = noise
+
+    def sample(self, count):
+        centers = self.centers[self.rng.integers(len(self.centers), size=count)]
+        latent = centers + self.spread * self.rng.standard_normal(centers.shape).astype(np.float32)
+        vectors = latent @ self.projection
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors += self.noise * self.rng.standard_normal(vectors.shape).astype(np.float32) / np.sqrt(vectors.shape[1])
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def write_store(path, corpus, size, batch_size=10000):
+    with store.EmbeddingStoreWriter(path) as writer:
+        for start in range(0, size, batch_size):
+            for i, vector in enumerate(corpus.sample(min(batch_size, size - start))):
+                writer.write(Embedding(content=f"chunk {start + i}", vector=vector))
+
+
+def per_query_ms(index, queries, k, exact=False):
+    timings = []
+    for query in queries:
+        start_time = time.perf_counter()
+        index.query(query, k=k, max_dist=None, exact=exact)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(timings)
+
+
+def run(sizes, dim, topics, queries, ks, nprobes, seed):
+    rng = np.random.default_rng(seed)
+    directory = tempfile.mkdtemp()
+    for size in sizes:
+        corpus = Corpus(rng, topics=topics, dim=dim)
+        path = f"{directory}/embeddings-{size}.bin"
+        write_store(path, corpus, size)
+        embedding_store = EmbeddingStore(path)
+
+        start_time = time.perf_counter()
+        index = IVFIndex.build(embedding_store, max_dist=None)
+        print(f"\n{size} vectors of size {dim}: built {index.nlist} lists in {time.perf_counter() - start_time:.1f}s")
+
+        query_embeddings = [Embedding(f"query {i}", v) for i, v in enumerate(corpus.sample(queries))]
+        exact_ms = per_query_ms(index, query_embeddings, max(ks), exact=True)
+        print(f"  exact            {exact_ms:8.2f}ms per query")
+        truth = {
+            k: [{d.e2.content for d in nearest} for nearest in index.query_batch(query_embeddings, k=k, exact=True)]
+            for k in ks
+        }
+        for nprobe in nprobes:
+            if nprobe > index.nlist:
+                continue
+            index.nprobe = nprobe
+            recalls = []
+            for k in ks:
+                found = index.query_batch(query_embeddings, k=k)
+                hits = sum(len(t & {d.e2.content for d in f}) for t, f in zip(truth[k], found))
+                recalls.append(f"recall@{k}={hits / (k * len(query_embeddings)):.3f}")
+            ms = per_query_ms(index, query_embeddings, max(ks))
+            print(f"  nprobe={nprobe:<4}      {ms:8.2f}ms per query ({exact_ms / ms:5.1f}x)  " + "  ".join(recalls))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=200, help="clusters in the synthetic corpus")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, nargs="+", default=[10, 20])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.sizes, args.dim, args.topics, args.queries, args.k, args.nprobe, args.seed)
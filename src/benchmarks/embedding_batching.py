@@ -0,0 +1,49 @@
+"""
+Offline benchmark of `Embedding.gen_list` batching against the fake embeddings client:
+
+    PYTHONPATH=src python -m benchmarks.embedding_batching --inputs 2000 --latency 0.25
+"""
+
+import argparse
+import time
+from apis.openai import Embedding
+from apis.openai.fake import FakeClient
+
+CONFIGS = [
+    # (batch_size, concurrency)
+    (1, 1),  # the old one-request-per-string behaviour
+    (16, 1),
+    (64, 1),
+    (64, 4),
+    (128, 8),
+]
+
+
+def run(inputs: int, latency: float, failure_rate: float):
+    content_list = [f'benchmark knowledge line number {i}' for i in range(inputs)]
+    for batch_size, concurrency in CONFIGS:
+        fake_client = FakeClient(latency=latency, failure_rate=failure_rate)
+        start_time = time.perf_counter()
+        embeddings = Embedding.gen_list(
+            content_list,
+            batch_size=batch_size,
+            concurrency=concurrency,
+            embeddings_client=fake_client,
+        )
+        elapsed = time.perf_counter() - start_time
+        assert [e.content for e in embeddings] == content_list
+        print(
+            f'batch_size={batch_size:<4} concurrency={concurrency:<2} '
+            f'requests={fake_client.embeddings.requests:<5} '
+            f'max_in_flight={fake_client.embeddings.max_in_flight:<2} '
+            f'elapsed={elapsed:7.2f}s throughput={inputs / elapsed:9.1f} embeddings/s'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inputs', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake request')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='chance a fake request fails')
+    args = parser.parse_args()
+    run(args.inputs, args.latency, args.failure_rate)
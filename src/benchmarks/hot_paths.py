@@ -0,0 +1,245 @@
+"""
+Offline micro-benchmarks of the code every request runs, with the embeddings client
+stubbed by `apis.openai.fake` so nothing touches the network:
+
+    PYTHONPATH=src python -m benchmarks.hot_paths [--quick] [--output results.json]
+
+Results are printed and saved as json (by default under data/benchmarks/), with the
+git commit and library versions, so runs can be compared over time with `--compare`.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import numpy as np
+import settings
+import storage
+from apis.openai import Embedding, EmbeddingDist, EmbeddingIndex, EmbeddingCache
+from apis.openai import embeddings as embeddings_module
+from apis.openai import index as index_module
+from apis.openai.fake import FakeClient, fake_vector
+from models import DisplayPills, Message, Messages
+import app
+
+DIM = 1536
+
+
+def measure(fn, min_time=0.5, min_runs=5, max_runs=10000, reset=None):
+    """
+    Call `fn` until `min_time` has passed (within the run limits), returning timings in
+    microseconds. `reset` is called untimed after every run.
+    """
+    timings = []
+    deadline = time.perf_counter() + min_time
+    while len(timings) < min_runs or (time.perf_counter() < deadline and len(timings) < max_runs):
+        start_time = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start_time) * 1e6)
+        if reset:
+            reset()
+    timings.sort()
+    return {
+        "runs": len(timings),
+        "mean_us": statistics.fmean(timings),
+        "p50_us": timings[len(timings) // 2],
+        "p95_us": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        "min_us": timings[0],
+    }
+
+
+def conversation(turns):
+    messages = Messages.new("You are Sam." * 50)
+    for i in range(turns):
+        messages.append(Message(role="user", content=f"What about question number {i}?"))
+        messages.append(Message(role="assistant", content=f"Here is a fairly ordinary answer to question {i}. " * 8))
+    return messages
+
+
+def bench_k_nearest(sizes, min_time):
+    results = {}
+    query = "Where did you go to school?"
+    for size in sizes:
+        corpus = [Embedding(content=f"knowledge {i}", vector=fake_vector(f"knowledge {i}", DIM)) for i in range(size)]
+        index = EmbeddingIndex(corpus, max_dist=None)
+        # cold misses every cache tier and calls the (stubbed) embeddings client, warm hits memory
+        index_module.query_cache.clear()
+        results[f"k_nearest/cold/{size}"] = measure(
+            lambda: index_module.k_nearest(query, index, k=20), min_time, reset=index_module.query_cache.clear
+        )
+        results[f"k_nearest/warm/{size}"] = measure(lambda: index_module.k_nearest(query, index, k=20), min_time)
+        results[f"k_nearest/list/{size}"] = measure(lambda: index_module.k_nearest(query, corpus, k=20), min_time)
+    e1, e2 = Embedding("a", fake_vector("a", DIM)), Embedding("b", fake_vector("b", DIM))
+    results["EmbeddingDist.get"] = measure(lambda: EmbeddingDist.get(e1, e2), min_time)
+    return results
+
+
+def bench_load_list(min_time):
+    results = {}
+    for path in ("embeddings.json", settings.EMBEDDINGS_FILE):
+        if os.path.exists(f"{settings.LOCAL_RESOURCE_DIR}/{path}"):
+            results[f"Embedding.load_list/{path}"] = measure(lambda: Embedding.load_list(path), min_time, max_runs=50)
+    return results
+
+
+def bench_messages(lengths, directory, min_time):
+    results = {}
+    cache_size = Messages.cache.max_entries
+    Messages.cache.max_entries = 0  # measure the backends, not the write-behind cache
+    try:
+        for name, backend in (
+            ("json", storage.JsonMessagesBackend(f"{directory}/messages")),
+            ("sqlite", storage.SqliteMessagesBackend(f"{directory}/messages.sqlite3")),
+        ):
+            Messages.backend = backend
+            for turns in lengths:
+                messages = conversation(turns)
+                backend.create(messages.id, messages._rows(), messages._meta())
+                messages._saved = messages._rows()
+                results[f"Messages.load_from_id/{name}/{turns}"] = measure(
+                    lambda: Messages.load_from_id(messages.id), min_time
+                )
+                # what `/pills` does
+                results[f"Messages.load_from_id+DisplayPills.generate/{name}/{turns}"] = measure(
+                    lambda: DisplayPills(Messages.load_from_id(messages.id)).generate(), min_time
+                )
+
+                def save_turn():
+                    messages.append(Message(role="user", content="And another thing?"))
+                    messages.append(Message(role="assistant", content="Sure."))
+                    messages.save()
+
+                def remove_turn():
+                    del messages[-2:]  # keep the length steady
+                    messages.save()
+
+                results[f"Messages.save/{name}/{turns}"] = measure(
+                    save_turn, min_time, max_runs=2000, reset=remove_turn
+                )
+    finally:
+        Messages.cache.max_entries = cache_size
+        Messages.backend = storage.get_backend()
+    return results
+
+
+def bench_pills(lengths, min_time):
+    results = {}
+    for turns in lengths:
+        messages = conversation(turns)
+
+        def generate():
+            DisplayPills(messages).generate()
+
+        results[f"DisplayPills.generate/{turns}"] = measure(generate, min_time)
+    return results
+
+
+def bench_render(lengths, min_time):
+    """Render a conversation's html as the home page does, with no fragments cached and with all of them cached."""
+    results = {}
+    for turns in lengths:
+        display = conversation(turns).to_display()
+        with app.app.test_request_context("/"):
+            results[f"render/cold/{turns}"] = measure(
+                lambda: app.fragment_cache.render(display), min_time, max_runs=500, reset=app.fragment_cache.clear
+            )
+            results[f"render/warm/{turns}"] = measure(lambda: app.fragment_cache.render(display), min_time)
+    return results
+
+
+def bench_event_stream(lengths, min_time, tokens=200):
+    """Render a whole `/submit` stream (through the fragment cache and the sse encoder) for a conversation length."""
+    results = {}
+    for turns in lengths:
+        messages = conversation(turns)
+
+        async def messages_gen():
+            messages.append(Message(role="assistant", content=""))
+            for i in range(tokens):
+                messages[-1] = Message(role="assistant", content=messages[-1].content + f"token{i} ")
+                yield messages
+            messages.pop()
+
+        def stream():
+            with app.app.test_request_context("/submit"):
+                response = app.messages_gen_to_event_stream(messages_gen())
+                for _ in response.response:
+                    pass
+                response.close()
+
+        results[f"event_stream/{turns}"] = measure(stream, min_time, max_runs=200)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)["results"]
+    for name, result in results.items():
+        if name in baseline:
+            change = result["p50_us"] / baseline[name]["p50_us"] - 1
+            print(f"{name:<45} {baseline[name]['p50_us']:12.1f}us -> {result['p50_us']:12.1f}us {change:+8.1%}")
+
+
+def run(quick, output, baseline):
+    min_time = 0.1 if quick else 0.5
+    sizes = [100, 1000] if quick else [100, 1000, 10000]
+    lengths = [1, 10, 100] if quick else [1, 10, 100, 500]
+
+    # stub every embeddings call, and keep the query cache away from the real one
+    embeddings_module.client = FakeClient(latency=0)
+    directory = tempfile.mkdtemp()
+    index_module.query_cache = EmbeddingCache(path=f"{directory}/embeddings.sqlite3")
+
+    results = {}
+    for bench in (
+        lambda: bench_k_nearest(sizes, min_time),
+        lambda: bench_load_list(min_time),
+        lambda: bench_messages(lengths, directory, min_time),
+        lambda: bench_pills(lengths, min_time),
+        lambda: bench_render(lengths, min_time),
+        lambda: bench_event_stream(lengths, min_time),
+    ):
+        for key, result in bench().items():
+            results[key] = result
+            print(f"{key:<45} p50={result['p50_us']:12.1f}us p95={result['p95_us']:12.1f}us runs={result['runs']}")
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({"environment": environment(), "results": results}, file, indent=2)
+    print(f"Saved results to {output}.")
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and shorter runs")
+    parser.add_argument(
+        "--output",
+        default=f"data/benchmarks/hot_paths-{datetime.datetime.now():%Y%m%d-%H%M%S}.json",
+    )
+    parser.add_argument("--compare", metavar="BASELINE", help="a previous results file to compare against")
+    args = parser.parse_args()
+    run(args.quick, args.output, args.compare)
@@ -0,0 +1,85 @@
+"""
+Benchmark of the rate limit check every request pays, under concurrent load from several
+processes and threads, for the per-worker memory storage and the shared sqlite storage:
+
+    PYTHONPATH=src python -m benchmarks.limiter_overhead --processes 4 --threads 8
+
+Also checks the limit holds across processes: with the shared storage only `--limit` hits
+on the shared key are allowed in total, with the memory storage each process allows that many.
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import threading
+import time
+from limits import RateLimitItemPerMinute
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+import ratelimit_storage  # registers the sqlite:// scheme
+
+
+def worker(uri, threads, hits, limit, results):
+    limiter = FixedWindowRateLimiter(storage_from_string(uri))
+    shared = RateLimitItemPerMinute(limit)
+    per_client = RateLimitItemPerMinute(10 ** 9)
+    latencies, allowed = [], [0]
+    lock = threading.Lock()
+
+    def client(n):
+        times, ok = [], 0
+        key = f"{os.getpid()}-{n}"  # a client ip, like get_remote_address
+        for _ in range(hits):
+            start_time = time.perf_counter()
+            limiter.hit(per_client, key)
+            ok += limiter.hit(shared, "shared")
+            times.append((time.perf_counter() - start_time) / 2)
+        with lock:
+            latencies.extend(times)
+            allowed[0] += ok
+
+    pool = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    start_time = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put((latencies, allowed[0], time.perf_counter() - start_time))
+
+
+def run(processes, threads, hits, limit):
+    directory = tempfile.mkdtemp()
+    for uri in ("memory://", f"sqlite:///{directory}/limits.sqlite3"):
+        results = multiprocessing.Queue()
+        pool = [
+            multiprocessing.Process(target=worker, args=(uri, threads, hits, limit, results))
+            for _ in range(processes)
+        ]
+        for process in pool:
+            process.start()
+        outcomes = [results.get() for _ in pool]
+        for process in pool:
+            process.join()
+
+        latencies = sorted(latency for outcome in outcomes for latency in outcome[0])
+        allowed = sum(outcome[1] for outcome in outcomes)
+        elapsed = max(outcome[2] for outcome in outcomes)
+        print(
+            f'{uri.split(":")[0]:<7} checks={2 * len(latencies):<7} '
+            f'p50={statistics.median(latencies) * 1e6:7.1f}us '
+            f'p99={latencies[int(len(latencies) * 0.99)] * 1e6:8.1f}us '
+            f'throughput={2 * len(latencies) / elapsed:9.0f} checks/s '
+            f'allowed={allowed} (limit {limit})'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients per process')
+    parser.add_argument('--hits', type=int, default=500, help='requests per client')
+    parser.add_argument('--limit', type=int, default=15, help='per minute, on a key every client shares')
+    args = parser.parse_args()
+    run(args.processes, args.threads, args.hits, args.limit)
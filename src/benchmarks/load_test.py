@@ -0,0 +1,203 @@
+"""
+Load driver for `/submit`: many simulated visitors, each with its own session cookie,
+opening server-side-event streams against a running server at once:
+
+    PYTHONPATH=src python -m apis.openai.fake_server &
+    SAMBOT_RATELIMIT_ENABLED=0 OPENAI_BASE_URL=http://127.0.0.1:8765/v1 \\
+        uvicorn --app-dir src asgi:application --port 8000 &
+    PYTHONPATH=src python -m benchmarks.load_test --url http://127.0.0.1:8000 --users 100 --server-pid $!
+
+Reports time-to-first-token (the first answer text, not the ellipsis animation), total
+stream time, dropped streams, and the server's CPU and RSS (itself and its children, read
+from /proc) while the load ran. Rate limits must be off on the server, or most streams
+will be the "you've hit the limit" message.
+"""
+
+from http.cookies import SimpleCookie
+from urllib.parse import quote
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+import aiohttp
+
+QUESTIONS = [
+    "Where are you from?",
+    "What do you do for work?",
+    "What are your hobbies?",
+    "What is your favourite programming language and why?",
+    "Do you like living in Montreal?",
+]
+
+
+class Visitor:
+    """One browser: a cookie jar of its own (the session cookie is `Secure`, so aiohttp won't keep it over http)."""
+
+    def __init__(self, http, url):
+        self.http = http
+        self.url = url
+        self.cookies = {}
+
+    def _remember(self, response):
+        for header in response.headers.getall("Set-Cookie", []):
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+    def _headers(self, **headers):
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        return headers
+
+    async def home(self):
+        async with self.http.get(f"{self.url}/", headers=self._headers()) as response:
+            await response.read()
+            self._remember(response)
+            return response.status
+
+    async def submit(self, question, timeout):
+        """Stream one answer, returning (time to first event, time to first token, total time, error)."""
+        start_time = time.perf_counter()
+        first_event = first_token = None
+        try:
+            async with self.http.get(
+                f"{self.url}/submit?user_content={quote(question)}",
+                headers=self._headers(Accept="text/event-stream"),
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                self._remember(response)
+                if response.status != 200:
+                    return first_event, first_token, None, f"http {response.status}"
+                event = None
+                async for line in response.content:
+                    line = line.decode("utf-8").rstrip("\n")
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: "):
+                        now = time.perf_counter() - start_time
+                        first_event = first_event if first_event is not None else now
+                        if event == "done":
+                            return first_event, first_token, now, None
+                        data = json.loads(line[len("data: "):])
+                        text = data.get("text", data.get("last", ""))
+                        if first_token is None and event in ("append", "replace-last") and text.strip("."):
+                            first_token = now
+                return first_event, first_token, None, "stream ended without a done event"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return first_event, first_token, None, type(e).__name__
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of a process and its children from /proc."""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples = []
+        self.cpu_start = self.cpu_end = None
+        self.tick = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def pids(self):
+        """The process and all of its descendants (e.g., uvicorn's workers)."""
+        children = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as file:
+                        ppid = int(file.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                children.setdefault(ppid, []).append(int(entry))
+        found, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            found.append(pid)
+            stack.extend(children.get(pid, []))
+        return found
+
+    def sample(self):
+        """(cpu seconds, rss bytes) summed over the process tree."""
+        cpu = rss = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as file:
+                    fields = file.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / self.tick  # utime + stime
+                with open(f"/proc/{pid}/statm") as file:
+                    rss += int(file.read().split()[1]) * self.page_size
+            except (OSError, IndexError, ValueError):
+                continue  # exited meanwhile
+        return cpu, rss
+
+    async def run(self):
+        self.cpu_start, _ = self.sample()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                cpu, rss = self.sample()
+                self.cpu_end = cpu
+                self.rss_samples.append(rss)
+        except asyncio.CancelledError:
+            self.cpu_end, _ = self.sample()
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return f"p50={pick(0.5) * 1000:8.1f}ms p95={pick(0.95) * 1000:8.1f}ms p99={pick(0.99) * 1000:8.1f}ms"
+
+
+async def run(url, users, streams, ramp, timeout, server_pid):
+    results = []
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as http:
+
+        async def visit(n):
+            await asyncio.sleep(ramp * n / max(1, users))
+            visitor = Visitor(http, url)
+            await visitor.home()
+            for i in range(streams):
+                results.append(await visitor.submit(QUESTIONS[(n + i) % len(QUESTIONS)], timeout))
+
+        sampler = ProcessSampler(server_pid) if server_pid else None
+        sampling = asyncio.ensure_future(sampler.run()) if sampler else None
+        start_time = time.perf_counter()
+        await asyncio.gather(*(visit(n) for n in range(users)))
+        elapsed = time.perf_counter() - start_time
+        if sampling:
+            sampling.cancel()
+            await asyncio.gather(sampling, return_exceptions=True)
+
+    completed = [r for r in results if r[3] is None]
+    errors = {}
+    for r in results:
+        if r[3] is not None:
+            errors[r[3]] = errors.get(r[3], 0) + 1
+    print(f"streams:          {len(results)} in {elapsed:.1f}s ({len(results) / elapsed:.1f}/s), {len(completed)} completed")
+    print(f"dropped:          {len(results) - len(completed)} {errors or ''}")
+    print(f"first event:      {percentiles([r[0] for r in results if r[0] is not None])}")
+    print(f"first token:      {percentiles([r[1] for r in completed if r[1] is not None])}")
+    print(f"stream time:      {percentiles([r[2] for r in completed])}")
+    if sampler and sampler.cpu_end is not None:
+        cpu = sampler.cpu_end - sampler.cpu_start
+        rss = sampler.rss_samples or [0]
+        print(
+            f"server:           cpu={cpu:.1f}s ({100 * cpu / elapsed:.0f}% of a core) "
+            f"rss mean={statistics.fmean(rss) / 2**20:.0f}MiB peak={max(rss) / 2**20:.0f}MiB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=50, help="concurrent visitors")
+    parser.add_argument("--streams", type=int, default=2, help="questions each visitor asks, one after another")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which visitors arrive")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds before a stream counts as dropped")
+    parser.add_argument("--server-pid", type=int, help="sample this process (and its children) for cpu and rss")
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.users, args.streams, args.ramp, args.timeout, args.server_pid))
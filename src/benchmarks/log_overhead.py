@@ -0,0 +1,89 @@
+"""
+Benchmark of what logging costs a `/submit` request, i.e. the log calls on its path
+(messages load, k-nearest with its 20 results, cache stats, stream summary), for the
+old pipeline and each mode of logger.py, at DEBUG and INFO:
+
+    PYTHONPATH=src python -m benchmarks.log_overhead --requests 2000
+
+Records go to /dev/null, so this is the cost in the request's thread. With the queue
+the formatting and the write happen on the listener thread instead, "drain" is how
+long it then took to catch up.
+"""
+
+import argparse
+import logging
+import os
+import time
+import logger
+
+CONTENTS = [f"Sam studied computer science at McGill and likes building things, fact {i}." * 2 for i in range(20)]
+DISTANCES = [0.3 + i / 100 for i in range(20)]
+STATS = {"memory_hits": 10, "disk_hits": 2, "misses": 3, "memory_entries": 15}
+
+
+class EagerColorFormatter(logger.ColorFormatter):
+    """The formatter before logger.py cached them: a new `logging.Formatter` per record."""
+
+    def format(self, record):
+        formatter = logging.Formatter(fmt=self.FORMATS.get(record.levelno), datefmt="%Y-%m-%d %H:%M:%S")
+        return formatter.format(record)
+
+
+def eager_request(log):
+    """The log calls of one request, with every message built up front as before."""
+    log.debug(f"Loaded messages from id {'0' * 36}.")
+    log.debug(f"Query embedding cache stats: {dict(STATS)}")
+    log.debug(f"Found k-nearest distances: {[d for d in DISTANCES]}")
+    log.debug(f"Found k-nearest embedding distances: {[(c, d) for c, d in zip(CONTENTS, DISTANCES)]}.")
+    log.debug(f"Sent {120} frames ({40960} bytes) for this response.")
+    log.info("Submit finished.")
+
+
+def lazy_request(log):
+    """The same log calls, with the expensive arguments only built if the record is emitted."""
+    log.debug(f"Loaded messages from id {'0' * 36}.")
+    log.debug("Query embedding cache stats: %s", logger.Lazy(lambda: dict(STATS)))
+    log.debug("Found k-nearest distances: %s", logger.Lazy(lambda: [d for d in DISTANCES]))
+    log.debug(
+        "Found k-nearest embedding distances: %s.",
+        logger.Lazy(lambda: [(c, d) for c, d in zip(CONTENTS, DISTANCES)]),
+    )
+    log.debug(f"Sent {120} frames ({40960} bytes) for this response.")
+    log.info("Submit finished.")
+
+
+def run(requests):
+    devnull = open(os.devnull, "w")
+    modes = [
+        ("old: sync, formatter per record, eager", dict(use_queue=False, log_format="color"), EagerColorFormatter, eager_request),
+        ("sync, cached formatters, lazy", dict(use_queue=False, log_format="color"), None, lazy_request),
+        ("queue, color, lazy", dict(use_queue=True, log_format="color"), None, lazy_request),
+        ("queue, json, lazy", dict(use_queue=True, log_format="json"), None, lazy_request),
+    ]
+    for level in ("DEBUG", "INFO"):
+        # a logger per level, since loggers cache which levels they're enabled for
+        log = logger.get_logger(f"benchmarks.log_overhead.{level.lower()}")
+        log.setLevel(level)
+        for name, options, formatter, request in modes:
+            handler = logger.configure(stream=devnull, **options)
+            if formatter:
+                handler.setFormatter(formatter())
+            start_time = time.perf_counter()
+            for _ in range(requests):
+                request(log)
+            elapsed = time.perf_counter() - start_time
+            drain_start = time.perf_counter()
+            logger.shutdown()
+            drain = time.perf_counter() - drain_start
+            print(
+                f"{level:<5} {name:<42} {elapsed / requests * 1e6:8.1f}us per request"
+                + (f"  (drain {drain * 1000:.0f}ms)" if options["use_queue"] else "")
+            )
+    logger.configure()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    run(args.requests)
@@ -0,0 +1,23 @@
+"""
+Build the approximate nearest-neighbour (ivf) index of a binary embedding store and
+save it next to the store, where `EmbeddingIndex.load` picks it up:
+
+    python src/build_ann_index.py embeddings.bin [--nlist 512]
+
+Paths are relative to `settings.LOCAL_RESOURCE_DIR`. Re-run it whenever the store
+changes, a stale index is ignored (with a warning) in favour of exact search.
+"""
+
+import argparse
+import settings
+from apis.openai import ivf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("store", nargs="?", default=settings.EMBEDDINGS_FILE)
+    parser.add_argument("--nlist", type=int, help="number of lists, about sqrt(count) by default")
+    parser.add_argument("--iterations", type=int, default=10, help="k-means iterations")
+    args = parser.parse_args()
+    index = ivf.build(f"{settings.LOCAL_RESOURCE_DIR}/{args.store}", nlist=args.nlist, iterations=args.iterations)
+    print(f"Built an ivf index of {len(index)} embeddings in {index.nlist} lists for {args.store}.")
@@ -0,0 +1,28 @@
+"""
+Convert an embeddings file into another format, e.g. the JSON list in data/resources
+into the memory-mapped binary store the app loads at startup:
+
+    python src/convert_embeddings.py embeddings.json embeddings.bin
+
+Paths are relative to `settings.LOCAL_RESOURCE_DIR`. The output format is picked
+from the destination extension (`.json` for JSON, anything else for binary).
+"""
+
+import argparse
+from apis.openai import Embedding
+
+
+def convert(source: str, destination: str) -> int:
+    """Convert the embeddings at `source` and return how many were written."""
+    embeddings = Embedding.load_list(source)
+    Embedding.save_list(embeddings, destination)
+    return len(embeddings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", nargs="?", default="embeddings.json")
+    parser.add_argument("destination", nargs="?", default="embeddings.bin")
+    args = parser.parse_args()
+    count = convert(args.source, args.destination)
+    print(f"Converted {count} embeddings from {args.source} to {args.destination}.")
@@ -0,0 +1,120 @@
+"""
+One long-lived asyncio event loop per worker process, running in a background thread.
+Synchronous request handlers hand coroutines to it with `submit()` instead of creating
+(and leaking) a new loop per request.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import threading
+import logger
+
+_logger = logger.get_logger(__name__)
+
+
+class BackgroundLoop:
+    """An event loop running forever in a daemon thread until `stop()` is called."""
+
+    def __init__(self, name="sambot-event-loop"):
+        self.name = name
+        self.loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        # a forked worker inherits the loop object but not the thread running it
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self.loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,), name=self.name, daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+            ready.wait()
+            _logger.debug(f"Started background event loop in process {self._pid}.")
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """
+        Schedule `coro` on the loop, starting it if needed. The returned future can
+        be waited on from any thread, and cancelling it cancels the underlying task.
+        """
+        if not self.running:
+            self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Run `coro` on the loop and block until it finishes."""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout=timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def iterate(self, agen):
+        """
+        Drive an async generator from synchronous code, one item per step on the loop.
+        Closing the returned generator early (e.g., the client disconnected) closes
+        `agen` on the loop too, so its cleanup runs.
+        """
+        async def step():
+            return await agen.__anext__()
+
+        async def close():
+            await agen.aclose()
+
+        try:
+            while True:
+                try:
+                    yield self.run(step())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(close())
+
+    def stop(self, timeout=5.0):
+        """Cancel outstanding tasks, close pooled openai connections, and stop the loop."""
+        with self._lock:
+            if not self.running:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=timeout)
+            except (concurrent.futures.TimeoutError, RuntimeError) as e:
+                _logger.warning(f"Background event loop did not shut down cleanly: {e!r}.")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=timeout)
+            if not self._thread.is_alive():
+                self.loop.close()
+            self._thread = None
+            _logger.debug("Stopped background event loop.")
+
+    async def _shutdown(self):
+        from apis.openai import aio  # imported late so this module stays usable without openai settings
+
+        current = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await aio.aclose()
+        await self.loop.shutdown_asyncgens()
+
+
+background_loop = BackgroundLoop()
+submit = background_loop.submit
+run = background_loop.run
+iterate = background_loop.iterate
+atexit.register(background_loop.stop)
@@ -0,0 +1,79 @@
+"""
+Per-worker cache of rendered `message.html` fragments. A finished message never
+changes, so its html is rendered once and then looked up by role and a hash of its
+content; a page is the cached fragments joined, plus the live message (if any)
+rendered fresh. Memory is bounded by the total size of the cached fragments.
+"""
+
+import dataclasses
+import threading
+from collections import OrderedDict
+import flask
+
+
+@dataclasses.dataclass
+class FragmentStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    bytes: int = 0  # held by the cache right now
+
+
+class FragmentCache:
+    """LRU of (role, content hash) to rendered html, holding at most `max_bytes` of html."""
+
+    def __init__(self, max_bytes, template="message.html"):
+        self.max_bytes = max_bytes
+        self.template = template
+        self.stats = FragmentStats()
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(message):
+        return message.role, message.content_hash
+
+    def render_one(self, message):
+        return flask.render_template(self.template, message=message)
+
+    def get_many(self, messages):
+        """The html of finished `messages`, rendering (and caching) the ones missing."""
+        keys = [self.key(m) for m in messages]
+        with self._lock:  # one lock round for the whole page
+            parts = [self._fragments.get(key) for key in keys]
+            for key, html in zip(keys, parts):
+                if html is not None:
+                    self._fragments.move_to_end(key)
+            misses = parts.count(None)
+            self.stats.hits += len(parts) - misses
+            self.stats.misses += misses
+        if misses:
+            for i, message in enumerate(messages):
+                if parts[i] is None:
+                    parts[i] = self.render_one(message)
+                    self._put(keys[i], parts[i])
+        return parts
+
+    def _put(self, key, html):
+        if len(html) > self.max_bytes:
+            return
+        with self._lock:
+            if key not in self._fragments:
+                self._fragments[key] = html
+                self.stats.bytes += len(html)
+            while self.stats.bytes > self.max_bytes:
+                _, evicted = self._fragments.popitem(last=False)
+                self.stats.bytes -= len(evicted)
+                self.stats.evictions += 1
+
+    def render(self, messages, live=False):
+        """The html of `messages`, where the last one is rendered without caching if it's `live` (i.e., streaming)."""
+        parts = self.get_many(messages[:-1] if live else messages)
+        if live and messages:
+            parts.append(self.render_one(messages[-1]))
+        return "".join(parts)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.stats.bytes = 0
@@ -59,17 +59,32 @@ content_list = [
 ]
 
 from apis.openai import Embedding, k_nearest
+from apis.openai.fake import FakeClient
+import argparse
+import settings
 
-path = 'embeddings.json'
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed content_list and save it for the app to load.")
+    parser.add_argument("--path", help="inside LOCAL_RESOURCE_DIR, .json or binary (default: settings.EMBEDDINGS_FILE)")
+    parser.add_argument("--batch-size", type=int, default=settings.EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=settings.EMBEDDING_CONCURRENCY)
+    parser.add_argument("--fake", action="store_true", help="use a local fake client instead of openai, needs --path")
+    args = parser.parse_args()
+    if args.path is None:
+        if args.fake:
+            # fake vectors are meaningless, never let them replace the embeddings the app answers from
+            parser.error("--fake needs an explicit --path")
+        args.path = settings.EMBEDDINGS_FILE
 
-#embeddings = Embedding.gen_list(content_list)
-#Embedding.save_list(embeddings, path)
-#embeddings = Embedding.load_list(path)
+    embeddings = Embedding.gen_list(
+        content_list,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        embeddings_client=FakeClient(latency=0.05) if args.fake else None,
+    )
+    Embedding.save_list(embeddings, args.path)
 
 #while True:
 #    content = input('Enter your content:\n')
 #    nearest = k_nearest(content, embeddings, k=3)
 #    print([n.content for n in nearest])
-
-
-
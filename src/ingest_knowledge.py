@@ -0,0 +1,285 @@
+"""
+Chunk markdown knowledge sources (e.g., info.md) and embed them into a new version of
+the knowledge store, only sending the chunks that were added or changed since the
+last version to openai:
+
+    python src/ingest_knowledge.py [info.md ...] [--fake]
+
+Versions are written to `KNOWLEDGE_DIR` inside the resource directory as `v0001.bin`,
+`v0002.bin`, ..., each with a json manifest, and `current.bin` links to the newest.
+Chunks are read, embedded and written a window at a time, so neither the sources nor
+the store ever have to fit in memory. Point `settings.EMBEDDINGS_FILE` at
+`knowledge/current.bin` to answer from the ingested knowledge.
+"""
+
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+import settings
+import logger
+from apis.openai import Embedding, EmbeddingStore, EMBEDDING_MODEL, ivf
+from apis.openai.fake import FakeClient
+from apis.openai.store import EmbeddingStoreWriter
+
+_logger = logger.get_logger(__name__)
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*:?\s*$")
+_LIST_ITEM = re.compile(r"^\s*(?:[-*+]|\d+[.)])\s+")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def _blocks(lines) -> Iterator[tuple]:
+    """(headings, text) for every paragraph and list item of a markdown file, as its lines stream in."""
+    headings, block = [], []
+
+    def flush():
+        text = " ".join(part.strip() for part in block).strip()
+        block.clear()
+        return (tuple(headings), text) if text else None
+
+    for line in lines:
+        heading = _HEADING.match(line)
+        if heading or not line.strip() or _LIST_ITEM.match(line):
+            if (done := flush()) is not None:
+                yield done
+        if heading:
+            level = len(heading.group(1))
+            headings[level - 1:] = [heading.group(2)]
+        elif line.strip():
+            block.append(_LIST_ITEM.sub("", line, count=1))
+    if (done := flush()) is not None:
+        yield done
+
+
+def _split(text: str, max_chars: int) -> Iterator[str]:
+    """`text` in pieces of whole sentences no longer than `max_chars` (unless one sentence is)."""
+    piece = ""
+    for sentence in _SENTENCE_END.split(text):
+        if piece and len(piece) + 1 + len(sentence) > max_chars:
+            yield piece
+            piece = sentence
+        else:
+            piece = f"{piece} {sentence}" if piece else sentence
+    if piece:
+        yield piece
+
+
+def iter_chunks(path: str, max_chars: int = settings.KNOWLEDGE_CHUNK_CHARS) -> Iterator[str]:
+    """
+    The chunks of the markdown file at `path`: every paragraph and list item, split
+    into pieces of at most `max_chars`, each prefixed with the headings it is under.
+    """
+    with open(path, "r") as file:
+        for headings, text in _blocks(file):
+            prefix = " > ".join(headings)
+            for piece in _split(text, max_chars):
+                yield f"{prefix}: {piece}" if prefix else piece
+
+
+def chunk_key(content: str, model: str) -> str:
+    """Identifies a chunk's embedding: the same text embedded by the same model never needs embedding again."""
+    return hashlib.sha256(f"{model}\0{content}".encode("utf-8")).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class IngestStats:
+    chunks: int = 0
+    embedded: int = 0  # new or changed chunks sent to openai
+    reused: int = 0  # unchanged chunks copied from the previous version
+    removed: int = 0  # chunks of the previous version that are gone
+    seen: set = field(default_factory=set, repr=False)  # keys of the previous version still in use
+
+
+class KnowledgeVersions:
+    """The versioned knowledge stores in one directory: `vNNNN.bin`, `vNNNN.json`, and `current.bin`."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, version: int, extension: str = "bin") -> str:
+        return f"{self.directory}/v{version:04d}.{extension}"
+
+    @property
+    def current_path(self) -> str:
+        return f"{self.directory}/current.bin"
+
+    def versions(self) -> List[int]:
+        return sorted(
+            int(os.path.basename(path)[1:-len(".json")])
+            for path in glob.glob(f"{self.directory}/v[0-9][0-9][0-9][0-9].json")
+        )
+
+    def manifest(self, version: int) -> dict:
+        with open(self.path(version, "json"), "r") as file:
+            return json.load(file)
+
+    def publish(self, version: int, manifest: dict) -> None:
+        """Write the manifest of a store already written as `version`, then point `current.bin` at it."""
+        temp_path = f"{self.path(version, 'json')}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(temp_path, self.path(version, "json"))
+        link = f"{self.current_path}.tmp"
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(self.path(version)), link)
+        os.replace(link, self.current_path)  # readers see the old or the new version, never neither
+
+    def prune(self, keep: int) -> None:
+        """Remove all but the newest `keep` versions."""
+        for version in self.versions()[:-keep] if keep > 0 else []:
+            for path in (self.path(version), ivf.ivf_path(self.path(version)), self.path(version, "json")):
+                if os.path.exists(path):
+                    os.remove(path)
+            _logger.debug(f"Removed knowledge version {version}.")
+
+
+class Ingester:
+    """Writes the chunks of the sources to a new version, embedding only the ones the previous version lacks."""
+
+    def __init__(
+        self,
+        versions: KnowledgeVersions,
+        max_chars: int = settings.KNOWLEDGE_CHUNK_CHARS,
+        batch_size: int = settings.EMBEDDING_BATCH_SIZE,
+        concurrency: int = settings.EMBEDDING_CONCURRENCY,
+        embeddings_client=None,
+    ):
+        self.versions = versions
+        self.max_chars = max_chars
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.embeddings_client = embeddings_client
+        # recorded in the chunk keys and the manifest, so a real run never reuses fake vectors
+        self.model = FakeClient.MODEL if isinstance(embeddings_client, FakeClient) else EMBEDDING_MODEL
+        # chunks are embedded a window at a time, enough to keep every concurrent request busy
+        self.window = max(1, batch_size * concurrency)
+
+    def _previous(self, version: Optional[int]):
+        """The previous store, its chunk keys in order, and a row of each key, or nothing to reuse."""
+        if version is None:
+            return None, [], {}
+        previous = EmbeddingStore(self.versions.path(version))
+        model = self.versions.manifest(version)["model"]
+        keys = [chunk_key(previous.content(i), model) for i in range(len(previous))]
+        rows = {}
+        for i, key in enumerate(keys):
+            rows.setdefault(key, i)  # a repeated chunk has the same vector wherever it is
+        return previous, keys, rows
+
+    def _write_window(self, writer, window, previous, rows, stats):
+        new = list(dict.fromkeys(content for content, key in window if key not in rows))
+        embedded = {}
+        if new:
+            for embedding in Embedding.gen_list(
+                new,
+                batch_size=self.batch_size,
+                concurrency=self.concurrency,
+                embeddings_client=self.embeddings_client,
+            ):
+                embedded[embedding.content] = embedding.vector
+            stats.embedded += len(new)
+        for content, key in window:
+            if key in rows:
+                writer.write(Embedding(content=content, vector=previous.matrix[rows[key]]))
+                stats.reused += 1
+                stats.seen.add(key)
+            else:
+                writer.write(Embedding(content=content, vector=embedded[content]))
+            stats.chunks += 1
+        window.clear()
+
+    def ingest(self, sources: List[str], force: bool = False) -> Optional[int]:
+        """Write a new version from `sources`, returning it, or None if nothing changed (unless `force`)."""
+        os.makedirs(self.versions.directory, exist_ok=True)
+        existing = self.versions.versions()
+        parent = existing[-1] if existing else None
+        previous, previous_keys, rows = self._previous(parent)
+        version = (parent or 0) + 1
+        stats = IngestStats()
+        start_time = time.perf_counter()
+
+        unchanged = previous is not None
+        writer = EmbeddingStoreWriter(self.versions.path(version))
+        try:
+            window = []
+            for source in sources:
+                for content in iter_chunks(source, self.max_chars):
+                    key = chunk_key(content, self.model)
+                    # the same chunks in the same order as before make the same store
+                    position = stats.chunks + len(window)
+                    unchanged = unchanged and position < len(previous_keys) and previous_keys[position] == key
+                    window.append((content, key))
+                    if len(window) >= self.window:
+                        self._write_window(writer, window, previous, rows, stats)
+            self._write_window(writer, window, previous, rows, stats)
+            stats.removed = len(set(rows) - stats.seen)
+            if unchanged and stats.chunks == len(previous_keys) and not force:
+                writer.abort()
+                _logger.info(f"Knowledge is up to date at version {parent} ({stats.chunks} chunks).")
+                return None
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+
+        self.versions.publish(version, {
+            "version": version,
+            "parent": parent,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "model": self.model,
+            "max_chars": self.max_chars,
+            "sources": {os.path.basename(source): file_digest(source) for source in sources},
+            "chunks": stats.chunks,
+            "embedded": stats.embedded,
+            "reused": stats.reused,
+            "removed": stats.removed,
+        })
+        if parent is not None and os.path.exists(ivf.ivf_path(self.versions.path(parent))):
+            ivf.build(self.versions.path(version))  # the previous version was searched approximately, keep it so
+        _logger.info(
+            f"Wrote knowledge version {version}: {stats.chunks} chunks, {stats.embedded} embedded, "
+            + f"{stats.reused} reused and {stats.removed} removed in {time.perf_counter() - start_time:.1f} seconds."
+        )
+        return version
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="*", default=settings.KNOWLEDGE_SOURCES, help="inside LOCAL_RESOURCE_DIR")
+    parser.add_argument("--max-chars", type=int, default=settings.KNOWLEDGE_CHUNK_CHARS, help="longest chunk")
+    parser.add_argument("--batch-size", type=int, default=settings.EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=settings.EMBEDDING_CONCURRENCY)
+    parser.add_argument("--keep", type=int, default=settings.KNOWLEDGE_KEEP_VERSIONS, help="versions to keep")
+    parser.add_argument("--force", action="store_true", help="write a new version even if nothing changed")
+    parser.add_argument(
+        "--fake", action="store_true", help="use a local fake client instead of openai (re-embedded by the next real run)"
+    )
+    args = parser.parse_args()
+
+    versions = KnowledgeVersions(f"{settings.LOCAL_RESOURCE_DIR}/{settings.KNOWLEDGE_DIR}")
+    ingester = Ingester(
+        versions,
+        max_chars=args.max_chars,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        embeddings_client=FakeClient(latency=0.05) if args.fake else None,
+    )
+    version = ingester.ingest([f"{settings.LOCAL_RESOURCE_DIR}/{source}" for source in args.sources], force=args.force)
+    versions.prune(args.keep)
+    print(f"Knowledge version {version} is current." if version else "Knowledge is up to date.")
@@ -0,0 +1,44 @@
+"""
+Per-thread connections to the SQLite files the app keeps on the host (the embedding
+cache, the rate limits and the sqlite messages backend), all in WAL mode so readers
+don't wait on the writer.
+"""
+
+import os
+import sqlite3
+import threading
+from typing import Callable
+
+
+class ThreadLocalConnection:
+    """
+    One connection to `path` per thread, since sqlite connections can't be shared across
+    threads. `setup` is called with each new connection, e.g. to create the tables.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        setup: Callable[[sqlite3.Connection], None],
+        timeout: float = 5,
+        synchronous: str = "NORMAL",
+        **connect_kwargs,
+    ):
+        self.path = path
+        self.setup = setup
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.connect_kwargs = connect_kwargs
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=self.timeout, **self.connect_kwargs)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(f"PRAGMA synchronous={self.synchronous}")
+            self.setup(db)
+            self._local.db = db
+        return db
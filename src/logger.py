@@ -1,4 +1,12 @@
+import atexit
+import datetime
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
 import time
 
 import settings
@@ -28,14 +36,14 @@ class LogTimeContextManager:
         """
         Save start time and log.
         """
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
         self.log_fn(f"{self.message.capitalize()}...")
 
     def __exit__(self, exc_type, exc_value, traceback):
         """
         Compute end time and log.
         """
-        self.elapsed_time = time.time() - self.start_time
+        self.elapsed_time = time.perf_counter() - self.start_time
         self.log_fn(
             f"Finished {self.message.lower()} in {self.elapsed_time:.2f} seconds."
         )
@@ -43,6 +51,23 @@ class LogTimeContextManager:
         return False
 
 
+class Lazy:
+    """
+    A log argument that is only computed if the record is actually emitted, e.g.
+    `_logger.debug("Nearest: %s", Lazy(lambda: [d.dist for d in nearest]))`.
+    """
+
+    __slots__ = ("fn",)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self):
+        return str(self.fn())
+
+    __repr__ = __str__
+
+
 class CustomLogger(logging.Logger):
     """
     Custom logger!
@@ -90,22 +115,131 @@ class ColorFormatter(logging.Formatter):
         BLUE_LOGGING_LEVEL: blue + format_str + reset,
     }
 
+    def __init__(self):
+        super().__init__()
+        self.formatters = {
+            level: logging.Formatter(fmt=fmt, datefmt="%Y-%m-%d %H:%M:%S")
+            for level, fmt in self.FORMATS.items()
+        }
+        self.default = logging.Formatter(fmt=self.format_str, datefmt="%Y-%m-%d %H:%M:%S")
+
     def format(self, record):
-        formatter = logging.Formatter(
-            fmt=self.FORMATS.get(record.levelno),
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
-        return formatter.format(record)
+        return self.formatters.get(record.levelno, self.default).format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per line, for log collectors in production.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+FORMATTERS = {
+    "color": ColorFormatter,
+    "json": JsonFormatter,
+}
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a listener thread that formats and writes them, so logging
+    never blocks a request on stderr. Messages are still merged with their args
+    here (args can change after the call), but only for records that pass the level.
+    """
+
+    def __init__(self, handler):
+        super().__init__(queue.SimpleQueue())
+        self.handler = handler
+        self.listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # a forked worker inherits the queue but not the listener thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        """Write out everything queued and stop the listener."""
+        with self._lock:
+            if self.listener is not None and self._pid == os.getpid():
+                self.listener.stop()
+            self._pid = None
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        self.start()
+        super().emit(record)
+
+
+_loggers = {}
+_handler = None
+
+
+def build_handler(stream=None, log_format=settings.LOG_FORMAT, use_queue=settings.LOG_QUEUE):
+    """The handler every logger shares: a stream handler, behind a queue if `use_queue`."""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(FORMATTERS[log_format]())
+    if use_queue:
+        handler = BackgroundQueueHandler(handler)
+    return handler
+
+
+def configure(**kwargs):
+    """Swap the shared handler of every logger, see `build_handler`."""
+    global _handler
+    if isinstance(_handler, BackgroundQueueHandler):
+        _handler.stop()
+    _handler = build_handler(**kwargs)
+    for logger in _loggers.values():
+        logger.handlers = [_handler]
+    return _handler
+
+
+def shutdown():
+    if isinstance(_handler, BackgroundQueueHandler):
+        _handler.stop()
+
+
+atexit.register(shutdown)
 
 
 def get_logger(name):
     """
-    Get a new logger instance with the given module name.
+    Get the logger for the given module name, created on first use. Every logger
+    shares one handler (see `configure`).
     """
-    logger = CustomLogger(name)
-    logger.setLevel(settings.LOG_LEVEL)
-    handler = logging.StreamHandler()
-    formatter = ColorFormatter()
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    global _handler
+    logger = _loggers.get(name)
+    if logger is None:
+        if _handler is None:
+            _handler = build_handler()
+        logger = _loggers.setdefault(name, CustomLogger(name))
+        logger.setLevel(settings.LOG_LEVEL)
+        logger.handlers = [_handler]
     return logger
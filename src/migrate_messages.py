@@ -0,0 +1,49 @@
+"""
+Import conversations saved by the json messages backend into the sqlite backend:
+
+    python src/migrate_messages.py [--delete]
+
+Conversations already in the database are skipped, so it is safe to re-run. Each file's
+modification time is kept as the conversation's creation time. Pass `--delete` to remove
+each json file once it has been imported.
+"""
+
+import argparse
+import os
+import storage
+
+
+def migrate(source, destination, delete=False):
+    """Copy every conversation from the json `source` into the sqlite `destination`."""
+    imported = skipped = failed = 0
+    with os.scandir(source.directory) as entries:
+        for entry in entries:
+            if not (entry.name.startswith("msg-") and entry.name.endswith(".json")):
+                continue
+            id = entry.name[len("msg-"):-len(".json")]
+            try:
+                stored = source.load(id)
+            except ValueError as e:
+                print(f"Skipping {entry.name}, it could not be decoded: {e}.")
+                failed += 1
+                continue
+            if destination.load(id) is not None:
+                skipped += 1
+            else:
+                destination.create(id, stored.rows, stored.meta, created_at=entry.stat().st_mtime)
+                imported += 1
+            if delete:
+                source.delete(id)
+    return imported, skipped, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delete", action="store_true", help="remove json files once imported")
+    args = parser.parse_args()
+    source = storage.JsonMessagesBackend()
+    destination = storage.SqliteMessagesBackend()
+    if not os.path.isdir(source.directory):
+        parser.exit(message=f"Nothing to migrate, {source.directory} does not exist.\n")
+    imported, skipped, failed = migrate(source, destination, delete=args.delete)
+    print(f"Imported {imported} conversations into {destination.path} ({skipped} already there, {failed} failed).")
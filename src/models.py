@@ -3,13 +3,23 @@ from uuid import uuid4
 from collections import UserList
 import json
 import apis.openai as openai
-import os
 import settings
+import storage
+import session_cache
+import answer_cache
+import tracing
 import logger
 import asyncio
 import resources
 import Levenshtein as lev
+from rapidfuzz import process as fuzz_process
+from rapidfuzz.distance import Levenshtein as fuzz_lev
 import random
+import hashlib
+import functools
+import re
+import threading
+import time
 
 _logger = logger.get_logger(__name__)
 
@@ -50,107 +60,208 @@ class IdNone(BadId):
     ...
 
 
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough local estimate of the number of gpt tokens in `text`: a token per word or
+    punctuation mark, plus one for every 6 characters past the first in long words.
+    """
+    return sum(1 + (len(piece) - 1) // 6 for piece in _TOKEN_PIECES.findall(text))
+
+
 @dataclasses.dataclass
 class Message:
     """Chat gpt message."""
 
+    OVERHEAD_TOKENS = 4  # role and separators around every message
+
     role: str
     content: str
+    _tokens: tuple = dataclasses.field(default=None, init=False, repr=False, compare=False)
+    _hash: tuple = dataclasses.field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def tokens(self) -> int:
+        """Estimated tokens this message costs in a prompt, cached until the content changes."""
+        if self._tokens is None or self._tokens[0] is not self.content:
+            self._tokens = (self.content, estimate_tokens(self.content) + self.OVERHEAD_TOKENS)
+        return self._tokens[1]
+
+    @property
+    def content_hash(self) -> bytes:
+        """Digest of the content (e.g., to key rendered html by), cached until the content changes."""
+        if self._hash is None or self._hash[0] is not self.content:
+            self._hash = (self.content, hashlib.blake2b(self.content.encode("utf-8"), digest_size=16).digest())
+        return self._hash[1]
 
 
 class Messages(UserList):
     """Unique message collection with DB create, load, and save."""
 
     __init_key = uuid4()  # soft force clients to use factory init methods
-
-    def __init__(self, key=None, id=None, initlist=None):
+    backend = storage.get_backend()  # where messages are persisted, see storage.py
+    cache = session_cache.WriteBehindCache(  # live conversations, so a save doesn't wait on the backend
+        flush=lambda messages: messages.flush(),
+        max_entries=settings.MESSAGES_CACHE_SIZE,
+        flush_interval=settings.MESSAGES_FLUSH_INTERVAL,
+        name="messages-cache",
+    ).register_shutdown()
+
+    def __init__(self, key=None, id=None, initlist=None, meta=None):
         super().__init__(initlist=initlist)
         if key != self.__init_key:
             raise ValueError(
                 "Please use factory method to initialize a Messages object!"
             )
         self.id = id
+        self._saved = self._rows()  # what the backend holds, so saves only send what changed
+        self._flush_lock = threading.Lock()
+        self.covered_pills = self._covered_pills(meta or {})
 
-    @staticmethod
-    def _todict(messages):
-        """Return a dictionary representation of the given Messages object."""
-        return {
-            "id": messages.id,
-            "initlist": [dataclasses.asdict(msg) for msg in messages.data],
-        }
+    def _rows(self):
+        return [{"role": m.role, "content": m.content} for m in self.data]
 
-    @staticmethod
-    def _filename(id):
-        """The filename for storing a messages object with the given id."""
-        return f"{settings.LOCAL_MESSAGES_DIR}/msg-{id}.json"
+    def _meta(self):
+        """What is saved alongside the rows, so loading doesn't have to derive it again."""
+        return {"pills": DisplayPills.fingerprint(), "covered_pills": sorted(self.covered_pills)}
+
+    def _covered_pills(self, meta):
+        if meta.get("pills") == DisplayPills.fingerprint():
+            return set(meta["covered_pills"])
+        # saved before, or with other pills, so compare the whole history once
+        return DisplayPills.covered(m.content for m in self.data if m.role == "user")
+
+    def append(self, item):
+        super().append(item)
+        if item.role == "user":
+            self.covered_pills |= DisplayPills.covered([item.content])
+
+    def extend(self, other):
+        other = list(other)
+        super().extend(other)
+        self.covered_pills |= DisplayPills.covered(m.content for m in other if m.role == "user")
 
     @classmethod
     def load_from_id(cls, id):
         if not id:
             _logger.debug("Could not load messages using None id.")
             raise IdNone
+        if cls.cache.enabled and (cached := cls.cache.get(id)) is not None:
+            return cached
         try:
-            with open(cls._filename(id), "r") as file:
-                data = json.load(file)
-                initlist = [
-                    Message(role=m["role"], content=m["content"])
-                    for m in data["initlist"]
-                ]
-                instance = cls(key=cls.__init_key, id=data["id"], initlist=initlist)
-                _logger.debug(f"Loaded messages from id {id}.")
-                return instance
-        except FileNotFoundError as e:
-            err_msg = f"Could not find messages with id {id}."
-            _logger.warn(err_msg)
-            raise NotFound(err_msg) from e
-        except json.decoder.JSONDecodeError as e:
+            stored = cls.backend.load(id)
+        except ValueError as e:
             err_msg = f"Error decoding messages with id: {id}. {e.args}"
             _logger.warn(err_msg)
             raise NotFound(err_msg) from e
+        except Exception as e:
+            raise ReadError(f"Failed to load Messages: {e}.") from e
+        if stored is None:
+            err_msg = f"Could not find messages with id {id}."
+            _logger.warn(err_msg)
+            raise NotFound(err_msg)
+        initlist = [Message(role=m["role"], content=m["content"]) for m in stored.rows]
+        instance = cls(key=cls.__init_key, id=id, initlist=initlist, meta=stored.meta)
+        _logger.debug(f"Loaded messages from id {id}.")
+        if cls.cache.enabled:
+            # another request may have loaded it meanwhile, everyone shares that one
+            instance = cls.cache.put(id, instance)
+        return instance
+
+    def reload(self):
+        """Replace the messages with what the backend holds now (e.g., another request saved a turn meanwhile)."""
+        try:
+            stored = self.backend.load(self.id)
+        except Exception as e:
+            raise ReadError(f"Failed to reload Messages: {e}.") from e
+        if stored is None:
+            return self  # not stored yet
+        self.data = [Message(role=m["role"], content=m["content"]) for m in stored.rows]
+        self._saved = self._rows()
+        self.covered_pills = self._covered_pills(stored.meta)
+        return self
+
+    @classmethod
+    def new(cls, system: str):
+        """A new conversation that isn't stored anywhere, see `create`."""
+        initlist = [Message(role="system", content=system)]
+        return cls(key=cls.__init_key, id=str(uuid4()), initlist=initlist)
 
     @classmethod
     def create(cls, system: str):
         try:
-            id = str(uuid4())
-            initlist = [Message(role="system", content=system)]
-            instance = cls(key=cls.__init_key, id=id, initlist=initlist)
-
-            # make sure messages directory exists
-            os.makedirs(settings.LOCAL_MESSAGES_DIR, exist_ok=True)
-
-            with open(cls._filename(id), "w") as file:
-                json.dump(cls._todict(instance), file)
-                return instance
-
+            instance = cls.new(system)
+            cls.backend.create(instance.id, instance._saved, instance._meta())
         except Exception as e:
             raise WriteError(f"Failed to create Messages: {e}.") from e
+        if cls.cache.enabled:
+            cls.cache.put(instance.id, instance)
+        return instance
 
     def save(self):
-        try:
-            with open(self._filename(self.id), "w") as file:
-                json.dump(self._todict(self), file)
+        """Save the messages, behind the request if they are cached (see `flush`)."""
+        if self.cache.enabled:
+            self.cache.mark_dirty(self.id, self)
+            return self
+        return self.flush()
+
+    def flush(self):
+        """Write whatever changed since the last flush to the backend now."""
+        with self._flush_lock:
+            try:
+                rows = self._rows()
+                start = min(len(rows), len(self._saved))
+                changed = {i: rows[i] for i in range(start) if rows[i] != self._saved[i]}
+                self.backend.save(self.id, rows, start, changed, self._meta())
+                self._saved = rows
                 return self
-        except Exception as e:
-            raise WriteError(f"Failed to save Messages: {e}.") from e
+            except Exception as e:
+                raise WriteError(f"Failed to save Messages: {e}.") from e
 
     def delete(self):
+        self.cache.discard(self.id)
         try:
-            os.remove(self._filename(self.id))
+            self.backend.delete(self.id)
         except Exception as e:
             raise WriteError(f"Failed to delete messages: {e}.") from e
 
     def deep_copy(self):
         """Return a deep-copy of this Messages object."""
         copied_msg_data = [Message(role=m.role, content=m.content) for m in self.data]
-        return Messages(key=self.__init_key, id=self.id, initlist=copied_msg_data)
+        copy = Messages(key=self.__init_key, id=self.id, initlist=copied_msg_data, meta=self._meta())
+        copy._saved = list(self._saved)
+        return copy
 
     def to_display(self):
         """Format messages for front-end display."""
         return [m for m in self.data if m.role != "system"]
 
-    def to_gpt(self):
-        """Format messages for calls to chat gpt's api."""
-        return [dataclasses.asdict(m) for m in self.data]
+    def window(self, budget):
+        """
+        The system message and as many of the latest turns (a user message and its answers)
+        as fit in `budget` estimated tokens. The latest turn is always kept, even alone over budget.
+        """
+        system = self.data[:1] if self.data and self.data[0].role == "system" else []
+        history = self.data[len(system):]
+        start, end, used = len(history), len(history), 0
+        while end > 0:
+            turn_start = end - 1
+            while turn_start > 0 and history[turn_start].role != "user":
+                turn_start -= 1
+            cost = sum(m.tokens for m in history[turn_start:end])
+            if used + cost > budget and end < len(history):
+                break
+            start, end, used = turn_start, turn_start, used + cost
+        if start:
+            _logger.debug(f"Left {start} older messages out of the prompt, {used} tokens of history kept.")
+        return system + history[start:]
+
+    def to_gpt(self, budget=settings.GPT_HISTORY_TOKEN_BUDGET):
+        """Format messages for calls to chat gpt's api, keeping the history within `budget` tokens if set."""
+        messages = self.window(budget) if budget else self.data
+        return [{"role": m.role, "content": m.content} for m in messages]
 
     def to_system_gen(self):
         """Format messages as string for injection into system prompt generator."""
@@ -176,6 +287,7 @@ class DisplayPills(UserList):
         "Do you prefer coffee or tea?",
         "Do you like to read?",
     ]
+    MAX_DISTANCE = 16  # edits, i.e., a `get_str_similarity` of 6 or more
 
     def __init__(self, messages):
         super().__init__()
@@ -188,6 +300,26 @@ class DisplayPills(UserList):
         distance = 0.0001 if distance == 0 else distance  # avoid divide by 0
         return (1 / distance) * 100
 
+    @classmethod
+    @functools.cache
+    def fingerprint(cls):
+        """Changes with the pills and what covers them, so a covered set saved with other pills isn't trusted."""
+        return hashlib.sha256(json.dumps([cls.PILLS, cls.MAX_DISTANCE]).encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def covered(cls, user_contents):
+        """
+        The pills too similar to something in `user_contents` to suggest, i.e., within
+        `MAX_DISTANCE` edits, compared against every pill in one batch.
+        """
+        user_contents = list(user_contents)
+        if not user_contents:
+            return set()
+        distances = fuzz_process.cdist(
+            user_contents, cls.PILLS, scorer=fuzz_lev.distance, score_cutoff=cls.MAX_DISTANCE, workers=1
+        )
+        return {pill for pill, distance in zip(cls.PILLS, distances.min(axis=0)) if distance <= cls.MAX_DISTANCE}
+
     def generate(self):
         """Generate suggestion pills for the user to click on."""
 
@@ -196,32 +328,180 @@ class DisplayPills(UserList):
             self.data = []
             return
 
-        pill_options = []  # populated below
-        user_message_contents = [
-            message.content for message in self.messages if message.role == "user"
-        ]
-        for pill in self.PILLS:
-            should_add = True
-            for user_content in user_message_contents:
-                if self.get_str_similarity(user_content, pill) >= 6:
-                    # dont add if too similar to something already asked by the user
-                    should_add = False
-            if should_add:
-                pill_options.append(pill)
+        # dont add if too similar to something already asked by the user, kept up to date by `Messages`
+        pill_options = [pill for pill in self.PILLS if pill not in self.messages.covered_pills]
 
         # sample random pill options
         self.data = random.sample(pill_options, min(3, len(pill_options)))
 
 
+def prompt_fingerprint(index: openai.EmbeddingIndex) -> str:
+    """
+    Hash of the style and knowledge index as loaded by this worker (rather than as they
+    are on disk now), so precomputed prompts and cached answers are only used for prompts
+    built from the same. Samples the index (see `EmbeddingIndex.fingerprint`), never the file.
+    """
+    digest = hashlib.sha256()
+    digest.update((resources.STYLE or "").encode("utf-8"))
+    digest.update(str(settings.KNOWLEDGE_MAX_DIST).encode("utf-8"))
+    digest.update(index.fingerprint().encode("utf-8"))
+    return digest.hexdigest()
+
+
+@dataclasses.dataclass
+class PrecomputedPrompt:
+    """Query embedding, nearest knowledge and system prompt built ahead of time for a fixed question."""
+
+    question: str
+    embedding: openai.Embedding
+    knowledge: list
+    system: str
+
+
+class PrecomputedPrompts(dict):
+    """
+    Precomputed prompts for the suggestion pills and starters, keyed on normalized
+    question text. Built by precompute_prompts.py.
+    """
+
+    @staticmethod
+    def key(question):
+        return openai.EmbeddingCache.normalize(question)
+
+    def lookup(self, question):
+        return self.get(self.key(question))
+
+    @classmethod
+    def load(cls, fingerprint):
+        """Load the precomputed prompts, or none at all if they are missing or not built for `fingerprint`."""
+        instance = cls()
+        try:
+            with open(f"{settings.LOCAL_RESOURCE_DIR}/{settings.PRECOMPUTED_PROMPTS_FILE}", "r") as file:
+                data = json.load(file)
+            vectors = openai.EmbeddingStore(
+                f"{settings.LOCAL_RESOURCE_DIR}/{settings.PRECOMPUTED_VECTORS_FILE}"
+            )
+        except (FileNotFoundError, json.decoder.JSONDecodeError, openai.StoreError) as e:
+            _logger.warning(f"Not using precomputed prompts: {e}.")
+            return instance
+
+        if data["fingerprint"] != fingerprint:
+            _logger.warning(
+                "Not using precomputed prompts, style or knowledge changed since they were built. "
+                + "Re-run precompute_prompts.py."
+            )
+            return instance
+
+        for embedding, prompt in zip(vectors, data["prompts"]):
+            instance[cls.key(prompt["question"])] = PrecomputedPrompt(
+                question=prompt["question"],
+                embedding=embedding,
+                knowledge=prompt["knowledge"],
+                system=prompt["system"],
+            )
+        _logger.debug(f"Loaded {len(instance)} precomputed prompts.")
+        return instance
+
+
+@dataclasses.dataclass
+class SpeculationStats(tracing.Counters):
+    """Running totals for `SpeculativeRetrieval` in this worker."""
+
+    requests: int = 0
+    used: int = 0  # the speculative knowledge made it into the system message
+    no_prior_turns: int = 0  # ... without a rephrase at all, which saved about rephrase_seconds / rephrases each
+    wasted: int = 0  # the rephrase was too different, so knowledge was retrieved again
+    saved_seconds: float = 0.0  # retrieval time that overlapped a rephrase
+    rephrases: int = 0
+    rephrase_seconds: float = 0.0
+
+
+speculation_stats = SpeculationStats()
+
+
+class SpeculativeRetrieval:
+    """The nearest knowledge to the user's question as asked, retrieved while the question is rephrased."""
+
+    def __init__(self, question, index):
+        self.question = question
+        self.started = time.perf_counter()
+        self.finished = None
+        self.task = asyncio.ensure_future(self._retrieve(index))
+
+    async def _retrieve(self, index):
+        embedding_distances = await openai.async_k_nearest(content=self.question, embeddings=index, k=20)
+        self.finished = time.perf_counter()
+        return embedding_distances
+
+    def matches(self, rephrased, min_similarity=settings.SPECULATIVE_MIN_SIMILARITY):
+        """Whether `rephrased` is close enough to the question as asked to reuse its knowledge."""
+        normalize = openai.EmbeddingCache.normalize
+        return lev.ratio(normalize(self.question), normalize(rephrased)) >= min_similarity
+
+    async def result(self, no_prior_turns=False):
+        needed = time.perf_counter()
+        embedding_distances = await self.task
+        if no_prior_turns:
+            # needed straight away, so nothing overlapped, what was saved is the skipped rephrase
+            speculation_stats.add(requests=1, used=1, no_prior_turns=1)
+            return embedding_distances
+        # retrieving afterwards would have taken as long again, less what we still had to wait here
+        saved = min(self.finished - self.started, needed - self.started)
+        speculation_stats.add(requests=1, used=1, saved_seconds=saved)
+        return embedding_distances
+
+    def cancel(self):
+        """Stop retrieving if it's still running, and retrieve any error so it isn't logged as never retrieved."""
+        self.task.cancel()
+        self.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+
 class SystemMessage:
     """Wraps messages to generate a system message."""
 
-    embeddings = openai.Embedding.load_list('embeddings.json')
+    index = openai.EmbeddingIndex.load(settings.EMBEDDINGS_FILE)
+    fingerprint = prompt_fingerprint(index)  # what this worker's prompts are built from, cached answers too
+    precomputed = PrecomputedPrompts.load(fingerprint)
+    answers = answer_cache.AnswerCache(
+        max_entries=settings.ANSWER_CACHE_SIZE,
+        ttl=settings.ANSWER_CACHE_TTL,
+        max_dist=settings.ANSWER_CACHE_MAX_DIST,
+    )
 
-    def __init__(self, messages, user_content, dummy=settings.USE_DUMMY_SYSTEM_MESSAGE):
+    def __init__(self, messages, user_content, dummy=settings.USE_DUMMY_SYSTEM_MESSAGE, trace=None):
         self.messages = messages
         self.user_content = user_content
         self.dummy = dummy
+        self.trace = trace  # see tracing.py
+        self.question = None  # embedding of a first-turn question, which its answer is cached by
+        self.cached = None  # the `CachedAnswer` to replay instead of asking gpt-4o, if any
+
+    @staticmethod
+    def build(embedding_distances):
+        """Assemble the system message from the style guide and the nearest knowledge."""
+        embedded_knowledge = '\n'.join([d.e2.content for d in embedding_distances])
+        return f'{resources.STYLE}\n\n#Knowledge\n{embedded_knowledge}'
+
+    def has_prior_turns(self):
+        """Whether the user said anything before the question being answered."""
+        return sum(1 for m in self.messages if m.role == "user" and m.content) > 1
+
+    def get_precomputed(self):
+        """
+        The precomputed prompt for the user's question, if it is one of the fixed
+        questions and either starts the conversation or is an exact (e.g., pill) match.
+        """
+        precomputed = self.precomputed.lookup(self.user_content)
+        if precomputed is None:
+            return None
+        if not self.has_prior_turns() or self.user_content.strip() == precomputed.question:
+            return precomputed
+        return None
+
+    def remember(self, system, answer):
+        """Cache the answer to a first-turn question, unless it was itself replayed from the cache."""
+        if self.question is not None and self.cached is None:
+            self.answers.put(self.question, self.fingerprint, system, answer)
 
     async def generate(self):
         """
@@ -232,30 +512,72 @@ class SystemMessage:
             await asyncio.sleep(2)  # fake delay for testing
             return "DUMMY SYSTEM MESSAGE"
 
+        if self.trace:
+            tracing.current.set(self.trace)  # this runs as its own task, so only it (and its children) see it
+
+        precomputed = self.get_precomputed()
+        if not self.has_prior_turns() and self.answers.enabled:
+            with tracing.span('answer_cache', self.trace):
+                if precomputed:
+                    self.question = precomputed.embedding
+                else:
+                    self.question = await openai.query_cache.async_gen(self.user_content)
+                self.cached = self.answers.lookup(self.question, self.fingerprint)
+            if self.cached:
+                return self.cached.system
+
+        if precomputed:
+            _logger.debug(f'Using precomputed system message for: {precomputed.question}.')
+            return precomputed.system
+
         system_gen_prompt = (
             "Restate the user's question to include the context of the conversation:\n" +
             f"{self.messages.to_system_gen()}"
         )
 
-        contextualized_user_question = await openai.async_get_completion(
-            messages=[
-                {
-                    'role': 'system',
-                    'content': 'You are a helpful assistant.',
-                },
-                {
-                    'role': 'user',
-                    'content': (
-                        "Rephrase the user's question to make sense in the conversation context. Only " +
-                        "respond with the new question." +
-                        f"\n\nCONVERSATION:\n\n{self.messages.to_system_gen()}\nuser :: {self.user_content}"
+        # retrieve for the question as asked while it gets rephrased, often that's all we need
+        speculative = SpeculativeRetrieval(self.user_content, self.index) if settings.SPECULATIVE_RETRIEVAL else None
+        try:
+            if speculative and not self.has_prior_turns():
+                # nothing to put the question in the context of, so no rephrase to wait for
+                embedding_distances = await speculative.result(no_prior_turns=True)
+            else:
+                rephrase_started = time.perf_counter()
+                with tracing.span('rephrase', self.trace):
+                    contextualized_user_question = await openai.async_get_completion(
+                        messages=[
+                            {
+                                'role': 'system',
+                                'content': 'You are a helpful assistant.',
+                            },
+                            {
+                                'role': 'user',
+                                'content': (
+                                    "Rephrase the user's question to make sense in the conversation context. Only " +
+                                    "respond with the new question." +
+                                    f"\n\nCONVERSATION:\n\n{self.messages.to_system_gen()}\nuser :: {self.user_content}"
+                                )
+                            }
+                        ],
+                        model='gpt-4o',
                     )
-                }
-            ],
-            model='gpt-4o',
-        )
-        _logger.debug(f'Original user question: {self.user_content}.')
-        _logger.debug(f'Contextualized user quesiton: {contextualized_user_question}.')
+                speculation_stats.add(rephrases=1, rephrase_seconds=time.perf_counter() - rephrase_started)
+                _logger.debug(f'Original user question: {self.user_content}.')
+                _logger.debug(f'Contextualized user quesiton: {contextualized_user_question}.')
+
+                if speculative and speculative.matches(contextualized_user_question):
+                    embedding_distances = await speculative.result()
+                else:
+                    embedding_distances = await openai.async_k_nearest(
+                        content=contextualized_user_question,
+                        embeddings=self.index,
+                        k=20,
+                    )
+                    if speculative:
+                        speculation_stats.add(requests=1, wasted=1)
+        finally:
+            if speculative:
+                speculative.cancel()
 
         """
         hallucination_stopper = await openai.async_get_completion(
@@ -278,18 +600,12 @@ class SystemMessage:
         )
         _logger.debug(f'Hallucination stopper: {hallucination_stopper}.')"""
 
-        embedding_distances = [d for d in openai.k_nearest(
-            content=contextualized_user_question,
-            embeddings=self.embeddings,
-            k=20,
-        ) if d.dist < 0.64]
-        _logger.debug(f'''Found k-nearest embedding distances: {[
+        _logger.debug('Found k-nearest embedding distances: %s.', logger.Lazy(lambda: [
             (d.e2.content, d.dist)
             for d in embedding_distances
-        ]}.''')
+        ]))
 
-        embedded_knowledge = '\n'.join([d.e2.content for d in embedding_distances])
-        return f'{resources.STYLE}\n\n#Knowledge\n{embedded_knowledge}'
+        return self.build(embedding_distances)
 
 
 
@@ -0,0 +1,56 @@
+"""
+Precompute the query embedding, nearest knowledge and system prompt for every
+suggestion pill and starter, so that submitting one of them skips the rephrase
+and embedding round-trips at request time:
+
+    python src/precompute_prompts.py
+
+Re-run this whenever style.md, starters.md, the pills, or the knowledge
+embeddings change, stale prompts are ignored by the app.
+"""
+
+import json
+import resources
+import settings
+from apis import openai
+from models import DisplayPills, SystemMessage
+
+
+def questions():
+    """The pill questions followed by each starter line, without duplicates."""
+    starters = [
+        line.strip().lstrip("*").strip()
+        for line in (resources.STARTERS or "").splitlines()
+    ]
+    unique = {}
+    for question in DisplayPills.PILLS + [s for s in starters if s]:
+        unique.setdefault(openai.EmbeddingCache.normalize(question), question)
+    return list(unique.values())
+
+
+def precompute():
+    """Build and save the precomputed prompts, returning how many were written."""
+    question_list = questions()
+    embeddings = openai.Embedding.gen_list(question_list)
+    for embedding in embeddings:
+        # warm the shared query cache too, for near-identical questions asked later
+        openai.query_cache.put(embedding.content, openai.EMBEDDING_MODEL, embedding.vector)
+
+    nearest = SystemMessage.index.query_batch(embeddings, k=20)
+    prompts = [
+        {
+            "question": question,
+            "knowledge": [{"content": d.e2.content, "dist": d.dist} for d in distances],
+            "system": SystemMessage.build(distances),
+        }
+        for question, distances in zip(question_list, nearest)
+    ]
+
+    openai.Embedding.save_list(embeddings, settings.PRECOMPUTED_VECTORS_FILE)
+    with open(f"{settings.LOCAL_RESOURCE_DIR}/{settings.PRECOMPUTED_PROMPTS_FILE}", "w") as file:
+        json.dump({"fingerprint": SystemMessage.fingerprint, "prompts": prompts}, file, indent=2)
+    return len(prompts)
+
+
+if __name__ == "__main__":
+    print(f"Precomputed {precompute()} prompts.")
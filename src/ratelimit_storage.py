@@ -0,0 +1,91 @@
+"""
+Rate limit storage shared by every worker process on the host, for `flask_limiter`:
+
+    fl.Limiter(..., storage_uri="sqlite:///data/cache/limits.sqlite3")
+
+Importing this module registers the `sqlite` scheme with `limits`. Counters live in one
+SQLite table in WAL mode, and each hit is a single upsert, so a check costs one short
+write transaction instead of a round trip to an external service.
+"""
+
+import sqlite3
+import time
+from limits.storage import Storage
+import logger
+from local_sqlite import ThreadLocalConnection
+
+_logger = logger.get_logger(__name__)
+
+
+class SqliteStorage(Storage):
+    """Fixed-window rate limit counters in an SQLite database, keyed on the limit key."""
+
+    STORAGE_SCHEME = ["sqlite"]
+    PURGE_INTERVAL = 60.0  # seconds between deleting expired counters, per process
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        # sqlite:///relative/path or sqlite:////absolute/path, as in sqlalchemy
+        self.path = uri[len("sqlite:///"):] if uri else ":memory:"
+        self._db = ThreadLocalConnection(
+            self.path,
+            self._create_tables,
+            synchronous="OFF",  # losing the last few hits in a power cut is fine
+            isolation_level=None,  # autocommit, one statement per hit
+        )
+        self._purged_at = time.monotonic()
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def connection(self):
+        return self._db.get()
+
+    @staticmethod
+    def _create_tables(db):
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS limits (key TEXT PRIMARY KEY, count INTEGER NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        db = self.connection()
+        (count,) = db.execute(
+            """
+            INSERT INTO limits (key, count, expires_at) VALUES (:key, :amount, :expires_at)
+            ON CONFLICT (key) DO UPDATE SET
+                count = CASE WHEN expires_at <= :now THEN :amount ELSE count + :amount END,
+                expires_at = CASE WHEN expires_at <= :now OR :elastic THEN :expires_at ELSE expires_at END
+            RETURNING count
+            """,
+            {"key": key, "amount": amount, "now": now, "expires_at": now + expiry, "elastic": elastic_expiry},
+        ).fetchone()
+        if time.monotonic() - self._purged_at > self.PURGE_INTERVAL:
+            self._purged_at = time.monotonic()
+            db.execute("DELETE FROM limits WHERE expires_at <= ?", (now,))
+        return count
+
+    def get(self, key):
+        row = self.connection().execute(
+            "SELECT count FROM limits WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self.connection().execute("SELECT expires_at FROM limits WHERE key = ?", (key,)).fetchone()
+        return int(row[0] if row else time.time())
+
+    def check(self):
+        try:
+            self.connection().execute("SELECT 1")
+            return True
+        except sqlite3.Error as e:
+            _logger.error(f"Rate limit storage is unhealthy: {e}.")
+            return False
+
+    def reset(self):
+        return self.connection().execute("DELETE FROM limits").rowcount
+
+    def clear(self, key):
+        self.connection().execute("DELETE FROM limits WHERE key = ?", (key,))
@@ -0,0 +1,171 @@
+"""
+Bounded, write-behind LRU cache of live objects (i.e., `models.Messages`) per worker.
+Reads are served from memory, and writes only mark an entry dirty: dirty entries are
+flushed to storage by a background timer, when they are evicted, and at shutdown.
+"""
+
+import atexit
+import dataclasses
+import os
+import threading
+import time
+from collections import OrderedDict
+import logger
+
+_logger = logger.get_logger(__name__)
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    flushes: int = 0
+    flush_errors: int = 0
+    flush_seconds: float = 0.0  # total, divide by flushes for the mean
+    max_flush_seconds: float = 0.0
+
+
+class WriteBehindCache:
+    """
+    Maps ids to live objects, flushing dirty ones with `flush(obj)`. Every `mark_dirty`
+    bumps a version, and an entry is only considered clean again if nothing marked it
+    dirty while it was being flushed, so concurrent writers never lose an update.
+    """
+
+    def __init__(self, flush, max_entries, flush_interval, name="write-behind-cache"):
+        self.flush = flush
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.name = name
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._dirty = {}  # id -> version
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def __contains__(self, id):
+        """Whether `id` is cached, without counting as a hit or a use."""
+        with self._lock:
+            return id in self._entries
+
+    def get(self, id):
+        with self._lock:
+            obj = self._entries.get(id)
+            if obj is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(id)
+            self.stats.hits += 1
+            return obj
+
+    def put(self, id, obj):
+        """Cache `obj`, returning whichever object is now cached for `id` (an earlier one wins)."""
+        with self._lock:
+            existing = self._entries.get(id)
+            if existing is not None:
+                self._entries.move_to_end(id)
+                return existing
+            self._entries[id] = obj
+            evicted = self._evict()
+        self._flush_evicted(evicted)
+        return obj
+
+    def mark_dirty(self, id, obj):
+        """
+        Schedule `obj` to be flushed, caching it if it isn't already. If another object
+        was cached for `id` meanwhile (i.e., `obj` was evicted while still in use), `obj`
+        is flushed right away instead so its writes aren't lost.
+        """
+        if self.put(id, obj) is not obj:
+            self._flush(id, None, obj)
+            return
+        with self._lock:
+            self._dirty[id] = self._dirty.get(id, 0) + 1
+        self._ensure_thread()
+
+    def discard(self, id):
+        """Forget `id` without flushing it, e.g. because it was deleted."""
+        with self._lock:
+            self._entries.pop(id, None)
+            self._dirty.pop(id, None)
+
+    def flush_all(self):
+        """Flush every dirty entry now."""
+        with self._lock:
+            dirty = [(id, version, self._entries.get(id)) for id, version in self._dirty.items()]
+        for id, version, obj in dirty:
+            if obj is not None:
+                self._flush(id, version, obj)
+
+    def _flush(self, id, version, obj):
+        start_time = time.perf_counter()
+        try:
+            self.flush(obj)
+        except Exception as e:
+            with self._lock:
+                self.stats.flush_errors += 1
+            _logger.error(f"Failed to flush {id} from the {self.name}: {e}.")
+            return False
+        elapsed = time.perf_counter() - start_time
+        with self._lock:
+            self.stats.flushes += 1
+            self.stats.flush_seconds += elapsed
+            self.stats.max_flush_seconds = max(self.stats.max_flush_seconds, elapsed)
+            if self._dirty.get(id) == version:
+                del self._dirty[id]
+        return True
+
+    def _evict(self):
+        """Drop least recently used entries past the size limit, must hold the lock."""
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            id, obj = self._entries.popitem(last=False)
+            self.stats.evictions += 1
+            version = self._dirty.get(id)
+            if version is not None:
+                evicted.append((id, version, obj))
+        return evicted
+
+    def _flush_evicted(self, evicted):
+        for id, version, obj in evicted:
+            if not self._flush(id, version, obj):
+                # keep it around rather than losing the writes, the timer will retry
+                with self._lock:
+                    self._entries.setdefault(id, obj)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()  # a forked worker needs its own flusher thread
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush_all()
+
+    def stop(self):
+        """Stop the flusher and write out everything still dirty, e.g. at shutdown."""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush_all()
+        _logger.debug(f"Stopped the {self.name}: {self.stats}.")
+
+    def register_shutdown(self):
+        atexit.register(self.stop)
+        return self
@@ -32,7 +32,98 @@ else:
     # use local secrets for development
     from _dev_secrets import FLASK_SECRET_KEY, OPENAI_API_KEY
 
+# Log records are written by a background thread (see logger.py), as json lines in production
+LOG_QUEUE = True
+LOG_FORMAT = "json" if IS_PROD else "color"
+
 
 SESSION_MESSAGES_KEY = "sambot-messages"
-LOCAL_MESSAGES_DIR = "data/messages"
+LOCAL_MESSAGES_DIR = "data/messages"  # used by the json messages backend
+MESSAGES_DB_PATH = "data/messages.sqlite3"  # used by the sqlite messages backend
+MESSAGES_BACKEND = "json"  # see storage.py, run migrate_messages.py before switching to "sqlite"
 LOCAL_RESOURCE_DIR = "data/resources"
+LOCAL_CACHE_DIR = "data/cache"
+EMBEDDINGS_FILE = "embeddings.bin"  # inside LOCAL_RESOURCE_DIR, see convert_embeddings.py
+PRECOMPUTED_PROMPTS_FILE = "prompts.json"  # inside LOCAL_RESOURCE_DIR, see precompute_prompts.py
+PRECOMPUTED_VECTORS_FILE = "prompts.bin"
+
+# Markdown sources chunked and embedded by ingest_knowledge.py, into versioned stores in KNOWLEDGE_DIR
+# (set EMBEDDINGS_FILE to "knowledge/current.bin" to answer from them)
+KNOWLEDGE_SOURCES = ["info.md"]  # inside LOCAL_RESOURCE_DIR
+KNOWLEDGE_DIR = "knowledge"  # inside LOCAL_RESOURCE_DIR
+KNOWLEDGE_CHUNK_CHARS = 400  # longest chunk, paragraphs and list items are split between sentences
+KNOWLEDGE_KEEP_VERSIONS = 5
+
+# Turn the rate limits off (SAMBOT_RATELIMIT_ENABLED=0) for load tests, see benchmarks/load_test.py
+RATELIMIT_ENABLED = os.getenv("SAMBOT_RATELIMIT_ENABLED", "1") != "0"
+
+# Rate limit counters shared by all workers on the host, see ratelimit_storage.py ("memory://" for per-worker)
+RATELIMIT_STORAGE_URI = f"sqlite:///{LOCAL_CACHE_DIR}/limits.sqlite3"
+
+# Knowledge embeddings further than this from the user's question are left out of the system prompt
+KNOWLEDGE_MAX_DIST = 0.64
+
+# Large knowledge bases are searched through an ivf index built by build_ann_index.py, which scans the
+# nearest NPROBE lists of vectors per question: more is slower but finds more of the true nearest
+KNOWLEDGE_IVF_NPROBE = 16
+KNOWLEDGE_EXACT_SEARCH = False  # scan every vector even when there is an ivf index
+
+# Knowledge is retrieved for the question as asked while gpt rephrases it in the conversation's context,
+# and kept if the rephrased question is at least this similar (Levenshtein ratio, 0 to 1)
+SPECULATIVE_RETRIEVAL = True
+SPECULATIVE_MIN_SIMILARITY = 0.85
+
+# Answers to first-turn questions are cached per worker and replayed for questions whose embedding is
+# this close to one answered before, see answer_cache.py. Set the size to 0 to always ask gpt-4o.
+ANSWER_CACHE_SIZE = 256  # answers
+ANSWER_CACHE_TTL = 24 * 60 * 60  # seconds
+ANSWER_CACHE_MAX_DIST = 0.2
+
+# Query embeddings are cached in memory per worker, and on disk for all workers on the host
+EMBEDDING_CACHE_PATH = f"{LOCAL_CACHE_DIR}/embeddings.sqlite3"
+EMBEDDING_CACHE_MEMORY_ENTRIES = 512
+EMBEDDING_CACHE_DISK_BYTES = 64 * 1024 * 1024
+
+# Knowledge embeddings are generated in batches, with several requests in flight
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_CONCURRENCY = 4
+EMBEDDING_MAX_RETRIES = 5
+
+# Where openai is reached, e.g. "http://127.0.0.1:8765/v1" for apis/openai/fake_server.py (None for openai)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+
+# Async openai calls share one pooled connection per event loop
+OPENAI_CONNECT_TIMEOUT = 5.0  # seconds
+OPENAI_READ_TIMEOUT = 60.0
+OPENAI_MAX_CONNECTIONS = 256  # also bounds the answers streaming at once per event loop
+OPENAI_MAX_CONCURRENCY = 32  # calls starting (or, unless streamed, in flight) per event loop
+
+# Upstream tokens are flushed to the client in batches, every window or once enough text is waiting
+STREAM_COALESCE_WINDOW = 0.04  # seconds, 0 to send every token as its own frame
+STREAM_COALESCE_MAX_CHARS = 48
+
+# Conversation history sent to gpt is cut to the latest turns that fit this many (estimated)
+# tokens, on top of the system message. 0 sends the whole conversation.
+GPT_HISTORY_TOKEN_BUDGET = 3000
+
+# Time each stage of a request, for the Server-Timing header, the done event and /metrics
+TRACING_ENABLED = True
+
+# /metrics is only served to scrapers sending "Authorization: Bearer <token>", and not at all if unset
+METRICS_TOKEN = os.getenv("SAMBOT_METRICS_TOKEN")
+
+# Live conversations can be cached per worker and written to the messages backend behind the request.
+# A worker flushing its stale copy would overwrite turns another worker saved meanwhile, so this is off
+# (every save writes through) unless a single worker serves all requests of a conversation, e.g. with
+# SAMBOT_MESSAGES_CACHE_SIZE=1024 under `uvicorn ... --workers 1`.
+MESSAGES_CACHE_SIZE = int(os.getenv("SAMBOT_MESSAGES_CACHE_SIZE", "0"))  # conversations, 0 to write through
+MESSAGES_FLUSH_INTERVAL = 1.0  # seconds
+
+# Conversations idle for longer than the TTL are swept, see sweep_messages.py
+MESSAGES_TTL = 30 * 24 * 60 * 60  # seconds
+MESSAGES_SWEEP_INTERVAL = 60 * 60  # seconds between sweeps in each worker, 0 to only sweep by hand
+MESSAGES_SWEEP_BATCH_SIZE = 500
+MESSAGES_ARCHIVE_DIR = None  # e.g. "data/archive" to keep swept conversations as gzipped json lines
+
+# Rendered html of finished messages is cached per worker, see fragments.py
+FRAGMENT_CACHE_BYTES = 8 * 1024 * 1024
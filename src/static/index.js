@@ -54,24 +54,44 @@ document.addEventListener("DOMContentLoaded", () => {
         disableSubmission();
 
         const source = new EventSource('/submit?user_content=' + userContent);
-        source.onmessage = function(event) {
-            if (event.data === 'STOP'){
-                location.reload(true);  // reload the page to generate pills... TODO: this is a hack
-                scrollToBottom();
-                source.close();
-                enableSubmission();
-            } else {
-                const parser = new DOMParser();
-                const doc = parser.parseFromString(event.data, 'text/html');
-                const newContent = doc.body.innerHTML;  // assumes stream data wrapped in body
-                messagesContainer.innerHTML = newContent;
-                scrollToBottom();
+        let lastContent = '';  // raw content of the last message, which deltas apply to
+
+        function setLastMessage(content) {
+            lastContent = content;
+            const lastMessage = messagesContainer.lastElementChild;
+            if (lastMessage) {
+                lastMessage.innerHTML = lastContent;
             }
-        };
-        source.onerror = function(event) {
-            console.error("Error occurred in the EventSource stream:", event);
+            scrollToBottom();
+        }
+
+        // full render of the conversation, sent first and again when reconnecting
+        source.addEventListener('render', function(event) {
+            const data = JSON.parse(event.data);
+            const parser = new DOMParser();
+            const doc = parser.parseFromString(data.html, 'text/html');
+            messagesContainer.innerHTML = doc.body.innerHTML;  // assumes stream data wrapped in body
+            lastContent = data.last;
+            scrollToBottom();
+        });
+        source.addEventListener('append', function(event) {
+            setLastMessage(lastContent + JSON.parse(event.data).text);
+        });
+        source.addEventListener('replace-last', function(event) {
+            setLastMessage(JSON.parse(event.data).text);
+        });
+        source.addEventListener('done', function(event) {
+            location.reload(true);  // reload the page to generate pills... TODO: this is a hack
+            scrollToBottom();
             source.close();
             enableSubmission();
+        });
+        source.onerror = function(event) {
+            // the browser reconnects by itself unless the stream is closed for good
+            if (source.readyState === EventSource.CLOSED) {
+                console.error("Error occurred in the EventSource stream:", event);
+                enableSubmission();
+            }
         };
     }
 
@@ -0,0 +1,273 @@
+"""
+Storage backends behind `models.Messages`. A backend persists a conversation as a
+list of `{"role": ..., "content": ...}` rows keyed by conversation id, with a small
+json-able `meta` dict of what `Messages` derives from the rows (opaque to the backend).
+"""
+
+import abc
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+import settings
+import logger
+from local_sqlite import ThreadLocalConnection
+
+_logger = logger.get_logger(__name__)
+
+Row = Dict[str, str]
+Meta = Dict[str, Any]
+
+
+class Stored(NamedTuple):
+    rows: List[Row]
+    meta: Meta  # empty for conversations stored before there was any
+
+
+class MessagesBackend(abc.ABC):
+    """Interface every messages storage backend implements."""
+
+    @abc.abstractmethod
+    def create(self, id: str, rows: List[Row], meta: Meta) -> None:
+        """Store a new conversation."""
+
+    @abc.abstractmethod
+    def load(self, id: str) -> Optional[Stored]:
+        """
+        The rows and meta of a conversation, or None if it doesn't exist. Raises `ValueError`
+        if the stored conversation can't be decoded.
+        """
+
+    @abc.abstractmethod
+    def save(self, id: str, rows: List[Row], start: int, changed: Dict[int, Row], meta: Meta) -> None:
+        """
+        Persist `rows` and replace `meta`, where `rows[start:]` are new since the last save
+        and `changed` holds the earlier rows that were replaced since then. Backends that
+        can't write partially are free to ignore the hints and write every row. A conversation
+        that doesn't exist (e.g., it was swept while a worker still held it) is stored whole.
+        """
+
+    @abc.abstractmethod
+    def delete(self, id: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def iter_idle(self, before: float, batch_size: int) -> Iterator[List[str]]:
+        """
+        Batches of ids of the conversations not updated since the `before` timestamp.
+        Each batch is read separately, so deleting between batches is fine.
+        """
+
+    @abc.abstractmethod
+    def delete_idle(self, ids: List[str], before: float) -> int:
+        """
+        Delete those of `ids` that still haven't been updated since `before` (i.e., not
+        if someone came back meanwhile), returning how many were deleted.
+        """
+
+
+class JsonMessagesBackend(MessagesBackend):
+    """One JSON document per conversation in a flat directory, re-written on every save. The default."""
+
+    def __init__(self, directory: str = settings.LOCAL_MESSAGES_DIR):
+        self.directory = directory
+
+    def filename(self, id: str) -> str:
+        """The filename for storing a messages object with the given id."""
+        return f"{self.directory}/msg-{id}.json"
+
+    def _write(self, id: str, rows: List[Row], meta: Meta) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.filename(id), "w") as file:
+            json.dump({"id": id, "initlist": rows, "meta": meta}, file)
+
+    def create(self, id, rows, meta):
+        self._write(id, rows, meta)
+
+    def load(self, id):
+        try:
+            with open(self.filename(id), "r") as file:
+                document = json.load(file)
+        except FileNotFoundError:
+            return None
+        except json.decoder.JSONDecodeError as e:
+            raise ValueError(e.args) from e
+        return Stored(document["initlist"], document.get("meta", {}))
+
+    def save(self, id, rows, start, changed, meta):
+        self._write(id, rows, meta)
+
+    def delete(self, id):
+        os.remove(self.filename(id))
+
+    def iter_idle(self, before, batch_size):
+        batch = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not (entry.name.startswith("msg-") and entry.name.endswith(".json")):
+                        continue
+                    try:
+                        if entry.stat().st_mtime >= before:
+                            continue
+                    except FileNotFoundError:
+                        continue  # deleted since it was listed
+                    batch.append(entry.name[len("msg-"):-len(".json")])
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+        except FileNotFoundError:
+            pass  # nothing was ever saved
+        if batch:
+            yield batch
+
+    def delete_idle(self, ids, before):
+        deleted = 0
+        for id in ids:
+            try:
+                if os.stat(self.filename(id)).st_mtime < before:
+                    os.remove(self.filename(id))
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+
+class SqliteMessagesBackend(MessagesBackend):
+    """
+    All conversations in one SQLite database in WAL mode, with one row per message,
+    so a save only inserts the new turns (and updates the few rows that changed).
+    """
+
+    def __init__(self, path: str = settings.MESSAGES_DB_PATH):
+        self.path = path
+        self._db = ThreadLocalConnection(path, self._create_tables, timeout=10)
+
+    def connection(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    @staticmethod
+    def _create_tables(db: sqlite3.Connection) -> None:
+        db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                meta TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                conversation_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (conversation_id, position)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at, id);
+            """
+        )
+        if "meta" not in [column[1] for column in db.execute("PRAGMA table_info(conversations)")]:
+            # created before conversations had meta
+            db.execute("ALTER TABLE conversations ADD COLUMN meta TEXT NOT NULL DEFAULT '{}'")
+
+    def create(self, id, rows, meta, created_at=None):
+        now = time.time()
+        with self.connection() as db:
+            db.execute(
+                "INSERT INTO conversations (id, created_at, updated_at, meta) VALUES (?, ?, ?, ?)",
+                (id, created_at or now, now, json.dumps(meta)),
+            )
+            self._insert(db, id, rows, start=0)
+
+    def load(self, id):
+        db = self.connection()
+        found = db.execute("SELECT meta FROM conversations WHERE id = ?", (id,)).fetchone()
+        if found is None:
+            return None
+        rows = [
+            {"role": role, "content": content}
+            for role, content in db.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY position",
+                (id,),
+            )
+        ]
+        try:
+            return Stored(rows, json.loads(found[0]))
+        except json.decoder.JSONDecodeError as e:
+            raise ValueError(e.args) from e
+
+    def save(self, id, rows, start, changed, meta):
+        now = time.time()
+        with self.connection() as db:
+            if db.execute(
+                "UPDATE conversations SET updated_at = ?, meta = ? WHERE id = ?", (now, json.dumps(meta), id)
+            ).rowcount == 0:
+                # gone (e.g., swept meanwhile), so store it whole rather than leave orphaned message rows
+                db.execute(
+                    "INSERT INTO conversations (id, created_at, updated_at, meta) VALUES (?, ?, ?, ?)",
+                    (id, now, now, json.dumps(meta)),
+                )
+                db.execute("DELETE FROM messages WHERE conversation_id = ?", (id,))
+                self._insert(db, id, rows, start=0)
+                return
+            db.executemany(
+                "UPDATE messages SET role = ?, content = ? WHERE conversation_id = ? AND position = ?",
+                [(row["role"], row["content"], id, position) for position, row in changed.items()],
+            )
+            # anything past the end of the new rows was removed since the last save
+            db.execute(
+                "DELETE FROM messages WHERE conversation_id = ? AND position >= ?", (id, len(rows))
+            )
+            self._insert(db, id, rows[start:], start=start)
+
+    def delete(self, id):
+        with self.connection() as db:
+            db.execute("DELETE FROM messages WHERE conversation_id = ?", (id,))
+            db.execute("DELETE FROM conversations WHERE id = ?", (id,))
+
+    def iter_idle(self, before, batch_size):
+        # keyset pagination, so no read transaction stays open between batches
+        cursor = (float("-inf"), "")
+        while True:
+            rows = self.connection().execute(
+                "SELECT updated_at, id FROM conversations WHERE updated_at < ? AND (updated_at, id) > (?, ?) "
+                + "ORDER BY updated_at, id LIMIT ?",
+                (before, *cursor, batch_size),
+            ).fetchall()
+            if not rows:
+                return
+            cursor = rows[-1]
+            yield [id for _, id in rows]
+
+    def delete_idle(self, ids, before):
+        placeholders = ", ".join("?" * len(ids))
+        with self.connection() as db:
+            db.execute(
+                "DELETE FROM messages WHERE conversation_id IN ("
+                + f"SELECT id FROM conversations WHERE id IN ({placeholders}) AND updated_at < ?)",
+                (*ids, before),
+            )
+            return db.execute(
+                f"DELETE FROM conversations WHERE id IN ({placeholders}) AND updated_at < ?", (*ids, before)
+            ).rowcount
+
+    @staticmethod
+    def _insert(db, id, rows, start):
+        db.executemany(
+            "INSERT OR REPLACE INTO messages (conversation_id, position, role, content) VALUES (?, ?, ?, ?)",
+            [(id, start + i, row["role"], row["content"]) for i, row in enumerate(rows)],
+        )
+
+
+BACKENDS = {
+    "json": JsonMessagesBackend,
+    "sqlite": SqliteMessagesBackend,
+}
+
+
+def get_backend(name: str = settings.MESSAGES_BACKEND) -> MessagesBackend:
+    try:
+        return BACKENDS[name]()
+    except KeyError as e:
+        raise settings.ConfigurationError(f"Unknown messages backend: {name}.") from e
@@ -0,0 +1,100 @@
+"""Helpers for the `/submit` token stream between openai and the server-side-events."""
+
+import asyncio
+import dataclasses
+import settings
+import tracing
+
+
+@dataclasses.dataclass
+class StreamStats(tracing.Counters):
+    """Running totals for every `/submit` stream this worker has sent."""
+
+    responses: int = 0
+    tokens: int = 0  # chunks received from upstream
+    chunks: int = 0  # chunks after coalescing
+    frames: int = 0  # server-side-events sent
+    bytes: int = 0
+
+    def frames_per_response(self):
+        return self.frames / self.responses if self.responses else 0.0
+
+
+stream_stats = StreamStats()
+
+
+async def coalesce_tokens(
+    tokens,
+    window=settings.STREAM_COALESCE_WINDOW,
+    max_chars=settings.STREAM_COALESCE_MAX_CHARS,
+):
+    """
+    Re-chunk an async token generator, so each chunk becomes one `Messages` update,
+    render and frame instead of one per upstream token. The first token is passed
+    straight through (so time-to-first-token doesn't suffer), after that tokens are
+    buffered until `window` seconds have passed since the first buffered token or
+    `max_chars` characters are waiting, whichever comes first.
+    """
+    if window <= 0:
+        async for token in tokens:
+            stream_stats.add(tokens=1, chunks=1)
+            yield token
+        return
+
+    loop = asyncio.get_running_loop()
+    buffer, size, deadline = [], 0, None
+    first = True
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(tokens.__anext__())
+            timeout = None if not buffer else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait([pending], timeout=timeout)
+            if not done:
+                # window elapsed while waiting on upstream, flush what we have
+                stream_stats.add(chunks=1)
+                yield "".join(buffer)
+                buffer, size = [], 0
+                continue
+
+            try:
+                token = pending.result()
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+            stream_stats.add(tokens=1)
+
+            if first:
+                first = False
+                stream_stats.add(chunks=1)
+                yield token
+                continue
+            if not buffer:
+                deadline = loop.time() + window
+            buffer.append(token)
+            size += len(token)
+            if size >= max_chars or loop.time() >= deadline:
+                stream_stats.add(chunks=1)
+                yield "".join(buffer)
+                buffer, size = [], 0
+
+        if buffer:
+            stream_stats.add(chunks=1)
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await tokens.aclose()
+
+
+def coalesced(string_gen):
+    """Wrap a string generator function (see app.py) so its tokens go through `coalesce_tokens`."""
+
+    async def coalesced_string_gen(messages):
+        async for chunk in coalesce_tokens(string_gen(messages)):
+            yield chunk
+
+    return coalesced_string_gen
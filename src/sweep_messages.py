@@ -0,0 +1,122 @@
+"""
+Delete (or archive, then delete) conversations nobody has touched in a while:
+
+    python src/sweep_messages.py [--ttl SECONDS] [--archive DIR]
+
+Every worker also sweeps in a background thread, see `settings.MESSAGES_SWEEP_INTERVAL`.
+The store is scanned in batches with a short pause between them, so a sweep never holds
+the database (or the GIL) for long, and conversations cached by the worker are skipped.
+"""
+
+import argparse
+import dataclasses
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+import settings
+import storage
+import logger
+
+_logger = logger.get_logger(__name__)
+
+
+@dataclasses.dataclass
+class SweepStats:
+    scanned: int = 0
+    deleted: int = 0
+    archived: int = 0
+    skipped: int = 0  # live in this worker's cache
+
+
+class Sweeper:
+    """Sweeps the conversations in `backend` that have been idle for longer than `ttl` seconds."""
+
+    def __init__(
+        self,
+        backend,
+        ttl=settings.MESSAGES_TTL,
+        batch_size=settings.MESSAGES_SWEEP_BATCH_SIZE,
+        archive_dir=settings.MESSAGES_ARCHIVE_DIR,
+        is_live=lambda id: False,
+        pause=0.05,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.archive_dir = archive_dir
+        self.is_live = is_live
+        self.pause = pause
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def sweep(self, now=None):
+        """Sweep every idle conversation once."""
+        before = (now or time.time()) - self.ttl
+        stats = SweepStats()
+        for batch in self.backend.iter_idle(before, self.batch_size):
+            stats.scanned += len(batch)
+            ids = [id for id in batch if not self.is_live(id)]
+            stats.skipped += len(batch) - len(ids)
+            if ids and self.archive_dir:
+                stats.archived += self.archive(ids)
+            if ids:
+                stats.deleted += self.backend.delete_idle(ids, before)
+            if self._stop.wait(self.pause):
+                break
+        return stats
+
+    def archive(self, ids):
+        """Append the conversations to today's archive, as one json line each."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = f"{self.archive_dir}/messages-{datetime.date.today().isoformat()}.jsonl.gz"
+        archived = 0
+        with gzip.open(path, "at", encoding="utf-8") as file:  # appending adds a gzip member, still one valid file
+            for id in ids:
+                try:
+                    stored = self.backend.load(id)
+                except ValueError as e:
+                    _logger.warning(f"Not archiving {id}, it could not be decoded: {e}.")
+                    continue
+                if stored is not None:
+                    file.write(json.dumps({"id": id, "initlist": stored.rows}) + "\n")
+                    archived += 1
+        return archived
+
+    def start(self, interval=settings.MESSAGES_SWEEP_INTERVAL):
+        """Sweep every `interval` seconds in a daemon thread, unless it's already running in this process."""
+        if not interval:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="messages-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                start_time = time.perf_counter()
+                stats = self.sweep()
+                _logger.info(f"Swept idle conversations in {time.perf_counter() - start_time:.2f}s: {stats}.")
+            except Exception as e:
+                _logger.error(f"Failed to sweep idle conversations: {e}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ttl", type=float, default=settings.MESSAGES_TTL, help="seconds idle before a conversation is swept")
+    parser.add_argument("--archive", default=settings.MESSAGES_ARCHIVE_DIR, help="archive swept conversations in this directory")
+    parser.add_argument("--batch-size", type=int, default=settings.MESSAGES_SWEEP_BATCH_SIZE)
+    args = parser.parse_args()
+    sweeper = Sweeper(storage.get_backend(), ttl=args.ttl, batch_size=args.batch_size, archive_dir=args.archive)
+    print(sweeper.sweep())
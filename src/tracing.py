@@ -0,0 +1,179 @@
+"""
+Lightweight per-request tracing on the monotonic clock. Each `/submit` gets a `Trace`
+whose spans (session load, rephrase, query embedding, k-nearest, first and last token,
+save) are sent back as a `Server-Timing` header and in the stream's done event, and are
+added to histograms served from `/metrics`: how long each stage took, and separately
+when each marked point (e.g., the first token) came after the request started.
+
+With `settings.TRACING_ENABLED` off no trace is created, and `span()` hands back one
+shared do-nothing context manager.
+"""
+
+import bisect
+import contextvars
+import dataclasses
+import threading
+import time
+import settings
+
+# the trace of the request being handled by this task, for code that isn't passed one (e.g., apis/openai)
+current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """The spans and marks of one request, as (stage, seconds) pairs."""
+
+    __slots__ = ("start", "spans", "marks", "finished")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.marks = []
+        self.finished = False
+
+    def span(self, stage):
+        return _Span(self, stage)
+
+    def mark(self, stage):
+        """Record a point in time (e.g., the first token) as the time since the request started."""
+        self.marks.append((stage, time.perf_counter() - self.start))
+
+    def server_timing(self):
+        """The spans and marks so far as a `Server-Timing` header value."""
+        spans = self.spans + self.marks + [("total", time.perf_counter() - self.start)]
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans)
+
+    def timings(self):
+        """The spans and marks so far in milliseconds, e.g. for the done event."""
+        return [[stage, round(seconds * 1000, 1)] for stage, seconds in self.spans + self.marks]
+
+    def finish(self):
+        """Add every span (and the total) to the stage histograms and every mark to the offset ones, once."""
+        if self.finished:
+            return
+        self.finished = True
+        for stage, seconds in self.spans:
+            observe(stage, seconds)
+        observe("total", time.perf_counter() - self.start)
+        for stage, seconds in self.marks:
+            observe(stage, seconds, metric=OFFSET_METRIC)
+
+
+class _Span:
+    __slots__ = ("trace", "stage", "start")
+
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.spans.append((self.stage, time.perf_counter() - self.start))
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def start():
+    """A new trace, or None if tracing is disabled."""
+    return Trace() if settings.TRACING_ENABLED else None
+
+
+def span(stage, trace=None):
+    """Time a block as `stage` of `trace` (or the current trace), if there is one."""
+    trace = trace or current.get()
+    return trace.span(stage) if trace is not None else NULL_SPAN
+
+
+def mark(stage, trace=None):
+    trace = trace or current.get()
+    if trace is not None:
+        trace.mark(stage)
+
+
+@dataclasses.dataclass
+class Counters:
+    """Base for dataclasses of running totals (e.g., `streaming.StreamStats`) that any thread adds to."""
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+class Histogram:
+    """Cumulative bucket counts in the Prometheus style."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def lines(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {total}"
+        yield f"{name}_count{{{labels}}} {count}"
+
+
+STAGE_METRIC = "sambot_stage_seconds"  # how long a stage took
+OFFSET_METRIC = "sambot_offset_seconds"  # when a mark came, after the request started
+
+histograms = {}  # (metric, stage) to its histogram
+_histograms_lock = threading.Lock()
+
+
+def observe(stage, seconds, metric=STAGE_METRIC):
+    histogram = histograms.get((metric, stage))
+    if histogram is None:
+        with _histograms_lock:
+            histogram = histograms.setdefault((metric, stage), Histogram())
+    histogram.observe(seconds)
+
+
+def prometheus(counters):
+    """
+    The stage and offset histograms and the given counters (a dict of metric name to a dict of
+    label-less values, e.g. `{"sambot_stream": {"frames": 12}}`) in the Prometheus text format.
+    """
+    lines = []
+    for metric in (STAGE_METRIC, OFFSET_METRIC):
+        lines.append(f"# TYPE {metric} histogram")
+        for (histogram_metric, stage), histogram in sorted(histograms.items()):
+            if histogram_metric == metric:
+                lines.extend(histogram.lines(metric, f'stage="{stage}"'))
+    for prefix, values in counters.items():
+        for name, value in values.items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {float(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,13 @@
+"""
+Shared setup for the tests. The app's modules are imported from src/ and, as when the
+app runs, from the repository root, since settings hold paths relative to it.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+os.chdir(ROOT)
+os.environ.setdefault("FLASK_SECRET_KEY", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
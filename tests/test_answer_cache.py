@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from answer_cache import AnswerCache
+from apis.openai import Embedding, EmbeddingIndex
+
+
+def question(content, *vector):
+    return Embedding(content, np.array(vector, dtype=np.float32))
+
+
+@pytest.fixture
+def cache():
+    return AnswerCache(max_entries=2, ttl=60, max_dist=0.2)
+
+
+def test_close_questions_share_an_answer(cache):
+    cache.put(question("Where are you from?", 1, 0), "fp", "system", "Oceanside.")
+    assert cache.lookup(question("where r u from", 0.95, 0.05), "fp").answer == "Oceanside."
+    assert cache.lookup(question("What do you do?", 0, 1), "fp") is None
+    assert (cache.stats.lookups, cache.stats.hits) == (2, 1)
+
+
+def test_answers_of_another_fingerprint_are_never_replayed(cache):
+    cache.put(question("q", 1, 0), "old", "system", "old answer")
+    assert cache.lookup(question("q", 1, 0), "new") is None
+    cache.put(question("q", 1, 0), "new", "system", "new answer")
+    assert cache.lookup(question("q", 1, 0), "old") is None
+    assert cache.lookup(question("q", 1, 0), "new").answer == "new answer"
+    assert cache.stats.invalidations == 1
+
+
+def test_oldest_answers_are_evicted(cache):
+    for i, vector in enumerate([(1, 0), (0, 1), (-1, 0)]):
+        cache.put(question(f"q{i}", *vector), "fp", "system", f"a{i}")
+    assert cache.lookup(question("q0", 1, 0), "fp") is None
+    assert cache.lookup(question("q2", -1, 0), "fp").answer == "a2"
+    assert cache.stats.evictions == 1
+
+
+def test_disabled_cache():
+    cache = AnswerCache(max_entries=0, ttl=60, max_dist=0.2)
+    cache.put(question("q", 1, 0), "fp", "system", "answer")
+    assert not cache.enabled
+    assert cache.lookup(question("q", 1, 0), "fp") is None
+
+
+def test_index_fingerprint():
+    embeddings = [Embedding(f"e{i}", v) for i, v in enumerate(np.eye(4, dtype=np.float32))]
+    assert EmbeddingIndex(embeddings).fingerprint() == EmbeddingIndex(list(embeddings)).fingerprint()
+    assert EmbeddingIndex(embeddings).fingerprint() != EmbeddingIndex(embeddings[1:]).fingerprint()
+    renamed = [Embedding("other", embeddings[0].vector)] + embeddings[1:]
+    assert EmbeddingIndex(embeddings).fingerprint() != EmbeddingIndex(renamed).fingerprint()
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from apis.openai import EmbeddingCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(path=str(tmp_path / "embeddings.sqlite3"), max_memory_entries=2, max_disk_bytes=1 << 20)
+
+
+def last_used(cache, content):
+    key = cache.key(content, "model")
+    return cache._connection().execute("SELECT last_used FROM embeddings WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_keys_are_normalized(cache):
+    cache.put("Where are you from?", "model", np.ones(4))
+    assert cache.get("  where ARE you   from? ", "model") is not None
+    assert cache.get("Where are you from?", "other model") is None
+
+
+def test_disk_tier_outlives_the_memory_tier(cache):
+    for i in range(3):
+        cache.put(f"q{i}", "model", np.full(4, i))
+    np.testing.assert_array_equal(cache.get("q0", "model"), np.zeros(4))
+    assert (cache.memory_hits, cache.disk_hits, cache.misses) == (0, 1, 0)
+
+
+def test_disk_hits_only_touch_stale_rows(cache, monkeypatch):
+    cache.put("q", "model", np.ones(4))
+    cache._memory.clear()
+    put_at = last_used(cache, "q")
+    cache.get("q", "model")
+    assert last_used(cache, "q") == put_at  # recent enough, the hit stayed a read
+
+    monkeypatch.setattr("time.time", lambda: put_at + EmbeddingCache.TOUCH_INTERVAL + 1)
+    cache._memory.clear()
+    cache.get("q", "model")
+    assert last_used(cache, "q") == put_at + EmbeddingCache.TOUCH_INTERVAL + 1
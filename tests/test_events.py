@@ -0,0 +1,91 @@
+import json
+import pytest
+import app
+import tracing
+from models import Message, Messages
+
+
+def parse(event):
+    """The (id, name, data) of one server-side-event."""
+    fields = dict(line.split(": ", 1) for line in event.strip("\n").split("\n"))
+    return int(fields["id"]), fields["event"], json.loads(fields["data"])
+
+
+@pytest.fixture
+def app_context():
+    with app.app.app_context():
+        yield
+
+
+@pytest.fixture
+def messages():
+    messages = Messages.new(system="You are Sam.")
+    messages.append(Message(role="user", content="Where are you from?"))
+    return messages
+
+
+def test_first_state_is_rendered(app_context, messages):
+    encoder = app.MessagesEventEncoder()
+    event_id, name, data = parse(encoder.encode(messages))
+    assert (event_id, name) == (1, "render")
+    assert data["html"] == '<li class="user">Where are you from?</li>'
+    assert data["last"] == "Where are you from?"
+    assert encoder.encode(messages) is None  # nothing changed, nothing sent
+
+
+def test_only_changes_are_sent(app_context, messages):
+    encoder = app.MessagesEventEncoder()
+    encoder.encode(messages)
+
+    messages.append(Message(role="assistant", content=""))
+    assert parse(encoder.encode(messages))[1:] == ("render", {
+        "html": '<li class="user">Where are you from?</li><li class="assistant"></li>',
+        "last": "",
+    })
+
+    messages[-1].content = "I grew up"
+    assert parse(encoder.encode(messages))[1:] == ("append", {"text": "I grew up"})
+    messages[-1].content += " on Vancouver Island."
+    assert parse(encoder.encode(messages))[1:] == ("append", {"text": " on Vancouver Island."})
+
+    messages[-1].content = "Actually, in Oceanside."
+    assert parse(encoder.encode(messages))[1:] == ("replace-last", {"text": "Actually, in Oceanside."})
+
+
+def test_replaying_the_events_rebuilds_the_last_message(app_context, messages):
+    """What the client does with the events: the last message ends up with the content the server has."""
+    encoder = app.MessagesEventEncoder()
+    messages.append(Message(role="assistant", content="."))
+    last = None
+    for content in ["..", "...", "", "Hi", "Hi, I'm", "Hi, I'm Sam."]:
+        messages[-1].content = content
+        event = encoder.encode(messages)
+        if event is None:
+            continue
+        _, name, data = parse(event)
+        if name == "render":
+            last = data["last"]
+        elif name == "append":
+            last += data["text"]
+        else:
+            last = data["text"]
+    assert last == "Hi, I'm Sam."
+
+
+def test_done_event(app_context, messages):
+    trace = tracing.Trace()
+    with trace.span("save"):
+        pass
+    encoder = app.MessagesEventEncoder(trace)
+    render = encoder.encode(messages)
+    event = encoder.done()
+    event_id, name, data = parse(event)
+    assert (event_id, name) == (2, "done")
+    assert [stage for stage, _ in data["timings"]] == ["save"]
+    assert trace.finished
+    assert encoder.bytes == len(render) + len(event)
+
+
+def test_done_event_without_trace(app_context, messages):
+    encoder = app.MessagesEventEncoder()
+    assert parse(encoder.done()) == (1, "done", {})
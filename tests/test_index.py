@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from apis.openai import Embedding, EmbeddingIndex
+
+
+def clustered_vectors(count, dim=32, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim))
+    vectors = centers[rng.integers(clusters, size=count)] + 0.3 * rng.standard_normal((count, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.fixture
+def embeddings():
+    return [Embedding(f"chunk {i}", v) for i, v in enumerate(clustered_vectors(2000))]
+
+
+@pytest.fixture
+def queries():
+    return [Embedding(f"query {i}", v) for i, v in enumerate(clustered_vectors(50, seed=1))]
+
+
+def brute_force(matrix, vector, k):
+    dists = np.linalg.norm(matrix - vector, axis=1)
+    order = np.argsort(dists, kind="stable")[:k]
+    return order, dists[order]
+
+
+def test_index_matches_brute_force(embeddings, queries):
+    index = EmbeddingIndex(embeddings, max_dist=None)
+    matrix = np.array([e.vector for e in embeddings])
+    for query, nearest in zip(queries, index.query_batch(queries, k=10)):
+        rows, dists = brute_force(matrix, query.vector, 10)
+        assert [d.e2 for d in nearest] == [embeddings[i] for i in rows]
+        np.testing.assert_allclose([d.dist for d in nearest], dists, rtol=1e-5)
+        assert nearest[0].e1 is query
+
+
+def test_query_is_query_batch(embeddings, queries):
+    index = EmbeddingIndex(embeddings, max_dist=None)
+    batch = index.query_batch(queries[:3], k=5)
+    assert [[d.e2.content for d in index.query(q, k=5)] for q in queries[:3]] == [
+        [d.e2.content for d in nearest] for nearest in batch
+    ]
+    assert index.query_batch([], k=5) == []
+
+
+def test_max_dist_and_k(embeddings, queries):
+    index = EmbeddingIndex(embeddings, max_dist=None)
+    nearest = index.query(queries[0], k=50)
+    cutoff = nearest[9].dist
+    assert all(d.dist < cutoff for d in index.query(queries[0], k=50, max_dist=cutoff))
+    assert len(index.query(queries[0], k=5000)) == len(embeddings)
+    assert index.query(queries[0], k=0) == []
+
+
+def test_index_default_max_dist():
+    embeddings = [Embedding(f"e{i}", v) for i, v in enumerate(np.eye(4, dtype=np.float32))]
+    index = EmbeddingIndex(embeddings, max_dist=0.5)
+    assert [d.e2 for d in index.query(Embedding("q", [0.9, 0.1, 0, 0]), k=4)] == [embeddings[0]]
+    assert len(index.query(Embedding("q", [0.9, 0.1, 0, 0]), k=4, max_dist=10)) == 4
+
+
+def test_matrix_must_match_the_embeddings():
+    embeddings = [Embedding(f"e{i}", v) for i, v in enumerate(np.eye(4, dtype=np.float32))]
+    with pytest.raises(ValueError):
+        EmbeddingIndex(embeddings, matrix=np.eye(3, dtype=np.float32))
@@ -0,0 +1,119 @@
+import os
+from types import SimpleNamespace
+import pytest
+from apis.openai import EMBEDDING_MODEL, EmbeddingStore
+from apis.openai.fake import FakeClient, FakeEmbeddings
+from ingest_knowledge import Ingester, KnowledgeVersions, _blocks, _split, iter_chunks
+
+MARKDOWN = """\
+# About me
+
+I grew up on Vancouver Island.
+I moved to Montreal for school.
+
+## Hobbies:
+
+- Chess
+- Skiing, mostly
+  in the Laurentians
+1. Badminton
+
+# Work
+Full-stack developer.
+"""
+
+
+def test_blocks():
+    assert list(_blocks(MARKDOWN.splitlines(keepends=True))) == [
+        (("About me",), "I grew up on Vancouver Island. I moved to Montreal for school."),
+        (("About me", "Hobbies"), "Chess"),
+        (("About me", "Hobbies"), "Skiing, mostly in the Laurentians"),
+        (("About me", "Hobbies"), "Badminton"),
+        (("Work",), "Full-stack developer."),
+    ]
+
+
+def test_blocks_without_headings():
+    assert list(_blocks(["just text\n", "\n", "\n", "more text"])) == [((), "just text"), ((), "more text")]
+    assert list(_blocks(["", "\n", "# Only a heading\n"])) == []
+
+
+def test_split_keeps_whole_sentences():
+    text = "One two. Three four five! Six? Seven."
+    assert list(_split(text, max_chars=1000)) == [text]
+    assert list(_split(text, max_chars=20)) == ["One two.", "Three four five!", "Six? Seven."]
+
+
+def test_split_never_cuts_a_long_sentence():
+    sentence = "This sentence is longer than the limit."
+    assert list(_split(f"Short. {sentence} End.", max_chars=10)) == ["Short.", sentence, "End."]
+
+
+def test_iter_chunks(tmp_path):
+    path = tmp_path / "info.md"
+    path.write_text(MARKDOWN)
+    chunks = list(iter_chunks(str(path), max_chars=40))
+    assert chunks[:3] == [
+        "About me: I grew up on Vancouver Island.",
+        "About me: I moved to Montreal for school.",
+        "About me > Hobbies: Chess",
+    ]
+    assert chunks[-1] == "Work: Full-stack developer."
+
+
+@pytest.fixture
+def ingester(tmp_path):
+    return Ingester(KnowledgeVersions(str(tmp_path / "knowledge")), embeddings_client=FakeClient(latency=0, dim=8))
+
+
+def test_ingest_reuses_unchanged_chunks(tmp_path, ingester):
+    source = tmp_path / "info.md"
+    source.write_text(MARKDOWN)
+    assert ingester.ingest([str(source)]) == 1
+    assert ingester.ingest([str(source)]) is None  # nothing changed
+
+    source.write_text(MARKDOWN + "\n# Coffee\n\nKicking Horse.\n")
+    assert ingester.ingest([str(source)]) == 2
+    manifest = ingester.versions.manifest(2)
+    assert (manifest["embedded"], manifest["reused"], manifest["removed"]) == (1, manifest["chunks"] - 1, 0)
+    current = EmbeddingStore(ingester.versions.current_path)
+    assert current.content(len(current) - 1) == "Coffee: Kicking Horse."
+    assert os.path.realpath(ingester.versions.current_path) == os.path.realpath(ingester.versions.path(2))
+
+
+def test_ingest_repeated_and_reordered_chunks(tmp_path, ingester):
+    source = tmp_path / "info.md"
+    source.write_text("Same paragraph.\n\nSame paragraph.\n\nAnother one.\n")
+    assert ingester.ingest([str(source)]) == 1
+    assert ingester.ingest([str(source)]) is None
+
+    # the same chunks in another order make another store, without embedding anything
+    source.write_text("Another one.\n\nSame paragraph.\n\nSame paragraph.\n")
+    assert ingester.ingest([str(source)]) == 2
+    assert ingester.versions.manifest(2)["embedded"] == 0
+    assert ingester.ingest([str(source)]) is None
+
+
+def test_prune(tmp_path, ingester):
+    source = tmp_path / "info.md"
+    for i in range(4):
+        source.write_text(f"Version {i}.\n")
+        ingester.ingest([str(source)])
+    ingester.versions.prune(keep=2)
+    assert ingester.versions.versions() == [3, 4]
+    assert not os.path.exists(ingester.versions.path(1))
+
+
+def test_fake_vectors_are_never_reused_by_a_real_run(tmp_path, ingester):
+    source = tmp_path / "info.md"
+    source.write_text(MARKDOWN)
+    assert ingester.ingest([str(source)]) == 1
+    assert ingester.versions.manifest(1)["model"] == FakeClient.MODEL
+
+    real_client = SimpleNamespace(embeddings=FakeEmbeddings(latency=0, dim=8))  # not a FakeClient, so "real"
+    real = Ingester(ingester.versions, embeddings_client=real_client)
+    assert real.ingest([str(source)]) == 2
+    manifest = ingester.versions.manifest(2)
+    assert manifest["model"] == EMBEDDING_MODEL
+    assert (manifest["embedded"], manifest["reused"]) == (manifest["chunks"], 0)
+    assert real.ingest([str(source)]) is None
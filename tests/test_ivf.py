@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from apis.openai import Embedding, EmbeddingIndex, EmbeddingStore, IVFIndex, ivf, store
+from tests.test_index import clustered_vectors
+
+
+@pytest.fixture
+def embedding_store(tmp_path):
+    path = str(tmp_path / "embeddings.bin")
+    store.save([Embedding(f"chunk {i}", v) for i, v in enumerate(clustered_vectors(2000))], path)
+    return EmbeddingStore(path)
+
+
+@pytest.fixture
+def queries():
+    return [Embedding(f"query {i}", v) for i, v in enumerate(clustered_vectors(50, seed=1))]
+
+
+def contents(nearest_lists):
+    return [[d.e2.content for d in nearest] for nearest in nearest_lists]
+
+
+def test_probing_every_list_is_exact(embedding_store, queries):
+    index = IVFIndex.build(embedding_store, nlist=16, max_dist=None)
+    exact = EmbeddingIndex(embedding_store, matrix=embedding_store.matrix, max_dist=None)
+    index.nprobe = index.nlist
+    assert contents(index.query_batch(queries, k=10)) == contents(exact.query_batch(queries, k=10))
+
+
+def test_recall(embedding_store, queries):
+    index = IVFIndex.build(embedding_store, nlist=16, nprobe=4, max_dist=None)
+    found = index.query_batch(queries, k=10)
+    truth = index.query_batch(queries, k=10, exact=True)
+    hits = sum(len(set(f) & set(t)) for f, t in zip(contents(found), contents(truth)))
+    assert hits / (10 * len(queries)) >= 0.9
+    for nearest in found:
+        assert [d.dist for d in nearest] == sorted(d.dist for d in nearest)
+
+
+def test_exact_flag(embedding_store, queries):
+    index = IVFIndex.build(embedding_store, nlist=16, nprobe=1, exact=True, max_dist=None)
+    exact = EmbeddingIndex(embedding_store, matrix=embedding_store.matrix, max_dist=None)
+    assert contents(index.query_batch(queries, k=10)) == contents(exact.query_batch(queries, k=10))
+
+
+def test_lists_hold_every_row_once(embedding_store):
+    index = IVFIndex.build(embedding_store, nlist=16)
+    assert index.list_offsets[0] == 0 and index.list_offsets[-1] == len(embedding_store)
+    assert sorted(index.list_ids) == list(range(len(embedding_store)))
+
+
+def test_save_and_open(embedding_store, queries, tmp_path):
+    index = IVFIndex.build(embedding_store, nlist=16, max_dist=None)
+    path = ivf.ivf_path(embedding_store.path)
+    index.save(path, ivf.store_fingerprint(embedding_store))
+    opened = IVFIndex.open(embedding_store, path, nprobe=index.nprobe, max_dist=None)
+    np.testing.assert_array_equal(opened.list_ids, index.list_ids)
+    assert contents([opened.query(queries[0], k=5)]) == contents([index.query(queries[0], k=5)])
+
+    # the index of one store is never used with another
+    other_path = str(tmp_path / "other.bin")
+    store.save([Embedding(f"other {i}", v) for i, v in enumerate(clustered_vectors(100, seed=2))], other_path)
+    with pytest.raises(store.StoreError):
+        IVFIndex.open(EmbeddingStore(other_path), path)
+    with pytest.raises(store.StoreError):
+        IVFIndex.open(embedding_store, str(tmp_path / "missing.ivf"))
+
+
+def test_load_falls_back_to_exact_search(embedding_store, monkeypatch, tmp_path):
+    monkeypatch.setattr("settings.LOCAL_RESOURCE_DIR", str(tmp_path))
+    assert type(EmbeddingIndex.load("embeddings.bin")) is EmbeddingIndex
+    ivf.build(embedding_store.path, nlist=16)
+    assert isinstance(EmbeddingIndex.load("embeddings.bin"), IVFIndex)
+    with open(ivf.ivf_path(embedding_store.path), "wb") as file:
+        file.write(b"garbage")
+    assert type(EmbeddingIndex.load("embeddings.bin")) is EmbeddingIndex
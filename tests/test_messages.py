@@ -0,0 +1,64 @@
+import pytest
+from models import Message, Messages, estimate_tokens
+
+
+def conversation(turns, system="You are Sam."):
+    messages = Messages.new(system=system)
+    for i in range(turns):
+        messages.append(Message(role="user", content=f"question number {i}?"))
+        messages.append(Message(role="assistant", content=f"answer number {i}, with a few more words."))
+    return messages
+
+
+def turn_cost(messages, turn):
+    return sum(m.tokens for m in messages.data[1 + 2 * turn:3 + 2 * turn])
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("Hi, Sam!") == 4
+    assert estimate_tokens("internationalization") == 1 + 19 // 6
+
+
+def test_tokens_follow_the_content():
+    message = Message(role="user", content="one")
+    before = message.tokens
+    message.content = "one two three"
+    assert message.tokens == before + 2
+
+
+def test_everything_fits():
+    messages = conversation(5)
+    assert messages.window(10_000) == messages.data
+
+
+def test_latest_turns_that_fit_are_kept_whole():
+    messages = conversation(5)
+    budget = turn_cost(messages, 4) + turn_cost(messages, 3) + turn_cost(messages, 2) - 1
+    window = messages.window(budget)
+    assert window[0].role == "system"
+    assert window[1:] == messages.data[-4:]  # two whole turns, never half of the third
+
+
+def test_latest_turn_is_kept_even_over_budget():
+    messages = conversation(3)
+    assert messages.window(1) == [messages[0]] + messages.data[-2:]
+
+
+def test_turn_with_several_answers():
+    messages = conversation(2)
+    messages.append(Message(role="assistant", content="and another thing"))
+    assert messages.window(1) == [messages[0]] + messages.data[-3:]
+
+
+def test_without_system_message():
+    messages = conversation(2)
+    messages.data = messages.data[1:]
+    assert messages.window(1) == messages.data[-2:]
+
+
+@pytest.mark.parametrize("budget", [0, None])
+def test_to_gpt_without_budget_sends_everything(budget):
+    messages = conversation(4)
+    assert len(messages.to_gpt(budget=budget)) == len(messages)
+    assert messages.to_gpt(budget=budget)[0] == {"role": "system", "content": "You are Sam."}
@@ -0,0 +1,53 @@
+import sqlite3
+import pytest
+import storage
+from models import DisplayPills, Message, Messages
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    if request.param == "json":
+        backend = storage.JsonMessagesBackend(str(tmp_path))
+    else:
+        backend = storage.SqliteMessagesBackend(str(tmp_path / "messages.sqlite3"))
+    monkeypatch.setattr(Messages, "backend", backend)
+    return backend
+
+
+def test_covered_pills_follow_the_questions():
+    messages = Messages.new(system="")
+    messages.append(Message(role="user", content="where are you from"))
+    assert "Where are you from?" in messages.covered_pills
+    messages.extend([
+        Message(role="assistant", content="What is your favourite movie?"),
+        Message(role="user", content="hi"),
+    ])
+    assert messages.covered_pills == DisplayPills.covered(["where are you from", "hi"])
+    assert "What is your favourite movie?" not in messages.covered_pills
+
+
+def test_covered_pills_are_saved_with_the_conversation(backend, monkeypatch):
+    messages = Messages.create(system="")
+    messages.append(Message(role="user", content="Do you like to read books?"))
+    messages.save()
+
+    covered = messages.covered_pills
+    assert "Do you like to read?" in covered
+    monkeypatch.setattr(DisplayPills, "covered", lambda user_contents: pytest.fail("recomputed on load"))
+    assert Messages.load_from_id(messages.id).covered_pills == covered
+
+
+def test_covered_pills_saved_with_other_pills_are_recomputed(backend):
+    messages = Messages.create(system="")
+    messages.append(Message(role="user", content="Where were you born?"))
+    backend.save(messages.id, messages._rows(), 1, {}, {"pills": "old", "covered_pills": []})
+    assert Messages.load_from_id(messages.id).covered_pills == DisplayPills.covered(["Where were you born?"])
+
+
+def test_sqlite_conversations_from_before_meta(tmp_path):
+    path = str(tmp_path / "messages.sqlite3")
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE conversations (id TEXT PRIMARY KEY, created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+        db.execute("INSERT INTO conversations VALUES ('old', 0, 0)")
+    backend = storage.SqliteMessagesBackend(path)
+    assert backend.load("old") == storage.Stored([], {})
@@ -0,0 +1,56 @@
+import time
+import pytest
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+import ratelimit_storage
+
+
+@pytest.fixture
+def uri(tmp_path):
+    return f"sqlite:///{tmp_path}/limits.sqlite3"
+
+
+def test_sqlite_scheme_is_registered(uri):
+    storage = storage_from_string(uri)
+    assert isinstance(storage, ratelimit_storage.SqliteStorage)
+    assert storage.check()
+
+
+def test_fixed_window_limit(uri):
+    limiter = FixedWindowRateLimiter(storage_from_string(uri))
+    limit = parse("3 per minute")
+    assert [limiter.hit(limit, "visitor") for _ in range(4)] == [True, True, True, False]
+    assert limiter.hit(limit, "someone else")
+    assert not limiter.test(limit, "visitor")
+    reset_at, remaining = limiter.get_window_stats(limit, "visitor")
+    assert remaining == 0
+    assert time.time() < reset_at <= time.time() + 60
+
+
+def test_counters_are_shared_between_workers(uri):
+    """Two storages over one file, as two worker processes on the same host."""
+    limit = parse("2 per minute")
+    first, second = FixedWindowRateLimiter(storage_from_string(uri)), FixedWindowRateLimiter(storage_from_string(uri))
+    assert first.hit(limit, "visitor")
+    assert second.hit(limit, "visitor")
+    assert not first.hit(limit, "visitor")
+
+
+def test_counters_expire(uri):
+    storage = storage_from_string(uri)
+    assert storage.incr("key", expiry=0.05) == 1
+    assert storage.incr("key", expiry=0.05) == 2
+    time.sleep(0.1)
+    assert storage.get("key") == 0
+    assert storage.incr("key", expiry=60) == 1  # a new window starts from scratch
+
+
+def test_clear_and_reset(uri):
+    storage = storage_from_string(uri)
+    storage.incr("a", expiry=60, amount=5)
+    storage.incr("b", expiry=60)
+    storage.clear("a")
+    assert storage.get("a") == 0 and storage.get("b") == 1
+    assert storage.reset() == 1
+    assert storage.get("b") == 0
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from apis.openai import Embedding, EmbeddingStore, store
+
+
+def random_embeddings(count, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    return [Embedding(content=f"chunk {i}", vector=rng.standard_normal(dim).astype(np.float32)) for i in range(count)]
+
+
+def test_round_trip(tmp_path):
+    embeddings = random_embeddings(5) + [
+        Embedding(content="", vector=np.zeros(8, dtype=np.float32)),
+        Embedding(content="Montréal, 🥯 and a\nnewline", vector=np.ones(8, dtype=np.float32)),
+    ]
+    path = str(tmp_path / "embeddings.bin")
+    assert store.save(embeddings, path) == len(embeddings)
+
+    assert store.is_store(path)
+    loaded = EmbeddingStore(path)
+    assert len(loaded) == len(embeddings)
+    assert loaded.dim == 8
+    assert loaded.contents() == [e.content for e in embeddings]
+    np.testing.assert_array_equal(loaded.matrix, np.array([e.vector for e in embeddings]))
+    assert loaded[-1].content == embeddings[-1].content
+    with pytest.raises(IndexError):
+        loaded[len(embeddings)]
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / "empty.bin")
+    assert store.save([], path) == 0
+    assert len(EmbeddingStore(path)) == 0
+
+
+def test_vectors_of_another_size_are_refused(tmp_path):
+    with pytest.raises(store.StoreError):
+        store.save([Embedding("a", np.zeros(4)), Embedding("b", np.zeros(5))], str(tmp_path / "mixed.bin"))
+    assert list(tmp_path.iterdir()) == []  # nothing half written is left behind
+
+
+@pytest.mark.parametrize("data", [b"", b"SAMBEMB\x00", b"not a store at all" * 8])
+def test_bad_files_raise_store_error(tmp_path, data):
+    path = tmp_path / "bad.bin"
+    path.write_bytes(data)
+    with pytest.raises(store.StoreError):
+        EmbeddingStore(str(path))
+
+
+def test_is_store(tmp_path):
+    path = tmp_path / "embeddings.json"
+    path.write_text("{}")
+    assert not store.is_store(str(path))
+    assert not store.is_store(str(tmp_path / "missing.bin"))
@@ -0,0 +1,74 @@
+import asyncio
+import streaming
+
+
+async def token_gen(tokens, delay=0.0, closed=None):
+    try:
+        for token in tokens:
+            if delay:
+                await asyncio.sleep(delay)
+            yield token
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_no_window_passes_every_token_through():
+    tokens = ["a", "b", "c"]
+    assert asyncio.run(collect(streaming.coalesce_tokens(token_gen(tokens), window=0))) == tokens
+
+
+def test_buffered_tokens_keep_their_text_and_order():
+    tokens = [f"{i} " for i in range(100)]
+    chunks = asyncio.run(collect(streaming.coalesce_tokens(token_gen(tokens), window=10, max_chars=1000)))
+    # the first token straight away, everything else together once upstream is done
+    assert chunks == [tokens[0], "".join(tokens[1:])]
+
+
+def test_max_chars_flushes_before_the_window():
+    tokens = ["x" * 10] * 11
+    chunks = asyncio.run(collect(streaming.coalesce_tokens(token_gen(tokens), window=10, max_chars=25)))
+    assert chunks[0] == tokens[0]
+    assert all(len(chunk) == 30 for chunk in chunks[1:-1])
+    assert "".join(chunks) == "".join(tokens)
+
+
+def test_window_flushes_while_upstream_is_slow():
+    async def main():
+        async def slow():
+            yield "first"
+            yield "a"
+            yield "b"
+            await asyncio.sleep(0.3)
+            yield "c"
+
+        return await collect(streaming.coalesce_tokens(slow(), window=0.05, max_chars=1000))
+
+    # "ab" can't wait for "c", it goes out once the window has passed
+    assert asyncio.run(main()) == ["first", "ab", "c"]
+
+
+def test_closing_early_closes_upstream():
+    async def main():
+        closed = []
+        chunks = streaming.coalesce_tokens(token_gen(["a"] * 100, delay=0.001, closed=closed), window=0.01)
+        assert await chunks.__anext__() == "a"
+        await chunks.aclose()
+        return closed
+
+    assert asyncio.run(main()) == [True]
+
+
+def test_coalesced_wraps_a_string_gen():
+    @streaming.coalesced
+    async def string_gen(messages):
+        for token in messages:
+            yield token
+
+    chunks = asyncio.run(collect(string_gen(["one", " two", " three"])))
+    assert "".join(chunks) == "one two three"
+    assert chunks[0] == "one"
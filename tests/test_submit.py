@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+import app
+import storage
+from models import Message, Messages
+
+
+class Prompt:
+    """Stands in for `SystemMessage`: no retrieval, no cached answer."""
+
+    cached = None
+
+    def __init__(self, content):
+        self.content = content
+
+    async def generate(self):
+        await asyncio.sleep(0.01)
+        return self.content
+
+    def remember(self, content, answer):
+        pass
+
+
+def answer_gen(answer, sent):
+    async def string_gen(messages):
+        sent.append([m["content"] for m in messages.to_gpt()])
+        for token in answer.split():
+            await asyncio.sleep(0.01)
+            yield token + " "
+    return string_gen
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    backend = storage.JsonMessagesBackend(str(tmp_path))
+    monkeypatch.setattr(Messages, "backend", backend)
+    return backend
+
+
+async def submit(messages, question, answer, sent):
+    prompt = Prompt(f"about {question}")
+    async for _ in app.string_gen_to_messages_gen(answer_gen(answer, sent), messages, question, prompt):
+        pass
+
+
+def test_submits_to_one_conversation_take_turns(backend):
+    messages = Messages.create(system="")
+    sent = []
+
+    async def main():
+        # each request loads its own copy, as they do with the cache off
+        first, second = Messages.load_from_id(messages.id), Messages.load_from_id(messages.id)
+        await asyncio.gather(
+            submit(first, "Where are you from?", "Oceanside, BC.", sent),
+            submit(second, "What do you do?", "I write software.", sent),
+        )
+
+    asyncio.run(main())
+    # the second question saw the whole first turn, and saving it kept that turn
+    assert sent[1][1:] == ["Where are you from?", "Oceanside, BC. ", "What do you do?", ""]
+    assert [m["content"] for m in backend.load(messages.id).rows][1:] == [
+        "Where are you from?", "Oceanside, BC. ", "What do you do?", "I write software. ",
+    ]
+
+
+def test_lock_is_released_when_the_client_leaves(backend):
+    messages = Messages.new(system="")
+
+    async def main():
+        gen = app.string_gen_to_messages_gen(answer_gen("a b c", []), messages, "q", Prompt("p"))
+        await gen.__anext__()
+        assert app.conversation_lock(messages.id).locked()
+        await gen.aclose()
+        assert not app.conversation_lock(messages.id).locked()
+
+    asyncio.run(main())
+    assert messages[1] == Message(role="user", content="q")